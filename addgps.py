@@ -20,11 +20,70 @@ from __future__ import print_function
 import re
 import os
 import time
+import select
 import subprocess
 import sys
 import logging
+import tempfile
+import shutil
+import struct
+import mmap
+import threading
+import heapq
+import multiprocessing
+import io
+import json
+import marshal
+import csv
+import sqlite3
+import stat
+import binascii
+import hashlib
+import cProfile
+import socket
+import signal
+from fnmatch import fnmatch
+import calendar
+import math
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import namedtuple, OrderedDict, deque
+from itertools import islice, chain
+from operator import itemgetter
 import readline  # for raw_input() reading from stdin
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver     # Python 2
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
+import addgps_client
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import queue
+except ImportError:
+    import Queue as queue       # Python 2
+try:
+    from logging.handlers import QueueHandler, QueueListener
+except ImportError:
+    QueueHandler = QueueListener = None     # Python 2
+
+if sys.version_info[0] >= 3:
+    unicode = str           #pylint: disable=redefined-builtin,invalid-name
+    raw_input = input       #pylint: disable=redefined-builtin,invalid-name
 
 #TODO: Add some Windows readline love, and fail gracefully everywhere
 #      if readline is not installed.
@@ -52,32 +111,595 @@ EPILOG = u"\n\
 # Acquire a logger with default setup, for early use
 m_logger = logging.getLogger(LOGGER_NAME)
 
+EXIFTOOL = u"exiftool"
+
+# Number of files handed to one exiftool command
+BATCH_SIZE = 1000
+
+ExiftoolResult = namedtuple('ExiftoolResult', ['returncode', 'stdout', 'stderr'])
+FileResult = namedtuple('FileResult', ['filename', 'returncode', 'message'])
+
+# Seconds between two progress lines with --stats
+PROGRESS_INTERVAL = 10.0
+
+clock = getattr(time, "perf_counter", time.time)
+
+class StageTimer(object):
+    """Time one pass through a stage, see Stats.timer"""
+    __slots__ = ("stats", "stage", "count", "start")
+
+    def __init__(self, stats, stage, count):
+        self.stats = stats
+        self.stage = stage
+        self.count = count
+        self.start = None
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.add(self.stage, clock() - self.start, self.count)
+        return False
+
+class Stats(object):
+    """
+    Timings of the stages of a run and counters like bytes written.
+
+    Stages may be timed from several threads. While --stats is not
+    given, m_stats is a NullStats instead, which records nothing.
+    """
+    enabled = True
+
+    def __init__(self, total=None, write_strategy=None):
+        self.start = clock()
+        self.total = total
+        self.write_strategy = write_strategy
+        self.stages = OrderedDict()
+        self.counters = OrderedDict()
+        self.files = 0
+        self.failed = 0
+        self.next_progress = self.start + PROGRESS_INTERVAL
+        self.lock = threading.Lock()
+
+    def timer(self, stage, count=1):
+        """Return a context manager timing a pass through stage, for count items"""
+        return StageTimer(self, stage, count)
+
+    def add(self, stage, seconds, count=1):
+        """Account seconds spent in stage on count items"""
+        with self.lock:
+            entry = self.stages.setdefault(stage, [0, 0.0])
+            entry[0] += count
+            entry[1] += seconds
+
+    def count(self, counter, value=1):
+        """Add value to a counter"""
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def file_done(self, result):
+        """Count a finished file, logging progress every PROGRESS_INTERVAL seconds"""
+        self.files += 1
+        if result.returncode:
+            self.failed += 1
+        now = clock()
+        if now >= self.next_progress:
+            self.next_progress = now + PROGRESS_INTERVAL
+            rate = self.files / (now - self.start)
+            if self.total and rate:
+                m_logger.info("%d of %d files done, %d failed, %.0f files/s, ETA %s",
+                              self.files, self.total, self.failed, rate,
+                              time.strftime("%H:%M:%S", time.gmtime(
+                                  max(0, self.total - self.files) / rate)))
+            else:
+                m_logger.info("%d files done, %d failed, %.0f files/s",
+                              self.files, self.failed, rate)
+
+    def summary(self):
+        """@param return: dictionary of everything recorded, for --stats-json"""
+        elapsed = clock() - self.start
+        return OrderedDict([
+            ("seconds", round(elapsed, 6)),
+            ("files", self.files),
+            ("failed", self.failed),
+            ("files_per_second", round(self.files / elapsed, 3) if elapsed else 0.0),
+            ("write_strategy", self.write_strategy),
+            ("stages", OrderedDict((stage, OrderedDict([("count", count),
+                                                        ("seconds", round(seconds, 6))]))
+                                   for stage, (count, seconds) in self.stages.items())),
+            ("counters", OrderedDict(self.counters)),
+        ])
+
+    def table(self):
+        """@param return: the summary as a table, for --stats"""
+        summary = self.summary()
+        lines = ["{:18} {:>10} {:>10} {:>10} {:>6}".format(
+            "stage", "count", "total s", "mean ms", "share")]
+        for stage, entry in summary["stages"].items():
+            lines.append("{:18} {:>10} {:>10.3f} {:>10.3f} {:>5.1f}%".format(
+                stage, entry["count"], entry["seconds"],
+                entry["seconds"] * 1000 / entry["count"] if entry["count"] else 0.0,
+                entry["seconds"] * 100 / summary["seconds"] if summary["seconds"] else 0.0))
+        for counter, value in summary["counters"].items():
+            lines.append("{:18} {:>10}".format(counter, value))
+        lines.append("{} files, {} failed, {:.3f} s, {:.1f} files/s, {} write strategy".format(
+            summary["files"], summary["failed"], summary["seconds"],
+            summary["files_per_second"], summary["write_strategy"]))
+        return "\n".join(lines)
+
+class NullTimer(object):
+    """A StageTimer which does nothing"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+class NullStats(object):
+    """Stats which record nothing, so instrumentation costs next to nothing"""
+    enabled = False
+    null_timer = NullTimer()
+
+    def timer(self, stage, count=1):        #pylint: disable=unused-argument
+        """See Stats.timer"""
+        return self.null_timer
+
+    def add(self, stage, seconds, count=1):
+        """See Stats.add"""
+        pass
+
+    def count(self, counter, value=1):
+        """See Stats.count"""
+        pass
+
+    def file_done(self, result):
+        """See Stats.file_done"""
+        pass
+
+# Where the stages of a run are timed, see set_stats
+m_stats = NullStats()
+
+def set_stats(stats):
+    """Record the timings of everything which follows in stats, a Stats or NullStats"""
+    global m_stats      #pylint: disable=global-statement,invalid-name
+    m_stats = stats
+
+class FileEvents(object):
+    """
+    One log event per file, for --log-format jsonl: its path, what was
+    done to it with which coordinates, the result, and the seconds from
+    the file being taken up to its result. Files are taken up by jobs
+    and finished by file_done, see ResultCounter.
+    """
+    enabled = True
+
+    def __init__(self):
+        self.started = dict()
+
+    def jobs(self, jobs):
+        """Pass jobs on, see run_jobs, noting what they write and when"""
+        for filename, arguments in jobs:
+            self.started[filename] = (written_position(arguments), clock())
+            yield filename, arguments
+
+    def file_done(self, result):
+        """Log the event of a finished file"""
+        written, start = self.started.pop(result.filename, (None, None))
+        if not m_logger.isEnabledFor(logging.INFO):
+            return
+        action, position = written or (None, None)
+        lat, lon, alt = position or (None, None, None)
+        if result.returncode is None:
+            outcome = "skipped"
+        else:
+            outcome = "failed" if result.returncode else "done"
+        event = OrderedDict([
+            ("path", result.filename), ("action", action),
+            ("lat", lat), ("lon", lon), ("alt", alt),
+            ("result", outcome), ("detail", result.message or None),
+            ("seconds", None if start is None else round(clock() - start, 6)),
+        ])
+        m_logger.info("%s \"%s\": %s", action or "-", result.filename, outcome,
+                      extra={"event": event})
+
+class NullEvents(object):
+    """FileEvents which log nothing"""
+    enabled = False
+
+    def jobs(self, jobs):
+        """See FileEvents.jobs"""
+        return jobs
+
+    def file_done(self, result):
+        """See FileEvents.file_done"""
+        pass
+
+# Where files are logged as they are done, see set_events
+m_events = NullEvents()
+
+def set_events(events):
+    """Log an event for every file which follows with events, a FileEvents or NullEvents"""
+    global m_events     #pylint: disable=global-statement,invalid-name
+    m_events = events
+
+class ExiftoolError(Exception):
+    """Raised when the persistent exiftool process misbehaves"""
+    pass
+
+class ExiftoolEngine(object):
+    """Run many exiftool commands through one persistent process.
+
+    exiftool is started once with "-stay_open True -@ -" and each
+    command is streamed to its stdin, terminated by a numbered
+    "-execute" marker. The process is started lazily, so a dry run
+    never spawns exiftool. Use as a context manager to make sure the
+    process is shut down, also on Ctrl-C.
+    """
+    def __init__(self, executable=EXIFTOOL):
+        self.executable = executable
+        self.process = None
+        self.sequence = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # After an interrupt the process may be in the middle of a
+        # command, so don't bother asking it nicely.
+        self.close(force=exc_type is not None)
+        return False
+
+    def start(self):
+        """Start the exiftool process, if it is not already running"""
+        if self.process is None:
+            cmd = [self.executable, "-stay_open", "True", "-@", "-"]
+            m_logger.debug("Starting exiftool engine \"%s\"", cmd)
+            try:
+                self.process = subprocess.Popen(cmd,
+                                                stdin=subprocess.PIPE,
+                                                stdout=subprocess.PIPE,
+                                                stderr=subprocess.PIPE)
+            except OSError as exception:
+                raise ExiftoolError("Cannot start {}: {}".format(self.executable, exception))
+
+    def close(self, force=False):
+        """Shut down the exiftool process"""
+        process, self.process = self.process, None
+        if process is None:
+            return
+        if not force:
+            try:
+                process.stdin.write(b"-stay_open\nFalse\n")
+                process.stdin.flush()
+            except (IOError, OSError):
+                force = True
+        if force and process.poll() is None:
+            process.terminate()
+        for stream in (process.stdin, process.stdout, process.stderr):
+            try:
+                stream.close()
+            except (IOError, OSError):
+                pass
+        process.wait()
+
+    def execute(self, arguments):
+        """
+        @param arguments: list of exiftool arguments, without the program name
+        @param return: ExiftoolResult with return code, stdout and stderr
+        """
+        self.start()
+        self.sequence += 1
+        m_stats.count("exiftool_commands")
+        marker, payload = command_payload(arguments, self.sequence)
+
+        try:
+            self.process.stdin.write(payload)
+            self.process.stdin.flush()
+        except (IOError, OSError) as exception:
+            raise ExiftoolError("Lost connection to exiftool: {}".format(exception))
+
+        stdout, stderr = self._collect(marker.encode("ascii"))
+        return parse_exiftool_output(stdout, stderr, marker)
+
+    def _collect(self, marker):
+        """Read stdout and stderr until both end with marker.
+
+        Both pipes are drained together, so a command with lots of
+        error output cannot block on a full stderr pipe.
+        """
+        buffers = {self.process.stdout.fileno(): bytearray(),
+                   self.process.stderr.fileno(): bytearray()}
+        pending = set(buffers)
+        while pending:
+            readable = select.select(list(pending), [], [])[0]
+            for fd in readable:
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    self.close(force=True)
+                    raise ExiftoolError("exiftool exited unexpectedly")
+                buf = buffers[fd]
+                buf.extend(chunk)
+                if ends_with_marker(buf, marker):
+                    pending.discard(fd)
+        return (bytes(buffers[self.process.stdout.fileno()]),
+                bytes(buffers[self.process.stderr.fileno()]))
+
+def command_payload(arguments, sequence):
+    """
+    @param arguments: list of exiftool arguments, without the program name
+    @param sequence: number of the command
+    @param return: (marker ending its output, bytes to send to a -stay_open exiftool)
+    """
+    marker = "{{ready{}}}".format(sequence)
+    lines = list(arguments)
+    lines.extend(["-echo4", "${status}" + marker, "-execute{}".format(sequence)])
+    payload = []
+    for line in lines:
+        line = encode_argument(line)
+        if b"\n" in line:
+            raise ExiftoolError("Newline in exiftool argument {!r}".format(line))
+        payload.append(line)
+    payload.append(b"")
+    return marker, b"\n".join(payload)
+
+def ends_with_marker(output, marker):
+    """Tell if the output read so far ends with the marker of the command, as bytes"""
+    return output[-(len(marker) + 2):].rstrip().endswith(marker)
+
+def encode_argument(argument):
+    """Return argument as bytes, suitable for an exiftool argfile"""
+    if isinstance(argument, bytes):
+        return argument
+    return argument.encode("utf-8")
+
+def parse_exiftool_output(stdout, stderr, marker):
+    """Split the raw output of one -stay_open command into an ExiftoolResult"""
+    stdout = stdout.decode("utf-8", "replace").rstrip()
+    stderr = stderr.decode("utf-8", "replace").rstrip()
+
+    if stdout.endswith(marker):
+        stdout = stdout[:-len(marker)]
+
+    status = None
+    if stderr.endswith(marker):
+        stderr = stderr[:-len(marker)]
+        i = re.search(r'(?:^|\n)(\d+)$', stderr)
+        if i:
+            status = int(i.group(1))
+            stderr = stderr[:i.start(1)]
+
+    if status is None:
+        # Older exiftool versions don't know ${status}
+        stderr = re.sub(r'(?:^|\n)\$\{status\}$', '', stderr)
+        status = 1 if re.search(r'^Error', stderr, re.MULTILINE) else 0
+
+    return ExiftoolResult(status, stdout.strip("\n"), stderr.strip("\n"))
+
+MAX_LATITUDE = 90
+MAX_LONGITUDE = 180
+MAX_ALTITUDE = 10000000
+FEET = 0.304    # feet to meters
+
+# Degrees, minutes and seconds: 33°21'23.7"N, 33 21 23.7 N, 33:21:23.7N, 33d21m23.7s
+# (the degree sign is accepted both UTF-8 encoded and as a single character)
+DMS_COORDINATE = re.compile(
+    r'^([A-Z])?\s*([+-])?(\d+(?:\.\d*)?)\s*(?:\xc2\xb0|\xb0|deg|d|:|\s)\s*'
+    r'(?:(\d+(?:\.\d*)?)\s*(?:\'|min|m|:|\s)?\s*'
+    r'(?:(\d+(?:\.\d*)?)\s*(?:"|\'\'|sec|s)?)?)?\s*([A-Z])?$')
+ALTITUDE_VALUE = re.compile(r'^([+-]?\d+(?:\.\d*)?)\s*(feet|ft|f|m)?')
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+# Cells of less than four characters are too coarse to tag photos with
+GEOHASH_VALUE = re.compile(r'^[0-9b-hjkmnp-z]{4,12}$')
+
+DECIMAL_PATTERNS = {}
+
+CoordinateBatch = namedtuple("CoordinateBatch", ["latitudes", "latitude_refs",
+                                                 "longitudes", "longitude_refs",
+                                                 "altitudes", "altitude_refs",
+                                                 "errors", "messages"])
+
+def decimal_pattern(neg_ref, pos_ref):
+    """Return the compiled regex for decimal degrees with the given references"""
+    pattern = DECIMAL_PATTERNS.get((neg_ref, pos_ref))
+    if pattern is None:
+        pattern = re.compile(r'^([+-]?\d+(?:\.\d*)?)([{}{}])?'.format(
+            re.escape(pos_ref), re.escape(neg_ref)))
+        DECIMAL_PATTERNS[(neg_ref, pos_ref)] = pattern
+    return pattern
+
+def parse_coordinate(value, neg_ref, pos_ref, name):
+    """
+    Parse one latitude or longitude. Allowable input is
+    [+-]n[.fffff][<pos_ref><neg_ref>] or degrees, minutes and seconds
+    like 33°21'23.7"N, 33 21 23.7 N, 33:21:23.7N or 33d21m23.7s.
+
+    @param value: string to parse
+    @param neg_ref: reference of negative values, like "S"
+    @param pos_ref: reference of positive values, like "N"
+    @param name: name of the value, for error messages
+    @param return: (absolute value in degrees, reference)
+    """
+    i = DMS_COORDINATE.match(value)
+    if i:
+        lead_ref, sign, degrees, minutes, seconds, ref = i.groups()
+        if (lead_ref and ref) or (lead_ref or ref) not in (None, pos_ref, neg_ref) or \
+           float(minutes or 0) >= 60 or float(seconds or 0) >= 60:
+            raise ValueError("Unrecognized {} value \"{}\"".format(name, value))
+        ref = lead_ref or ref
+        val = float(degrees) + float(minutes or 0) / 60 + float(seconds or 0) / 3600
+        negative = sign == "-"
+    else:
+        i = decimal_pattern(neg_ref, pos_ref).search(value)
+        if not i:
+            raise ValueError("Unrecognized {} value \"{}\"".format(name, value))
+        val = float(i.group(1))
+        ref = i.group(2)
+        negative = val < 0
+        val = abs(val)
+
+    if negative:
+        if ref is not None:
+            raise ValueError("Negative value cannot have {}/{} reference".format(
+                pos_ref, neg_ref))
+        return val, neg_ref
+    return val, ref or pos_ref
+
+def parse_altitude(value):
+    """
+    Parse an altitude in meters, or in feet with an "f", "ft" or "feet" suffix.
+
+    @param value: string to parse, None or "" if there is no altitude
+    @param return: (absolute value in meters or None, reference)
+    """
+    if value is None or value == "":
+        # Altitude is optional
+        return None, ''
+
+    i = ALTITUDE_VALUE.search(value)
+    if not i:
+        raise ValueError("Unrecognized altitude value \"{}\"".format(value))
+
+    val = float(i.group(1))
+    if i.group(2) in ('f', 'ft', 'feet'):
+        val *= FEET
+    if val < 0:
+        return -val, 'Below sea level'
+    return val, 'Above sea level'
+
+def decode_geohash(geohash):
+    """
+    @param geohash: geohash string like "9q8yyk"
+    @param return: (lat, lon) of the center of the cell, north and east positive
+    """
+    lat = [-90.0, 90.0]
+    lon = [-180.0, 180.0]
+    even = True
+    for char in geohash.lower():
+        bits = GEOHASH_ALPHABET.find(char)
+        if bits < 0:
+            raise ValueError("Unrecognized geohash \"{}\"".format(geohash))
+        for mask in (16, 8, 4, 2, 1):
+            interval = lon if even else lat
+            middle = (interval[0] + interval[1]) / 2
+            interval[0 if bits & mask else 1] = middle
+            even = not even
+    return (lat[0] + lat[1]) / 2, (lon[0] + lon[1]) / 2
+
+def degrees_text(lat, lon):
+    """
+    @param lat: signed latitude, north is positive
+    @param lon: signed longitude, east is positive
+    @param return: (latitude, longitude) strings with explicit references
+    """
+    return ("{:.6f}{}".format(abs(lat), "N" if lat >= 0 else "S"),
+            "{:.6f}{}".format(abs(lon), "E" if lon >= 0 else "W"))
+
+def geohash_coordinates(text):
+    """Return (latitude, longitude) strings for a geohash, None if text isn't one"""
+    if not GEOHASH_VALUE.match(text):
+        return None
+    return degrees_text(*decode_geohash(text))
+
+def coordinate_arguments(title, value, ref):
+    """Return a value and its reference as parameters for exiftool"""
+    if value is None or value != value:     # None or NaN: no value
+        return []
+    return ["-GPS{}={}".format(title, float(value)),
+            "-GPS{}Ref={}".format(title, ref)]
+
+def range_errors(columns, count):
+    """
+    Validate parsed coordinates against their ranges in one pass.
+
+    @param columns: array('d') of latitudes, longitudes and altitudes, NaN
+                    where a value could not be parsed
+    @param count: number of rows
+    @param return: (columns, error mask, {row: (column, value)} of values out of range)
+    """
+    limits = (MAX_LATITUDE, MAX_LONGITUDE, MAX_ALTITUDE)
+    if numpy is not None and count:
+        columns = [numpy.frombuffer(column, dtype=numpy.float64) for column in columns]
+        errors = numpy.isnan(columns[0]) | numpy.isnan(columns[1])
+        ranges = [column > limit for column, limit in zip(columns, limits)]
+        out_of_range = {}
+        for index in reversed(range(len(columns))):
+            for row in numpy.flatnonzero(ranges[index]):
+                out_of_range[int(row)] = (index, float(columns[index][row]))
+            errors |= ranges[index]
+        return columns, errors, out_of_range
+
+    errors = []
+    out_of_range = {}
+    for row in range(count):
+        values = [column[row] for column in columns]
+        bad = [index for index, value in enumerate(values) if value > limits[index]]
+        if bad:
+            out_of_range[row] = (bad[0], values[bad[0]])
+        errors.append(bool(bad) or values[0] != values[0] or values[1] != values[1])
+    return columns, errors, out_of_range
+
+def parse_coordinates_batch(latitudes, longitudes, altitudes=None):
+    """
+    Parse and validate columns of coordinates. Every string is matched by
+    precompiled regexes, the range checks run over whole columns at once,
+    vectorized with NumPy if it is installed.
+
+    @param latitudes: sequence of latitude strings, see GPSLatitude
+    @param longitudes: sequence of longitude strings, see GPSLongitude
+    @param altitudes: sequence of altitude strings, None or "" if unknown;
+                      None if there are no altitudes at all
+    @param return: CoordinateBatch; values are absolute, NaN where unknown,
+                   in NumPy arrays if available and array('d') otherwise.
+                   errors is a per-row mask and messages maps the rows in
+                   error to their error message
+    """
+    count = len(latitudes)
+    if altitudes is None:
+        altitudes = [None] * count
+    nan = float("nan")
+    columns = (array('d'), array('d'), array('d'))
+    refs = ([], [], [])
+    messages = {}
+    with m_stats.timer("parse", count):
+        for row, (lat, lon, alt) in enumerate(zip(latitudes, longitudes, altitudes)):
+            try:
+                values = (parse_coordinate(lat, 'S', 'N', 'latitude'),
+                          parse_coordinate(lon, 'E', 'W', 'longitude'),
+                          parse_altitude(alt))
+            except ValueError as exception:
+                messages[row] = "{}".format(exception)
+                values = ((nan, ''), (nan, ''), (nan, ''))
+            for column, ref, (value, valref) in zip(columns, refs, values):
+                column.append(nan if value is None else value)
+                ref.append(valref)
+
+        columns, errors, out_of_range = range_errors(columns, count)
+    for row, (index, value) in out_of_range.items():
+        messages.setdefault(row, "{} value is out of range: {}".format(
+            ("Latitude", "Longitude", "Altitude")[index], value))
+    return CoordinateBatch(columns[0], refs[0], columns[1], refs[1],
+                           columns[2], refs[2], errors, messages)
+
+def batch_arguments(batch, row):
+    """Return the exiftool arguments for a row of a CoordinateBatch, None if it is in error"""
+    if batch.errors[row]:
+        return None
+    return (coordinate_arguments("Latitude", batch.latitudes[row], batch.latitude_refs[row]) +
+            coordinate_arguments("Longitude", batch.longitudes[row], batch.longitude_refs[row]) +
+            coordinate_arguments("Altitude", batch.altitudes[row], batch.altitude_refs[row]))
+
 class GPSxyz(object):
     """Parse and print GPS Latitude or Longitude for exiftool.
     Allowable input is:
-    [+-]n[.fffff][NS]
+    [+-]n[.fffff][NS] or degrees, minutes and seconds, see parse_coordinate
     """
     def __init__(self, value, neg_ref, pos_ref, name, maxval):      #pylint: disable=too-many-arguments
         self.name = name.lower()
         self.title = name.title()
-
-        i = re.search(r'^([+-]?\d+(?:\.\d*)?)([{}{}])?'.format(pos_ref, neg_ref), value)
-        if i:
-            self.val = float(i.group(1))
-            if self.val >= 0:
-                if i.group(2) in [None, pos_ref]:
-                    self.valref = pos_ref
-                else:
-                    self.valref = neg_ref
-            else:
-                if i.group(2) is None:
-                    self.val = -self.val
-                    self.valref = neg_ref
-                else:
-                    raise ValueError("Negative value cannot have {}/{} reference".format(
-                        pos_ref, neg_ref))
-        else:
-            raise ValueError("Unrecognized {} value \"{}\"".format(name, value))
+        self.val, self.valref = parse_coordinate(value, neg_ref, pos_ref, name)
 
         if self.val > maxval:
             raise ValueError("{} value is out of range: {}".format(
@@ -93,8 +715,8 @@ class GPSxyz(object):
 
     def arguments(self):
         """Return the value and reference as parameters for exiftool"""
-        return ["-GPS{}=\"{}\"".format(self.title, self.value()),
-                "-GPS{}Ref=\"{}\"".format(self.title, self.ref())]
+        with m_stats.timer("arguments"):
+            return coordinate_arguments(self.title, self.value(), self.ref())
 
 class GPSLatitude(GPSxyz):
     """Parse and print GPS Latitude for exiftool.
@@ -102,7 +724,7 @@ class GPSLatitude(GPSxyz):
     [+-]n[.fffff][NS]
     """
     def __init__(self, value):
-        super(GPSLatitude, self).__init__(value, 'S', 'N', 'latitude', 90)
+        super(GPSLatitude, self).__init__(value, 'S', 'N', 'latitude', MAX_LATITUDE)
 
 class GPSLongitude(GPSxyz):
     """Parse and print GPS Longitude for exiftool.
@@ -110,75 +732,44 @@ class GPSLongitude(GPSxyz):
     [+-]n[.fffff][NS]
     """
     def __init__(self, value):
-        super(GPSLongitude, self).__init__(value, 'E', 'W', 'longitude', 180)
+        super(GPSLongitude, self).__init__(value, 'E', 'W', 'longitude', MAX_LONGITUDE)
 
 class GPSAltitude(GPSxyz):
     """Parse and print GPS Altitude for exiftool"""
-    def __init__(self, value):
-        super(GPSAltitude, self).__init__(
-            value,
-            'Below sea level',
-            'Above sea level',
-            'altitude',
-            10000000)
-
-        if value is None or value == "":
-            self.val = None
-            self.valref = ''
-        else:
-            i = re.search(r'^([+-]?\d+(?:\.\d*)?)(f)?', value)
-            if i:
-                self.val = float(i.group(1))
-                if i.group(2) == 'f':
-                    self.val *= 0.304 # feet to meters
-
-                if self.val < 0:
-                    self.val = -self.val
-                    self.valref = 'Below sea level'
-                else:
-                    self.valref = 'Above sea level'
+    def __init__(self, value):      #pylint: disable=super-init-not-called
+        self.name = 'altitude'
+        self.title = 'Altitude'
+        self.val, self.valref = parse_altitude(value)
 
-            else:
-                raise ValueError("Unrecognized {} value \"{}\"".format(self.name, value))
-
-    def arguments(self):
-        """Return the value and reference as parameters for exiftool"""
-        if self.val is None:
-            return []
-        else:
-            return ["-GPS{}=\"{}\"".format(self.title, self.value()),
-                    "-GPS{}Ref=\"{}\"".format(self.title, self.ref())]
+        if self.val is not None and self.val > MAX_ALTITUDE:
+            raise ValueError("{} value is out of range: {}".format(
+                self.title, self.val))
 
 class SimpleCompleter(object):
     """Used to complete GPS coordinate aliases.
     Happily stolen from http://pymotw.com/2/readline/
+    The matches for a text are found by bisecting the sorted options,
+    so completion doesn't depend on the number of aliases.
     """
 
     def __init__(self, options):
         self.options = sorted(options)
+        self.start = 0
         return
 
     def complete(self, text, state):
         """Perform completion. See readline module for more info."""
 
-        response = None
         if state == 0:
-            # This is the first time for this text, so build a match list.
-            if text:
-                matches = [s
-                           for s in self.options
-                           if s and s.startswith(text)]
-                m_logger.debug('%s matches: %s', repr(text), matches)
-            else:
-                matches = self.options[:]
-                m_logger.debug('(empty input) matches: %s', matches)
+            # This is the first time for this text, find the first match.
+            self.start = bisect_left(self.options, text)
 
-        # Return the state'th item from the match list,
+        # Return the state'th item from the matches,
         # if we have that many.
-        try:
-            response = matches[state]
-        except IndexError:
-            response = None
+        index = self.start + state
+        response = None
+        if index < len(self.options) and self.options[index].startswith(text):
+            response = self.options[index]
         m_logger.debug('complete(%s, %s) => %s',
                        repr(text), state, repr(response))
         return response
@@ -196,9 +787,20 @@ def handle_arguments(arglist):
                             description=mydescription)
 
     parser.add_argument("-a", "--alias", dest="alias", action='append',
-                        default={},
+                        default=[],
                         help=("define an alias for easier location entry. " +
-                              "This argument may be given multiple times."))
+                              "This argument may be given multiple times. " +
+                              "Aliases can also be kept in the alias store, " +
+                              "see \"%(prog)s alias --help\"."))
+
+    parser.add_argument("--alias-file", dest="alias_file", metavar="FILE",
+                        help=("alias store to use. Default is " +
+                              "$XDG_CONFIG_HOME/addgps/aliases."))
+
+    parser.add_argument("--snap", dest="snap", type=float, metavar="METERS",
+                        help=("replace coordinates by those of the nearest " +
+                              "alias within this distance, so that files " +
+                              "taken at one site get identical coordinates."))
 
     parser.add_argument("-s", "--dryrun", dest="dryrun", action="store_true",
                         help=("enable dryrun mode: just simulate what " +
@@ -213,31 +815,396 @@ def handle_arguments(arglist):
     parser.add_argument("--logfile", dest="logfile", action="store",
                         help="Name of log file")
 
+    parser.add_argument("--log-format", dest="log_format", choices=("text", "jsonl"),
+                        default="text",
+                        help=("format of the log: \"text\" lines, or " +
+                              "\"jsonl\", JSON lines with an event for " +
+                              "every file, giving its path, action, " +
+                              "coordinates, result and duration. Default " +
+                              "is \"%(default)s\"."))
+
     parser.add_argument("-r", "--remove", dest="action", action="store_const",
                         const="remove", default="add",
                         help="Remove GPS information from files.")
 
+    parser.add_argument("--within", dest="within", action="append", default=[],
+                        metavar="NAME_OR_COORD:RADIUS",
+                        help=("with --remove, only remove GPS information " +
+                              "from the files taken within RADIUS meters " +
+                              "of an alias or of \"lat, lon\", e.g. " +
+                              "\"home:200\". This argument may be given " +
+                              "multiple times."))
+
     parser.add_argument("-c", "--confirm", dest="confirm", action="store_true",
                         help=("Ask for confirmation before removing GPS " +
                               "info. Default is to not ask."))
 
+    parser.add_argument("-j", "--jobs", dest="jobs", type=int,
+                        default=multiprocessing.cpu_count(),
+                        help=("number of exiftool processes to run in parallel. " +
+                              "Default is the number of CPUs."))
+
+    parser.add_argument("--backend", dest="backend", choices=("native", "exiftool"),
+                        default="native",
+                        help=("how to add GPS information: \"native\" writes " +
+                              "JPEG files directly and uses exiftool for all " +
+                              "other files, \"exiftool\" always uses exiftool. " +
+                              "Default is \"native\"."))
+
+    parser.add_argument("--geocode", dest="geocode", action="store_true",
+                        help=("also write the city, state and country of " +
+                              "the nearest place in the gazetteer built by " +
+                              "\"addgps gazetteer build\", as IPTC and XMP " +
+                              "tags."))
+
+    parser.add_argument("--gazetteer", dest="gazetteer", metavar="FILE",
+                        help=("gazetteer to use with --geocode. Default is " +
+                              "$XDG_DATA_HOME/addgps/gazetteer."))
+
+    parser.add_argument("--geocode-radius", dest="geocode_radius", type=float,
+                        default=GEOCODE_RADIUS, metavar="METERS",
+                        help=("with --geocode, the largest distance to the " +
+                              "place. Default is %(default)s."))
+
+    parser.add_argument("--sidecar", dest="sidecar", action="store_true",
+                        help=("add GPS information to, or remove it from, " +
+                              "XMP sidecars (\"IMG_0001.xmp\" next to " +
+                              "\"IMG_0001.CR2\") instead of the files " +
+                              "themselves, for camera RAW files and videos, " +
+                              "or the files of --sidecar-ext."))
+
+    parser.add_argument("--sidecar-ext", dest="sidecar_extensions", action="append",
+                        default=[], metavar="EXT[,EXT]",
+                        help=("with --sidecar, the extensions of the files " +
+                              "to write sidecars for, e.g. \"cr2,mov\", or " +
+                              "\"*\" for all files. This argument may be " +
+                              "given multiple times."))
+
+    parser.add_argument("--pipeline", dest="pipeline", action="store_true",
+                        help=("run discovery, checking and writing concurrently " +
+                              "in an asyncio pipeline with bounded queues " +
+                              "(Python 3 only)."))
+
+    parser.add_argument("--write-strategy", dest="write_strategy",
+                        choices=list(WRITE_STRATEGIES), default="backup",
+                        help=("how files are written: \"backup\" keeps the " +
+                              "original as FILE_original, \"overwrite\" " +
+                              "replaces the file by a new one, \"in-place\" " +
+                              "rewrites the file itself, keeping its inode, " +
+                              "at the cost of writing it twice. Default is " +
+                              "\"%(default)s\"."))
+
+    parser.add_argument("--fsync-every", dest="fsync_every", type=int, metavar="N",
+                        help=("flush the files written to disk every N files. " +
+                              "Default is to leave that to the operating system."))
+
+    parser.add_argument("--verify", dest="verify", action="store_true",
+                        help=("read the GPS position of the files written " +
+                              "back, a batch at a time while the next one is " +
+                              "written, and count those which do not have " +
+                              "the one asked for as failed."))
+
+    parser.add_argument("--verify-hash", dest="verify_hash", action="store_true",
+                        help=("with --verify, also hash the image data of " +
+                              "each file before and after writing it, to " +
+                              "check that only its metadata changed."))
+
+    parser.add_argument("--gpx", dest="gpx", action="append", default=[],
+                        metavar="TRACK.gpx",
+                        help=("take the coordinates from a GPX track log, " +
+                              "or an NMEA log (.nmea, .nma), by the time " +
+                              "each file was taken, instead of asking for " +
+                              "them. This argument may be given multiple times."))
+
+    parser.add_argument("--track-index", dest="track_index", action="store_true",
+                        help=("like --gpx, but take the coordinates from " +
+                              "the track store built by \"addgps track-index " +
+                              "build\"."))
+
+    parser.add_argument("--track-store", dest="track_store", metavar="DIR",
+                        help=("track store to use with --track-index. " +
+                              "Default is $XDG_DATA_HOME/addgps/tracks."))
+
+    parser.add_argument("--time-offset", dest="time_offset", default="0",
+                        help=("time zone of the camera clock, for files " +
+                              "without one, e.g. \"+02:00\" or \"-8\". " +
+                              "Default is UTC."))
+
+    parser.add_argument("--max-gap", dest="max_gap", type=float, default=MAX_GAP,
+                        metavar="SECONDS",
+                        help=("largest time between two track points to " +
+                              "interpolate over. Default is %(default)s."))
+
+    parser.add_argument("--mapping", dest="mapping", metavar="FILE",
+                        help=("read file names and their coordinates from " +
+                              "FILE (\"-\" for stdin) instead of asking for " +
+                              "them. Each line is either CSV: \"path, lat, " +
+                              "lon[, alt]\" or \"path, alias\", or JSON: " +
+                              "{\"path\": ..., \"lat\": ..., \"lon\": ..., " +
+                              "\"alt\": ...} or {\"path\": ..., \"alias\": ...}."))
+
+    parser.add_argument("--mapping-format", dest="mapping_format",
+                        choices=("csv", "jsonl"),
+                        help="format of --mapping. Default is to guess.")
+
+    parser.add_argument("--manifest", dest="manifest", metavar="FILE",
+                        help=("remember in FILE (an SQLite database) which " +
+                              "files got which coordinates, and skip files " +
+                              "which already have the coordinates to add."))
+
+    parser.add_argument("--scan", dest="scan", action="store_true",
+                        help=("do not change the files, but print which of them " +
+                              "have a GPS position, reading JPEG, TIFF, HEIF and " +
+                              "MP4 files natively in --jobs processes."))
+
+    parser.add_argument("--scan-format", dest="scan_format", choices=("jsonl", "csv"),
+                        default="jsonl",
+                        help=("format of the --scan report, with the fields " +
+                              "path, has_gps, lat and lon (signed decimal " +
+                              "degrees, north and east positive). Default " +
+                              "is \"%(default)s\"."))
+
+    parser.add_argument("--plan", dest="plan", metavar="FILE",
+                        help=("do not write the files, but record which file " +
+                              "gets which GPS information in FILE, to be " +
+                              "written with --apply."))
+
+    parser.add_argument("--apply", dest="apply", metavar="FILE",
+                        help=("write the files recorded in FILE by --plan. " +
+                              "Written files are journaled next to FILE, so " +
+                              "running it again resumes an interrupted run."))
+
+    parser.add_argument("--range", dest="range", metavar="START:END",
+                        help=("with --apply, only write the files numbered " +
+                              "START up to END (exclusive) of the plan, e.g. " +
+                              "to split it between machines. Files are " +
+                              "numbered from 0, either end may be omitted."))
+
+    parser.add_argument("--files-from", dest="files_from", metavar="FILE",
+                        help=("also process the files named in FILE (\"-\" " +
+                              "for stdin), one per line. They are processed " +
+                              "as they are read, so there is no limit to " +
+                              "their number."))
+
+    parser.add_argument("--null", dest="null", action="store_true",
+                        help=("(or -0) with --files-from, the names end with a NUL " +
+                              "character instead of a newline, as written " +
+                              "by \"find -print0\"."))
+
+    parser.add_argument("-R", "--recursive", dest="recursive", action="store_true",
+                        help="process the files in directories and their subdirectories.")
+
+    parser.add_argument("--include", dest="include", action="append", default=[],
+                        metavar="PATTERN",
+                        help=("with --recursive, only process files matching " +
+                              "this glob pattern. This argument may be given " +
+                              "multiple times."))
+
+    parser.add_argument("--exclude", dest="exclude", action="append", default=[],
+                        metavar="PATTERN",
+                        help=("with --recursive, skip files and directories " +
+                              "matching this glob pattern. This argument may " +
+                              "be given multiple times."))
+
+    parser.add_argument("--ext", dest="extensions", action="append", default=[],
+                        metavar="EXT[,EXT]",
+                        help=("with --recursive, only process files with these " +
+                              "extensions, e.g. \"jpg,cr2\". This argument " +
+                              "may be given multiple times."))
+
+    parser.add_argument("--follow-symlinks", dest="follow_symlinks", action="store_true",
+                        help="with --recursive, follow symbolic links.")
+
+    parser.add_argument("--daemon", dest="daemon", action="store_true",
+                        help=("keep running, with aliases loaded and exiftool " +
+                              "started, and tag the files addgps_client.py " +
+                              "sends over a Unix socket."))
+
+    parser.add_argument("--socket", dest="socket", metavar="PATH",
+                        help=("with --daemon, the socket to listen on. Default " +
+                              "is $ADDGPS_SOCKET, or addgps.sock in " +
+                              "$XDG_RUNTIME_DIR."))
+
+    parser.add_argument("--stats", dest="stats", action="store_true",
+                        help=("print how much time each stage took, with " +
+                              "counts of files and bytes, when done; log " +
+                              "progress every {:.0f} seconds.".format(PROGRESS_INTERVAL)))
+
+    parser.add_argument("--stats-json", dest="stats_json", metavar="FILE",
+                        help=("write the statistics of --stats as JSON to " +
+                              "FILE (\"-\" for stdout)."))
+
+    parser.add_argument("--profile", dest="profile", metavar="FILE",
+                        help=("profile the run with cProfile and write the " +
+                              "profile to FILE, for pstats or snakeviz."))
+
     parser.add_argument("--version", action="version",
                         version="%(prog)s " + PROG_VERSION_NUMBER)
     #version="%(prog) " + PROG_VERSION_NUMBER)
 
-    parser.add_argument("filelist", nargs="+")
+    parser.add_argument("filelist", nargs="*")
 
-    args = parser.parse_args(arglist)
+    args = parser.parse_args(null_option(arglist))
+
+    if (not args.filelist and not args.files_from and not args.mapping and not args.apply and
+            not args.daemon):
+        parser.error("please name the files to process")
+
+    if args.null and not args.files_from:
+        parser.error("-0 only works with --files-from")
+
+    if args.files_from and (args.mapping or args.apply or args.daemon):
+        parser.error("--mapping, --apply and --daemon take no --files-from")
+
+    if args.files_from == "-" and not (args.gpx or args.track_index or args.plan or
+                                       args.scan or args.action == "remove"):
+        parser.error("with --files-from -, stdin cannot be asked for the coordinates; " +
+                     "use --files-from FILE")
+
+    if args.files_from == "-" and args.action == "remove" and args.confirm:
+        parser.error("with --files-from -, stdin cannot be asked for confirmation")
+
+    if args.daemon and (args.filelist or args.mapping or args.gpx or args.track_index or
+                        args.plan or args.apply or args.pipeline):
+        parser.error("--daemon takes the files to process from addgps_client.py only")
+
+    if args.scan and (args.mapping or args.gpx or args.track_index or args.plan or args.apply or
+                      args.daemon or args.pipeline or args.action == "remove"):
+        parser.error("--scan only reads the files it is given")
+
+    if args.track_store and not args.track_index:
+        parser.error("--track-store only works with --track-index")
+
+    if args.track_index and (args.gpx or args.mapping or args.action == "remove"):
+        parser.error("--track-index takes the place of --gpx and --mapping when adding")
+
+    if args.socket and not args.daemon:
+        parser.error("--socket only works with --daemon")
+
+    if args.apply and (args.filelist or args.mapping or args.gpx or args.track_index or
+                       args.plan or args.action == "remove"):
+        parser.error("--apply takes the files and their GPS information from the plan only")
+
+    if args.range is not None and not args.apply:
+        parser.error("--range only works with --apply")
+
+    if args.mapping and args.action == "remove":
+        parser.error("--mapping only works for adding GPS information")
 
     if args.verbose and args.quiet:
         parser.error("please use either verbose (--verbose) or quiet (-q) option")
 
+    if args.jobs < 1:
+        parser.error("please use at least one job (--jobs)")
+
+    if args.pipeline and sys.version_info[0] < 3:
+        parser.error("--pipeline needs Python 3")
+
+    if args.pipeline and (args.gpx or args.track_index or args.manifest):
+        parser.error("--pipeline does not work with --gpx, --track-index or --manifest")
+
+    if args.pipeline and (args.plan or args.apply):
+        parser.error("--pipeline does not work with --plan or --apply")
+
+    if args.fsync_every is not None and args.fsync_every < 1:
+        parser.error("please flush at least every file (--fsync-every)")
+
+    if args.fsync_every and args.pipeline:
+        parser.error("--fsync-every does not work with --pipeline")
+
+    if args.verify_hash and not args.verify:
+        parser.error("--verify-hash only works with --verify")
+
+    if args.verify and (args.plan or args.scan or args.daemon):
+        parser.error("--verify does not work with --plan, --scan or --daemon")
+
+    if (args.gazetteer or args.geocode_radius != GEOCODE_RADIUS) and not args.geocode:
+        parser.error("--gazetteer and --geocode-radius only work with --geocode")
+
+    if args.geocode and (args.action == "remove" or args.apply or args.daemon):
+        parser.error("--geocode only works when adding GPS information; " +
+                     "a plan holds the places already")
+
+    if args.within and args.action != "remove":
+        parser.error("--within only works with --remove")
+
+    if args.within and (args.pipeline or args.daemon):
+        parser.error("--within does not work with --pipeline or --daemon")
+
+    if args.sidecar_extensions and not args.sidecar:
+        parser.error("--sidecar-ext only works with --sidecar")
+
+    if args.sidecar and args.manifest:
+        parser.error("--manifest does not work with --sidecar")
+
+    if args.plan and args.manifest:
+        parser.error("--manifest only works when writing, use it with --apply")
+
+    if args.snap is not None and args.snap <= 0:
+        parser.error("please use a positive distance with --snap")
+
+    try:
+        parse_time_offset(args.time_offset)
+        parse_range(args.range or ":")
+        if args.apply:
+            Plan(args.apply).close()
+        if args.track_index:
+            TrackStore(args.track_store or track_store_path())
+        if args.geocode:
+            Gazetteer(gazetteer_path(args)).close()
+        if args.within:
+            geofences(args)
+    except (ValueError, IOError, OSError, NativeWriterError) as exception:
+        parser.error(str(exception))
+
     return args
 
+def null_option(arglist):
+    """
+    Translate -0 to --null. Declared as such, an option which looks
+    like a negative number would make argparse take values like
+    "--time-offset -8" for options.
+    """
+    translated = []
+    options = True
+    for argument in arglist:
+        if argument == "--":
+            options = False
+        if options and argument == "-0" and translated[-1:] != ["--time-offset"]:
+            argument = "--null"
+        translated.append(argument)
+    return translated
+
+if QueueHandler is not None:
+    class LogQueueHandler(QueueHandler):
+        """
+        Hand log records to the thread of a QueueListener as they are,
+        so that formatting them, like writing them, happens off the
+        thread which logs.
+        """
+        def prepare(self, record):
+            return record
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as JSON lines, with the fields of their event, see FileEvents"""
+    def format(self, record):
+        entry = OrderedDict([("time", round(record.created, 6)),
+                             ("level", record.levelname.lower()),
+                             ("message", record.getMessage())])
+        entry.update(getattr(record, "event", None) or {})
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+# Writes the log records queued by LogQueueHandler, see initialize_logging
+m_log_listener = None
+
 def initialize_logging(args):
     """Log handling and configuration"""
 
+    stop_logging()
     logger = logging.getLogger(LOGGER_NAME)
+    jsonl = getattr(args, "log_format", None) == "jsonl"
 
     # create console handler and set level to debug
     if args.logfile:
@@ -260,20 +1227,31 @@ def initialize_logging(args):
         logger.setLevel(logging.INFO)
 
     # create formatter
-    formatter = logging.Formatter(log_format)
+    formatter = JsonFormatter() if jsonl else logging.Formatter(log_format)
 
     # add formatter to handler
     handler.setFormatter(formatter)
-
-    # add console_handler to logger
-    logger.addHandler(handler)
+    handlers = [handler]
 
     # Make sure warning and error messages always go to console
     if args.logfile:
         console_handler = logging.StreamHandler()
         console_handler.setLevel(logging.WARNING)
-        console_handler.setFormatter(logging.Formatter("%(levelname)-8s %(message)s"))
-        logger.addHandler(console_handler)
+        console_handler.setFormatter(JsonFormatter() if jsonl else
+                                     logging.Formatter("%(levelname)-8s %(message)s"))
+        handlers.append(console_handler)
+
+    # Where the standard library has it, log through a queue, so that
+    # logging a line costs the caller next to nothing
+    global m_log_listener      #pylint: disable=global-statement,invalid-name
+    if QueueHandler is not None:
+        records = queue.Queue()
+        m_log_listener = QueueListener(records, *handlers, respect_handler_level=True)
+        m_log_listener.start()
+        logger.addHandler(LogQueueHandler(records))
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
 
     ## omit double output (default handler and my own handler):
     logger.propagate = False
@@ -287,6 +1265,23 @@ def initialize_logging(args):
 
     logger.debug("logging initialized")
 
+def stop_logging():
+    """
+    Write out the log records still queued, and log directly from now
+    on, e.g. when main is done
+    """
+    global m_log_listener      #pylint: disable=global-statement,invalid-name
+    listener, m_log_listener = m_log_listener, None
+    if listener is None:
+        return
+    listener.stop()
+    logger = logging.getLogger(LOGGER_NAME)
+    for handler in list(logger.handlers):
+        if isinstance(handler, LogQueueHandler) and handler.queue is listener.queue:
+            logger.removeHandler(handler)
+            for target in listener.handlers:
+                logger.addHandler(target)
+
 
 def error_exit(errorcode, text):
     """exits with return value of errorcode and prints to stderr"""
@@ -326,77 +1321,3008 @@ def bad_filename(filename, dryrun):
     if dryrun:
         assert dryrun.__class__ == bool
 
-    if os.path.isdir(filename):
-        m_logger.warning(
-            "Skipping directory \"%s\" because this tool only renames proceses file names.",
-            filename)
-        return True
-    elif not os.path.isfile(filename):
-        m_logger.error(
-            "Skipping \"%s\" because this tool only processes existing file names.",
-            filename)
-        return True
+    with m_stats.timer("validate"):
+        if os.path.isdir(filename):
+            m_logger.warning(
+                "Skipping directory \"%s\" because this tool only processes file names " +
+                "(see --recursive).", filename)
+            return True
+        elif not os.path.isfile(filename):
+            m_logger.error(
+                "Skipping \"%s\" because this tool only processes existing file names.",
+                filename)
+            return True
 
     return False
 
 
-def add_gps_to_file(filename, lat, lon, alt, dryrun):
+def directory_entries(path, follow_symlinks):
     """
-    @param filename: string containing one file name
-    @param lat: Latitude, in exiftool-acceptable format
-    @param lon: Longitude, in exiftool-acceptable format
-    @param alt: Altitude, in exiftool-acceptable format
-    @param dryrun: boolean which defines if files should be changed (False) or not (True)
-    @param return: error value
+    @param path: name of a directory
+    @param follow_symlinks: boolean, look through symbolic links
+    @param return: sorted list of (name, path, is directory, os.stat result or None)
     """
+    entries = []
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                is_dir = entry.is_dir(follow_symlinks=follow_symlinks)
+                status = None if is_dir else entry.stat(follow_symlinks=follow_symlinks)
+            except OSError:
+                continue
+            entries.append((entry.name, entry.path, is_dir, status))
+    else:
+        for name in os.listdir(path):
+            child = os.path.join(path, name)
+            try:
+                status = os.stat(child) if follow_symlinks else os.lstat(child)
+            except OSError:
+                continue
+            is_dir = stat.S_ISDIR(status.st_mode)
+            entries.append((name, child, is_dir, None if is_dir else status))
+    entries.sort()
+    return entries
 
-    if bad_filename(filename, dryrun):
-        return
-#    import pdb; pdb.set_trace()
+def selected(name, path, include, exclude, extensions):
+    """Tell if a file passes the --include, --exclude and --ext filters"""
+    if extensions and os.path.splitext(name)[1].lower() not in extensions:
+        return False
+    if include and not any(fnmatch(name, p) or fnmatch(path, p) for p in include):
+        return False
+    return not any(fnmatch(name, p) or fnmatch(path, p) for p in exclude)
 
-    cmdlist = ["exiftool",]
-    cmdlist.extend(lat.arguments())
-    cmdlist.extend(lon.arguments())
-    cmdlist.extend(alt.arguments())
-    cmdlist.append(filename)
+def walk_files(paths, recursive=False, include=(), exclude=(), extensions=(),     #pylint: disable=too-many-arguments,too-many-locals
+               follow_symlinks=False, unique_paths=False):
+    """
+    Lazily expand a list of paths into the files to process.
 
-    m_logger.info(" ")
-    m_logger.info("Processing command \"%s\"", cmdlist)
+    Directories are walked depth first, in name order, when recursive
+    is set; files are produced as they are found, so work on them can
+    start before the walk is done. Every inode is produced once only,
+    so hard links are not processed twice, and directories already
+    visited are not entered again, which stops symbolic link loops.
 
-    if not dryrun:
-        retcode = subprocess.call(cmdlist, stdout=subprocess.PIPE)
-    else:
-        retcode = 0
+    @param paths: iterable of file and directory names
+    @param recursive: boolean, walk directories
+    @param include: list of glob patterns; if given, files must match one
+    @param exclude: list of glob patterns files and directories must not match
+    @param extensions: list of lower case file extensions, like ".jpg"
+    @param follow_symlinks: boolean, follow symbolic links to directories and files
+    @param unique_paths: boolean, paths name distinct files, like the output of
+                         find; files among them are produced without remembering
+                         their inode, so memory does not grow with their number
+    @param return: generator of file names
+    """
+    seen = set()
+    visited = set()
+    for path in paths:
+        if not (recursive and os.path.isdir(path)):
+            if unique_paths:
+                yield path
+                continue
+            try:
+                status = os.stat(path)
+            except OSError:
+                yield path   # let bad_filename complain
+                continue
+            if stat.S_ISREG(status.st_mode):
+                if (status.st_dev, status.st_ino) in seen:
+                    continue
+                seen.add((status.st_dev, status.st_ino))
+            yield path
+            continue
 
-    return retcode
+        stack = [path]
+        while stack:
+            directory = stack.pop()
+            try:
+                status = os.stat(directory)
+                if (status.st_dev, status.st_ino) in visited:
+                    m_logger.debug("Not entering \"%s\" again", directory)
+                    continue
+                visited.add((status.st_dev, status.st_ino))
+                entries = directory_entries(directory, follow_symlinks)
+            except OSError as exception:
+                m_logger.warning("Cannot read directory \"%s\": %s", directory, exception)
+                continue
+
+            subdirectories = []
+            for name, child, is_dir, status in entries:
+                if is_dir:
+                    if not any(fnmatch(name, p) or fnmatch(child, p) for p in exclude):
+                        subdirectories.append(child)
+                elif (stat.S_ISREG(status.st_mode) and
+                      selected(name, child, include, exclude, extensions) and
+                      (status.st_dev, status.st_ino) not in seen):
+                    seen.add((status.st_dev, status.st_ino))
+                    yield child
+            stack.extend(reversed(subdirectories))
 
-def remove_gps_from_file(filename, dryrun):
+def parse_extensions(values):
     """
-    @param filename: string containing one file name
-    @param dryrun: boolean which defines if files should be changed (False) or not (True)
-    @param return: error value
+    @param values: list of "EXT[,EXT]" as given to --ext
+    @param return: set of lower case extensions, like ".jpg"
     """
-    m_logger.debug("Removing gps info from \"%s\"", filename)
-    cmd = ["exiftool",
-           "-GPS*=",
-           filename]
+    extensions = set()
+    for extension in values:
+        for part in extension.split(","):
+            part = part.strip().lower()
+            if part:
+                extensions.add(part if part.startswith(".") or part == "*" else "." + part)
+    return extensions
 
-    m_logger.info(" ")
-    m_logger.info("Processing command \"%s\"", cmd)
+def read_names(stream, separator=b"\n"):
+    """
+    Split a stream into file names as its data arrives, without waiting
+    for a full buffer, so work on the first files starts while the
+    producer is still listing more.
 
-    if not dryrun:
-        retcode = subprocess.call(cmd, stdout=subprocess.PIPE)
-    else:
+    @param stream: binary file object
+    @param separator: b"\n", or b"\0" for -0
+    @param return: generator of file names
+    """
+    decode = getattr(os, "fsdecode", lambda name: name)
+    descriptor = stream.fileno()
+    pending = b""
+    while True:
+        data = os.read(descriptor, 65536)
+        if not data:
+            break
+        names = (pending + data).split(separator)
+        pending = names.pop()
+        for name in names:
+            if separator == b"\n":
+                name = name.rstrip(b"\r")
+            if name:
+                yield decode(name)
+    if pending.rstrip(b"\r\n"):
+        yield decode(pending.rstrip(b"\r\n") if separator == b"\n" else pending)
+
+def listed_files(name, null=False):
+    """Return the file names listed in a file, "-" being stdin, as a generator"""
+    if name == "-":
+        for filename in read_names(getattr(sys.stdin, "buffer", sys.stdin),
+                                   b"\0" if null else b"\n"):
+            yield filename
+        return
+    with open(name, "rb") as stream:
+        for filename in read_names(stream, b"\0" if null else b"\n"):
+            yield filename
+
+def expand_files(args):
+    """Return the files to process according to the command line, as a generator"""
+    extensions = parse_extensions(args.extensions)
+    files = walk_files(args.filelist, args.recursive, args.include, args.exclude,
+                       extensions, args.follow_symlinks)
+    if args.files_from:
+        files = chain(files, walk_files(listed_files(args.files_from, args.null),
+                                        args.recursive, args.include, args.exclude,
+                                        extensions, args.follow_symlinks, unique_paths=True))
+    return files
+
+class NativeWriterError(Exception):
+    """Raised when a file cannot be handled by the native writer"""
+    pass
+
+# TIFF field types and their sizes in bytes
+TIFF_TYPE_SIZES = {1: 1, 2: 1, 3: 2, 4: 4, 5: 8, 6: 1, 7: 1, 8: 2, 9: 4, 10: 8, 11: 4, 12: 8}
+TIFF_BYTE, TIFF_ASCII, TIFF_LONG, TIFF_RATIONAL = 1, 2, 4, 5
+GPS_IFD_POINTER = 0x8825
+EXIF_HEADER = b"Exif\x00\x00"
+JPEG_EXTENSIONS = (".jpg", ".jpeg", ".jpe")
+
+TiffEntry = namedtuple('TiffEntry', ['tag', 'type', 'count', 'raw', 'data_offset'])
+
+def jpeg_segments(data):
+    """
+    @param data: bytes or mmap of a JPEG file
+    @param return: generator of (marker, start, end) of the segments before the image data
+    """
+    if data[0:2] != b"\xff\xd8":
+        raise NativeWriterError("Not a JPEG file")
+    pos = 2
+    while True:
+        if data[pos:pos + 1] != b"\xff":
+            raise NativeWriterError("Bad JPEG marker at {}".format(pos))
+        while data[pos + 1:pos + 2] == b"\xff":
+            pos += 1   # fill bytes
+        marker = ord(data[pos + 1:pos + 2] or b"\xd9")
+        if marker in (0xda, 0xd9):
+            return
+        if 0xd0 <= marker <= 0xd7 or marker == 0x01:
+            pos += 2
+            continue
+        length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+        if length < 2 or pos + 2 + length > len(data):
+            raise NativeWriterError("Truncated JPEG segment at {}".format(pos))
+        yield marker, pos, pos + 2 + length
+        pos += 2 + length
+
+def tiff_byte_order(tiff):
+    """Return the struct byte order character of a TIFF header"""
+    endian = {b"II": "<", b"MM": ">"}.get(bytes(tiff[0:2]))
+    if endian is None or struct.unpack(endian + "H", bytes(tiff[2:4]))[0] != 42:
+        raise NativeWriterError("Bad TIFF header")
+    return endian
+
+def read_ifd(tiff, offset, endian):
+    """
+    @param tiff: TIFF data, offsets are relative to its start
+    @param offset: offset of the IFD
+    @param endian: struct byte order character
+    @param return: (list of TiffEntry, offset of the next IFD)
+    """
+    if offset < 8 or offset + 2 > len(tiff):
+        raise NativeWriterError("Bad IFD offset {}".format(offset))
+    count = struct.unpack(endian + "H", bytes(tiff[offset:offset + 2]))[0]
+    end = offset + 2 + 12 * count
+    if end + 4 > len(tiff):
+        raise NativeWriterError("Truncated IFD at {}".format(offset))
+    entries = []
+    for pos in range(offset + 2, end, 12):
+        raw = bytes(tiff[pos:pos + 12])
+        tag, kind, number = struct.unpack(endian + "HHI", raw[:8])
+        size = TIFF_TYPE_SIZES.get(kind, 1) * number
+        data_offset = struct.unpack(endian + "I", raw[8:])[0] if size > 4 else None
+        entries.append(TiffEntry(tag, kind, number, raw, data_offset))
+    return entries, struct.unpack(endian + "I", bytes(tiff[end:end + 4]))[0]
+
+def ifd_extent(tiff, offset, endian):
+    """
+    @param return: (offset just behind the IFD and the values it points
+                   to, number of bytes the IFD and its values occupy)
+    """
+    entries, _ = read_ifd(tiff, offset, endian)
+    extent = offset + 2 + 12 * len(entries) + 4
+    used = extent - offset
+    for entry in entries:
+        if entry.data_offset is not None:
+            size = TIFF_TYPE_SIZES.get(entry.type, 1) * entry.count
+            extent = max(extent, entry.data_offset + size)
+            used += size + size % 2
+    return extent, used
+
+def entry_value(tiff, entry, endian):
+    """Decode the value of a TiffEntry"""
+    if entry.data_offset is None:
+        data = entry.raw[8:]
+    else:
+        size = TIFF_TYPE_SIZES.get(entry.type, 1) * entry.count
+        data = bytes(tiff[entry.data_offset:entry.data_offset + size])
+    if entry.type == TIFF_ASCII:
+        return data[:entry.count].split(b"\x00")[0].decode("latin-1")
+    if entry.type in (TIFF_RATIONAL, 10):
+        kind = "I" if entry.type == TIFF_RATIONAL else "i"
+        numbers = struct.unpack(endian + kind * (2 * entry.count), data[:8 * entry.count])
+        return [float(n) / d if d else 0.0 for n, d in zip(numbers[0::2], numbers[1::2])]
+    kind = {1: "B", 3: "H", 4: "I", 6: "b", 7: "B", 8: "h", 9: "i", 11: "f", 12: "d"}[entry.type]
+    return list(struct.unpack(endian + kind * entry.count,
+                              data[:TIFF_TYPE_SIZES[entry.type] * entry.count]))
+
+def build_ifd(entries, endian, offset):
+    """
+    @param entries: list of (tag, type, count, value bytes)
+    @param endian: struct byte order character
+    @param offset: offset the IFD will have in the TIFF data
+    @param return: bytes of the IFD, followed by its out-of-line values
+    """
+    entries = sorted(entries)
+    data_offset = offset + 2 + 12 * len(entries) + 4
+    table = [struct.pack(endian + "H", len(entries))]
+    values = []
+    for tag, kind, count, value in entries:
+        if len(value) <= 4:
+            table.append(struct.pack(endian + "HHI", tag, kind, count) + value.ljust(4, b"\x00"))
+        else:
+            table.append(struct.pack(endian + "HHII", tag, kind, count, data_offset))
+            values.append(value)
+            data_offset += len(value)
+    table.append(struct.pack(endian + "I", 0))
+    return b"".join(table + values)
+
+def rationals(values, endian, denominator):
+    """
+    Pack floats as TIFF RATIONALs with a fixed denominator, divided
+    by 10 as often as it takes for large values to fit
+    """
+    packed = []
+    for value in values:
+        scale = denominator
+        while scale > 1 and round(value * scale) > 0xFFFFFFFF:
+            scale //= 10
+        packed.append(struct.pack(endian + "II", int(round(value * scale)), scale))
+    return b"".join(packed)
+
+def degrees_minutes_seconds(value):
+    """Split decimal degrees into degrees, minutes and seconds"""
+    seconds = round(abs(value) * 3600, 4)
+    degrees = int(seconds // 3600)
+    minutes = int(seconds % 3600 // 60)
+    return [degrees, minutes, seconds - degrees * 3600 - minutes * 60]
+
+def native_gps_tags(arguments):
+    """
+    @param arguments: list of exiftool arguments
+    @param return: dictionary of the GPS tags they write, or None if
+                   the native writer cannot do what they ask for
+    """
+    tags = argument_tags(arguments)
+    if tags is None or not set(tags) <= set(("GPSLatitude", "GPSLatitudeRef",
+                                             "GPSLongitude", "GPSLongitudeRef",
+                                             "GPSAltitude", "GPSAltitudeRef")):
+        return None
+    if not all(name in tags for name in ("GPSLatitude", "GPSLatitudeRef",
+                                         "GPSLongitude", "GPSLongitudeRef")):
+        return None
+    return tags
+
+def gps_ifd_entries(tags, endian):
+    """
+    @param tags: dictionary as returned by native_gps_tags
+    @param endian: struct byte order character
+    @param return: list of GPS IFD entries for build_ifd
+    """
+    try:
+        latitude = float(tags["GPSLatitude"])
+        longitude = float(tags["GPSLongitude"])
+        altitude = float(tags["GPSAltitude"]) if "GPSAltitude" in tags else None
+    except ValueError as exception:
+        raise NativeWriterError("Bad GPS value: {}".format(exception))
+
+    entries = [
+        (0, TIFF_BYTE, 4, b"\x02\x03\x00\x00"),   # GPSVersionID
+        (1, TIFF_ASCII, 2, tags["GPSLatitudeRef"][:1].encode("ascii") + b"\x00"),
+        (2, TIFF_RATIONAL, 3, rationals(degrees_minutes_seconds(latitude), endian, 10000)),
+        (3, TIFF_ASCII, 2, tags["GPSLongitudeRef"][:1].encode("ascii") + b"\x00"),
+        (4, TIFF_RATIONAL, 3, rationals(degrees_minutes_seconds(longitude), endian, 10000)),
+        ]
+    if altitude is not None:
+        below = tags.get("GPSAltitudeRef", "").startswith("Below") or altitude < 0
+        entries.append((5, TIFF_BYTE, 1, b"\x01" if below else b"\x00"))
+        entries.append((6, TIFF_RATIONAL, 1, rationals([abs(altitude)], endian, 1000)))
+    return entries
+
+def tiff_with_gps(tiff, tags):
+    """
+    Return a copy of TIFF data whose IFD0 points to a new GPS IFD.
+    Nothing in the data is moved: an old GPS IFD at the very end is
+    dropped, IFD0 is copied to the end if it needs a new entry, and
+    the GPS IFD is appended.
+    """
+    endian = tiff_byte_order(tiff)
+    tiff = bytearray(tiff)
+    ifd0 = struct.unpack(endian + "I", bytes(tiff[4:8]))[0]
+    entries, next_ifd = read_ifd(tiff, ifd0, endian)
+    pointers = [index for index, entry in enumerate(entries) if entry.tag == GPS_IFD_POINTER]
+
+    if pointers:
+        old_gps = struct.unpack(endian + "I", entries[pointers[0]].raw[8:])[0]
+        try:
+            extent, used = ifd_extent(tiff, old_gps, endian)
+            # Only drop it if nothing else lives in between
+            if old_gps > ifd0 and extent >= len(tiff) and extent - old_gps <= used:
+                del tiff[old_gps:]
+        except NativeWriterError:
+            pass   # broken old GPS IFD, leave it alone
+    if len(tiff) % 2:
+        tiff.append(0)
+
+    if pointers:
+        gps = len(tiff)
+        pos = ifd0 + 2 + 12 * pointers[0]
+        tiff[pos:pos + 12] = struct.pack(endian + "HHII", GPS_IFD_POINTER, TIFF_LONG, 1, gps)
+    else:
+        new_ifd0 = len(tiff)
+        raws = [entry.raw for entry in entries]
+        raws.append(struct.pack(endian + "HHII", GPS_IFD_POINTER, TIFF_LONG, 1, 0))
+        raws.sort(key=lambda raw: struct.unpack(endian + "H", raw[:2])[0])
+        gps = new_ifd0 + 2 + 12 * len(raws) + 4
+        raws[[struct.unpack(endian + "H", raw[:2])[0] for raw in raws].index(GPS_IFD_POINTER)] = \
+            struct.pack(endian + "HHII", GPS_IFD_POINTER, TIFF_LONG, 1, gps)
+        tiff.extend(struct.pack(endian + "H", len(raws)) + b"".join(raws) +
+                    struct.pack(endian + "I", next_ifd))
+        tiff[4:8] = struct.pack(endian + "I", new_ifd0)
+
+    tiff.extend(build_ifd(gps_ifd_entries(tags, endian), endian, gps))
+    return bytes(tiff)
+
+def empty_tiff():
+    """Return TIFF data with an empty IFD0, in exiftool's default byte order"""
+    return b"MM\x00\x2a" + struct.pack(">IHI", 8, 0, 0)
+
+def find_exif_segment(data):
+    """
+    @param data: bytes or mmap of a JPEG file
+    @param return: (start, end, tiff) of the EXIF APP1 segment; if there
+                   is none, start == end is where one should be inserted
+                   and tiff is None
+    """
+    insert_at = 2
+    for marker, start, end in jpeg_segments(data):
+        if marker == 0xe1 and data[start + 4:start + 10] == EXIF_HEADER:
+            return start, end, data[start + 10:end]
+        if marker == 0xe0 and insert_at == start:
+            insert_at = end   # keep JFIF first
+    return insert_at, insert_at, None
+
+def replace_file_range(filename, start, end, replacement, in_place=False, atomic=False):     #pylint: disable=too-many-arguments
+    """
+    Replace bytes start to end of a file. Same-sized replacements are
+    patched in place, otherwise the file is copied to a temporary file
+    which then replaces the original. With in_place, the original file
+    is rewritten instead, from the temporary copy of what follows end.
+    With atomic, the file is always replaced by the temporary file, so
+    that a crash leaves either the old or the new file.
+    """
+    if end - start == len(replacement) and not atomic:
+        m_stats.count("bytes_written", len(replacement))
+        with open(filename, "r+b") as f:
+            data = mmap.mmap(f.fileno(), 0)
+            try:
+                data[start:end] = replacement
+                data.flush()
+            finally:
+                data.close()
+        return
+
+    handle, tmpname = tempfile.mkstemp(prefix=".addgps-",
+                                       dir=os.path.dirname(os.path.abspath(filename)))
+    if in_place:
+        try:
+            with os.fdopen(handle, "w+b") as tail:
+                with open(filename, "r+b") as f:
+                    f.seek(end)
+                    shutil.copyfileobj(f, tail, 1 << 20)
+                    tail.seek(0)
+                    f.seek(start)
+                    f.write(replacement)
+                    shutil.copyfileobj(tail, f, 1 << 20)
+                    f.truncate()
+                    if m_stats.enabled:
+                        m_stats.count("bytes_read", f.tell() - len(replacement) + end)
+                        m_stats.count("bytes_written", 2 * tail.tell() + len(replacement))
+        finally:
+            os.remove(tmpname)
+        return
+
+    try:
+        with os.fdopen(handle, "wb") as out:
+            with open(filename, "rb") as source:
+                out.write(source.read(start))
+                out.write(replacement)
+                source.seek(end)
+                shutil.copyfileobj(source, out, 1 << 20)
+                if m_stats.enabled:
+                    m_stats.count("bytes_read", source.tell())
+                    m_stats.count("bytes_written", out.tell())
+        shutil.copymode(filename, tmpname)
+        os.rename(tmpname, filename)
+    finally:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+def write_gps_native(filename, arguments, dryrun=False):
+    """
+    Write GPS tags to a JPEG file without exiftool.
+
+    @param filename: string containing one file name
+    @param arguments: list of exiftool arguments describing the GPS tags
+    @param dryrun: boolean which defines if files should be changed (False) or not (True)
+    @param return: False if the native writer does not handle this
+                   kind of file or these arguments
+    """
+    if os.path.splitext(filename)[1].lower() not in JPEG_EXTENSIONS:
+        return False
+    tags = native_gps_tags(arguments)
+    if tags is None:
+        return False
+
+    with m_stats.timer("native"):
+        with open(filename, "rb") as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise NativeWriterError("Empty file")
+            try:
+                start, end, tiff = find_exif_segment(data)
+            finally:
+                data.close()
+        m_stats.count("bytes_read", end)
+
+        tiff = tiff_with_gps(tiff if tiff is not None else empty_tiff(), tags)
+        if len(tiff) + 8 > 0xffff:
+            raise NativeWriterError("EXIF segment too large")
+        segment = b"\xff\xe1" + struct.pack(">H", len(tiff) + 8) + EXIF_HEADER + tiff
+
+        if not dryrun:
+            strategy = strategy_of(arguments)
+            if strategy == "backup":
+                keep_backup(filename)
+            replace_file_range(filename, start, end, segment, strategy == "in-place",
+                               strategy == "overwrite")
+    return True
+
+def keep_backup(filename):
+    """Keep a copy of the original file, unless there is one already, as exiftool does"""
+    backup = filename + "_original"
+    if not os.path.exists(backup):
+        shutil.copy2(filename, backup)
+        size = os.path.getsize(backup)
+        m_stats.count("bytes_written", size)
+        m_stats.count("backup_bytes", size)
+
+def native_job(filename, arguments, dryrun):
+    """
+    @param return: FileResult of writing the file natively, or None
+                   if exiftool has to do it
+    """
+    try:
+        if write_gps_native(filename, arguments, dryrun):
+            return FileResult(filename, 0, "")
+    except (NativeWriterError, struct.error) as exception:
+        m_logger.debug("Using exiftool for \"%s\": %s", filename, exception)
+    except (IOError, OSError) as exception:
+        return FileResult(filename, 1, str(exception))
+    return None
+
+# Files --sidecar writes XMP sidecars for, unless --sidecar-ext says
+# otherwise: camera RAW formats and videos
+SIDECAR_EXTENSIONS = (".3fr", ".arw", ".cr2", ".cr3", ".crw", ".dcr", ".erf", ".iiq", ".kdc",
+                      ".mef", ".mos", ".mrw", ".nef", ".nrw", ".orf", ".pef", ".raf", ".raw",
+                      ".rw2", ".rwl", ".sr2", ".srf", ".srw", ".x3f",
+                      ".3gp", ".avi", ".m2ts", ".m4v", ".mkv", ".mov", ".mp4", ".mts")
+# Prefixes of the namespaces of sidecars, kept when rewriting them
+XMP_NAMESPACES = OrderedDict([
+    ("x", "adobe:ns:meta/"),
+    ("rdf", "http://www.w3.org/1999/02/22-rdf-syntax-ns#"),
+    ("exif", "http://ns.adobe.com/exif/1.0/"),
+    ("aux", "http://ns.adobe.com/exif/1.0/aux/"),
+    ("tiff", "http://ns.adobe.com/tiff/1.0/"),
+    ("xmp", "http://ns.adobe.com/xap/1.0/"),
+    ("xmpMM", "http://ns.adobe.com/xap/1.0/mm/"),
+    ("dc", "http://purl.org/dc/elements/1.1/"),
+    ("photoshop", "http://ns.adobe.com/photoshop/1.0/"),
+    ("crs", "http://ns.adobe.com/camera-raw-settings/1.0/"),
+    ("lr", "http://ns.adobe.com/lightroom/1.0/"),
+    ("darktable", "http://darktable.sf.net/"),
+    ])
+XMP_PACKET = (b'<?xpacket begin="\xef\xbb\xbf" id="W5M0MpCehiHzreSzNTczkc9d"?>\n',
+              b'\n<?xpacket end="w"?>\n')
+EMPTY_XMP = ('<x:xmpmeta xmlns:x="adobe:ns:meta/"><rdf:RDF xmlns:rdf="{}">' +
+             '<rdf:Description rdf:about=""/></rdf:RDF></x:xmpmeta>').format(XMP_NAMESPACES["rdf"])
+
+def sidecar_name(filename):
+    """Return the XMP sidecar of a file, e.g. "IMG_0001.xmp" for "IMG_0001.CR2" """
+    return os.path.splitext(filename)[0] + ".xmp"
+
+def sidecar_extensions(args):
+    """Return the extensions of the files to write sidecars for, as --sidecar asks for"""
+    if not args.sidecar:
+        return frozenset()
+    return frozenset(parse_extensions(args.sidecar_extensions) or SIDECAR_EXTENSIONS)
+
+def wants_sidecar(filename, extensions):
+    """Tell if a file gets an XMP sidecar, see sidecar_extensions"""
+    return bool(extensions) and ("*" in extensions or
+                                 os.path.splitext(filename)[1].lower() in extensions)
+
+def xmp_gps_properties(tags):
+    """
+    @param tags: dictionary as returned by native_gps_tags
+    @param return: list of (exif property, value) as XMP writes the GPS tags
+    """
+    try:
+        latitude = float(tags["GPSLatitude"])
+        longitude = float(tags["GPSLongitude"])
+        altitude = float(tags["GPSAltitude"]) if "GPSAltitude" in tags else None
+    except ValueError as exception:
+        raise NativeWriterError("Bad GPS value: {}".format(exception))
+
+    def coordinate(value, ref):
+        """XMP's "DDD,MM.mmmmmmK" """
+        minutes = round(abs(value) * 60, 6)
+        return "{},{:.6f}{}".format(int(minutes // 60), minutes % 60, ref[:1])
+
+    properties = [("GPSVersionID", "2.2.0.0"),
+                  ("GPSLatitude", coordinate(latitude, tags["GPSLatitudeRef"])),
+                  ("GPSLongitude", coordinate(longitude, tags["GPSLongitudeRef"]))]
+    if altitude is not None:
+        below = tags.get("GPSAltitudeRef", "").startswith("Below") or altitude < 0
+        properties.append(("GPSAltitudeRef", "1" if below else "0"))
+        properties.append(("GPSAltitude", "{}/1000".format(int(round(abs(altitude) * 1000)))))
+    return properties
+
+def sidecar_with_gps(data, tags, place=None):
+    """
+    Replace the GPS properties of an XMP sidecar, keeping everything else.
+
+    @param data: contents of the sidecar, None for a new one
+    @param tags: dictionary as returned by native_gps_tags, None to remove them
+    @param place: dictionary of photoshop properties, see split_location
+    @param return: the new contents of the sidecar
+    """
+    for prefix, uri in XMP_NAMESPACES.items():
+        ElementTree.register_namespace(prefix, uri)
+    try:
+        root = ElementTree.fromstring(EMPTY_XMP if data is None else data)
+    except ElementTree.ParseError as exception:
+        raise NativeWriterError("Bad XMP: {}".format(exception))
+    rdf = "{" + XMP_NAMESPACES["rdf"] + "}"
+    gps = "{" + XMP_NAMESPACES["exif"] + "}GPS"
+    place = dict(("{" + XMP_NAMESPACES["photoshop"] + "}" + name, value)
+                 for name, value in (place or {}).items())
+
+    descriptions = list(root.iter(rdf + "Description"))
+    if not descriptions:
+        container = root if root.tag == rdf + "RDF" else root.find(".//" + rdf + "RDF")
+        if container is None:
+            raise NativeWriterError("Not an XMP sidecar")
+        descriptions.append(ElementTree.SubElement(container, rdf + "Description",
+                                                   {rdf + "about": ""}))
+    for description in descriptions:
+        for name in [name for name in description.attrib
+                     if name.startswith(gps) or name in place]:
+            del description.attrib[name]
+        for child in [child for child in description
+                      if child.tag.startswith(gps) or child.tag in place]:
+            description.remove(child)
+    if tags is not None:
+        for name, value in xmp_gps_properties(tags):
+            descriptions[0].set(gps[:-3] + name, value)
+    for name, value in place.items():
+        descriptions[0].set(name, value)
+    return XMP_PACKET[0] + ElementTree.tostring(root, encoding="utf-8") + XMP_PACKET[1]
+
+def split_location(arguments):
+    """
+    @param arguments: list of exiftool arguments
+    @param return: (the arguments other than those of location_arguments,
+                    dictionary of the XMP photoshop properties those write)
+    """
+    names = set(tag for tag, _, _ in LOCATION_TAGS)
+    names.add("IPTC:CodedCharacterSet")
+    others = []
+    place = dict()
+    for argument in arguments:
+        tag, _, value = argument[1:].partition("=")
+        if tag not in names:
+            others.append(argument)
+        elif tag.startswith("XMP-photoshop:"):
+            place[tag.split(":", 1)[1]] = unquoted(value)
+    return others, place
+
+def sidecar_job(filename, arguments, dryrun):
+    """
+    Write the GPS tags of arguments, and the place of --geocode, to the
+    XMP sidecar of a file instead of the file itself, or remove the GPS
+    tags from it for "-GPS*=". The sidecar
+    is replaced as a whole, whatever the --write-strategy.
+
+    @param return: FileResult
+    """
+    arguments, place = split_location(arguments)
+    tags = native_gps_tags(arguments)
+    removing = tags is None and [argument for argument in arguments
+                                 if argument not in STRATEGY_OPTIONS] == ["-GPS*="]
+    if tags is None and not removing:
+        return FileResult(filename, 1, "Cannot write these tags to a sidecar")
+
+    sidecar = sidecar_name(filename)
+    try:
+        with m_stats.timer("sidecar"):
+            data = None
+            if os.path.exists(sidecar):
+                with open(sidecar, "rb") as stream:
+                    data = stream.read()
+                m_stats.count("bytes_read", len(data))
+            elif removing:
+                return FileResult(filename, 0, "")
+            data = sidecar_with_gps(data, tags, place)
+            if not dryrun:
+                tempname = "{}.{}.tmp".format(sidecar, binascii.hexlify(os.urandom(4)).decode())
+                with os.fdopen(os.open(tempname, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666),
+                               "wb") as stream:
+                    stream.write(data)
+                os.rename(tempname, sidecar)
+                m_stats.count("bytes_written", len(data))
+    except NativeWriterError as exception:
+        return FileResult(filename, 1, "\"{}\": {}".format(sidecar, exception))
+    except (IOError, OSError) as exception:
+        return FileResult(filename, 1, str(exception))
+    return FileResult(filename, 0, "")
+
+def xmp_coordinate(value):
+    """Return an XMP "DDD,MM.mmmmmmK" or "DDD,MM,SSK" coordinate in signed degrees"""
+    parts = value[:-1].split(",")
+    degrees = sum(float(part) / 60.0 ** n for n, part in enumerate(parts))
+    return -degrees if value[-1:] in ("S", "W") else degrees
+
+def read_sidecar_gps(filename):
+    """
+    @param filename: string containing the name of an XMP sidecar
+    @param return: signed (lat, lon, alt) like signed_coordinates, or
+                   None if the sidecar has no GPS position
+    """
+    with open(filename, "rb") as stream:
+        data = stream.read()
+    try:
+        root = ElementTree.fromstring(data)
+    except ElementTree.ParseError as exception:
+        raise NativeWriterError("Bad XMP: {}".format(exception))
+    gps = "{" + XMP_NAMESPACES["exif"] + "}GPS"
+    tags = dict()
+    for description in root.iter("{" + XMP_NAMESPACES["rdf"] + "}Description"):
+        for name, value in description.attrib.items():
+            if name.startswith(gps):
+                tags[name[len(gps) - 3:]] = value
+        for child in description:
+            if child.tag.startswith(gps) and child.text:
+                tags[child.tag[len(gps) - 3:]] = child.text.strip()
+    try:
+        lat = xmp_coordinate(tags["GPSLatitude"])
+        lon = xmp_coordinate(tags["GPSLongitude"])
+        alt = None
+        if "GPSAltitude" in tags:
+            numerator, _, denominator = tags["GPSAltitude"].partition("/")
+            alt = float(numerator) / float(denominator or 1)
+            if tags.get("GPSAltitudeRef") == "1":
+                alt = -alt
+    except (KeyError, ValueError, ZeroDivisionError):
+        return None
+    return lat, lon, alt
+
+def map_file(filename):
+    """
+    Map a file for reading, advising the kernel against read-ahead, so
+    that reading its metadata only loads the pages which hold it.
+
+    @param return: read-only mmap of the file
+    """
+    with open(filename, "rb") as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise NativeWriterError("Empty file")
+    if hasattr(data, "madvise"):
+        data.madvise(mmap.MADV_RANDOM)
+    return data
+
+def tiff_gps_tags(tiff):
+    """
+    @param tiff: TIFF data, e.g. an mmap of a TIFF file
+    @param return: dictionary of GPS tag numbers and values, empty if
+                   there is no GPS IFD
+    """
+    endian = tiff_byte_order(tiff)
+    entries, _ = read_ifd(tiff, struct.unpack(endian + "I", bytes(tiff[4:8]))[0], endian)
+    for entry in entries:
+        if entry.tag == GPS_IFD_POINTER:
+            gps = struct.unpack(endian + "I", entry.raw[8:])[0]
+            return dict((e.tag, entry_value(tiff, e, endian))
+                        for e in read_ifd(tiff, gps, endian)[0])
+    return {}
+
+def read_jpeg_gps(filename):
+    """
+    @param filename: string containing one file name
+    @param return: dictionary of GPS tag numbers and values, empty if
+                   the file has no GPS data
+    """
+    data = map_file(filename)
+    try:
+        tiff = find_exif_segment(data)[2]
+        if tiff is None:
+            return {}
+        return tiff_gps_tags(tiff)
+    except (struct.error, IndexError, KeyError) as exception:
+        raise NativeWriterError("Damaged metadata: {}".format(exception))
+    finally:
+        data.close()
+
+# ftyp brands of HEIF images; other ISO base media files are read as MP4/QuickTime
+HEIF_BRANDS = (b"heic", b"heix", b"heim", b"heis", b"hevc", b"mif1", b"msf1", b"avif")
+# Top level boxes a QuickTime file may start with instead of ftyp
+BMFF_TYPES = (b"ftyp", b"moov", b"mdat", b"wide", b"free", b"skip")
+ISO6709_POSITION = re.compile(r'^([+-]\d+(?:\.\d*)?)([+-]\d+(?:\.\d*)?)([+-]\d+(?:\.\d*)?)?')
+
+def bmff_boxes(data, start, end):
+    """
+    @param data: bytes or mmap of an ISO base media file (MP4, QuickTime, HEIF)
+    @param start: offset of the first box
+    @param end: offset behind the last box
+    @param return: generator of (type, payload start, payload end)
+    """
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack(">I4s", data[pos:pos + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[pos + 8:pos + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise NativeWriterError("Bad box at {}".format(pos))
+        yield kind, pos + header, pos + size
+        pos += size
+
+def bmff_box(data, start, end, kind):
+    """@param return: (payload start, payload end) of the first box of kind, or None"""
+    for box, box_start, box_end in bmff_boxes(data, start, end):
+        if box == kind:
+            return box_start, box_end
+    return None
+
+def bmff_number(data, pos, size):
+    """Read a big endian unsigned number of size bytes (0, 2, 4 or 8)"""
+    if size == 0:
+        return 0
+    return struct.unpack(">" + {2: "H", 4: "I", 8: "Q"}[size], data[pos:pos + size])[0]
+
+def heif_exif(data):
+    """
+    @param data: bytes or mmap of a HEIF file
+    @param return: the TIFF data of its Exif item, or None
+    """
+    meta = bmff_box(data, 0, len(data), b"meta")
+    if meta is None:
+        return None
+    start, end = meta[0] + 4, meta[1]   # meta is a full box
+    iinf = bmff_box(data, start, end, b"iinf")
+    iloc = bmff_box(data, start, end, b"iloc")
+    if iinf is None or iloc is None:
+        return None
+
+    exif_id = None
+    first = iinf[0] + 4 + (2 if ord(data[iinf[0]:iinf[0] + 1]) == 0 else 4)
+    for kind, pos, _ in bmff_boxes(data, first, iinf[1]):
+        version = ord(data[pos:pos + 1])
+        if kind == b"infe" and version >= 2:
+            id_size = 2 if version == 2 else 4
+            if data[pos + 4 + id_size + 2:pos + 4 + id_size + 6] == b"Exif":
+                exif_id = bmff_number(data, pos + 4, id_size)
+                break
+    if exif_id is None:
+        return None
+
+    pos = iloc[0]
+    version = ord(data[pos:pos + 1])
+    sizes = bytearray(data[pos + 4:pos + 6])
+    offset_size, length_size = sizes[0] >> 4, sizes[0] & 15
+    base_size, index_size = sizes[1] >> 4, (sizes[1] & 15 if version in (1, 2) else 0)
+    id_size = 2 if version < 2 else 4
+    count = bmff_number(data, pos + 6, id_size)
+    pos += 6 + id_size
+    for _ in range(count):
+        item = bmff_number(data, pos, id_size)
+        pos += id_size
+        method = 0
+        if version in (1, 2):
+            method = bmff_number(data, pos, 2) & 15
+            pos += 2
+        pos += 2    # data reference index
+        base = bmff_number(data, pos, base_size)
+        pos += base_size
+        extents = bmff_number(data, pos, 2)
+        pos += 2
+        if item == exif_id:
+            if method != 0 or extents < 1:
+                raise NativeWriterError("Exif item is not stored in the file data")
+            pos += index_size
+            offset = base + bmff_number(data, pos, offset_size)
+            length = bmff_number(data, pos + offset_size, length_size)
+            if offset + length > len(data) or length < 4:
+                raise NativeWriterError("Bad Exif item location")
+            tiff_start = offset + 4 + struct.unpack(">I", data[offset:offset + 4])[0]
+            return data[tiff_start:offset + length]
+        pos += extents * (index_size + offset_size + length_size)
+    return None
+
+def mp4_position(data):
+    """
+    @param data: bytes or mmap of an MP4 or QuickTime file
+    @param return: signed (lat, lon, alt) of its ISO 6709 location
+                   (moov/udta/\xa9xyz), or None
+    """
+    moov = bmff_box(data, 0, len(data), b"moov")
+    udta = moov and bmff_box(data, moov[0], moov[1], b"udta")
+    xyz = udta and bmff_box(data, udta[0], udta[1], b"\xa9xyz")
+    if not xyz:
+        return None
+    length = struct.unpack(">H", data[xyz[0]:xyz[0] + 2])[0]
+    text = data[xyz[0] + 4:min(xyz[0] + 4 + length, xyz[1])].decode("latin-1")
+    i = ISO6709_POSITION.search(text)
+    if not i:
+        return None
+    return (float(i.group(1)), float(i.group(2)),
+            float(i.group(3)) if i.group(3) else None)
+
+def read_gps_native(filename):
+    """
+    Read the GPS position of a JPEG, TIFF (including raw formats based
+    on TIFF), HEIF or MP4/QuickTime file, touching only the pages of
+    the file which hold its metadata.
+
+    @param filename: string containing one file name
+    @param return: signed (lat, lon, alt), like signed_coordinates, or None
+    @raise NativeWriterError: if the file is of another kind or damaged
+    """
+    data = map_file(filename)
+    try:
+        head = data[:12]
+        if head[:2] == b"\xff\xd8":
+            tiff = find_exif_segment(data)[2]
+            return gps_ifd_coordinates(tiff_gps_tags(tiff)) if tiff is not None else None
+        if head[:4] in (b"II*\x00", b"MM\x00*"):
+            return gps_ifd_coordinates(tiff_gps_tags(data))
+        if head[4:8] in BMFF_TYPES:
+            if head[4:8] == b"ftyp" and head[8:12] in HEIF_BRANDS:
+                tiff = heif_exif(data)
+                return gps_ifd_coordinates(tiff_gps_tags(tiff)) if tiff is not None else None
+            return mp4_position(data)
+        raise NativeWriterError("Unsupported file type")
+    except (struct.error, IndexError, KeyError) as exception:
+        raise NativeWriterError("Damaged metadata: {}".format(exception))
+    finally:
+        data.close()
+
+def run_exiftool(cmdlist, engine):
+    """
+    @param cmdlist: exiftool command, starting with the program name
+    @param engine: ExiftoolEngine to use, or None for a one-off engine
+    @param return: error value
+    """
+    if engine is None:
+        with ExiftoolEngine() as engine:
+            return run_exiftool(cmdlist, engine)
+
+    with m_stats.timer("exiftool"):
+        result = engine.execute(cmdlist[1:])
+    if result.stderr:
+        m_logger.warning("%s", result.stderr)
+    m_logger.debug("exiftool returned %d: %s", result.returncode, result.stdout)
+    return result.returncode
+
+def argument_limit():
+    """Return the number of bytes one exiftool command line may occupy"""
+    try:
+        arg_max = os.sysconf("SC_ARG_MAX")
+    except (AttributeError, ValueError, OSError):
+        arg_max = -1
+    if arg_max <= 0:
+        arg_max = 131072
+    # Leave room for the environment and exiftool's own arguments
+    return arg_max // 2
+
+def argfile_chunks(files, size=BATCH_SIZE, limit=None):
+    """
+    @param files: iterable of file names
+    @param size: maximum number of files per chunk
+    @param limit: maximum number of bytes of file names per chunk
+    @param return: generator of lists of file names
+    """
+    if limit is None:
+        limit = argument_limit()
+    chunk = []
+    length = 0
+    for filename in files:
+        needed = len(encode_argument(filename)) + 1
+        if chunk and (len(chunk) >= size or length + needed > limit):
+            yield chunk
+            chunk = []
+            length = 0
+        chunk.append(filename)
+        length += needed
+    if chunk:
+        yield chunk
+
+def split_batch_result(files, result):
+    """
+    Attribute the messages of one multi-file exiftool command to
+    the files they belong to.
+
+    @param files: list of file names given to the command
+    @param result: ExiftoolResult of the command
+    @param return: list of FileResult, one per file, in the order of files
+    """
+    messages = dict((filename, []) for filename in files)
+    failed = set()
+    unattributed = []
+    for line in result.stderr.splitlines():
+        i = re.search(r'^(Error|Warning): (.*) - (.*)$', line)
+        if i and i.group(3) in messages:
+            messages[i.group(3)].append(line)
+            if i.group(1) == "Error":
+                failed.add(i.group(3))
+        elif line.strip():
+            unattributed.append(line)
+
+    # exiftool reported a failure we cannot pin on a file: blame them all
+    blame_all = result.returncode != 0 and not failed
+
+    results = []
+    for filename in files:
+        if filename in failed:
+            returncode = result.returncode or 1
+        elif blame_all:
+            returncode = result.returncode
+        else:
+            returncode = 0
+        message = messages[filename]
+        if blame_all:
+            message = message + unattributed
+        results.append(FileResult(filename, returncode, "\n".join(message)))
+    return results
+
+def log_chunk(arguments, chunk):
+    """Log the exiftool command which is about to process chunk"""
+    m_logger.info("Processing command \"%s\" for %d files", [EXIFTOOL] + arguments, len(chunk))
+    m_logger.debug("Files: %s", chunk)
+
+def execute_with_argfile(arguments, chunk, engine):
+    """
+    Run one exiftool command for a chunk of files, using an argfile.
+
+    @param arguments: list of exiftool arguments, applied to every file
+    @param chunk: list of file names
+    @param engine: ExiftoolEngine to run the command with
+    @param return: ExiftoolResult
+    """
+    argfile = tempfile.NamedTemporaryFile(prefix="addgps-", suffix=".args", delete=False)
+    try:
+        with argfile:
+            for line in list(arguments) + chunk:
+                argfile.write(encode_argument(line) + b"\n")
+        return engine.execute(["-@", argfile.name])
+    finally:
+        os.remove(argfile.name)
+
+def execute_chunk(arguments, chunk, engine):
+    """
+    @param arguments: list of exiftool arguments, applied to every file
+    @param chunk: list of file names
+    @param engine: ExiftoolEngine to run the command with
+    @param return: list of FileResult, in the order of chunk
+    """
+    with m_stats.timer("exiftool", len(chunk)):
+        results = split_batch_result(chunk, execute_with_argfile(arguments, chunk, engine))
+    if m_stats.enabled:
+        count_rewritten((result.filename for result in results if result.returncode == 0),
+                        strategy_of(arguments))
+    return results
+
+def count_rewritten(files, strategy="backup"):
+    """
+    Count the bytes exiftool read and wrote rewriting files, see Stats.
+    exiftool always writes a new file; in place, it then copies it
+    over the original, and by default it keeps the original as backup.
+    """
+    for filename in files:
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            continue
+        written = 2 * size if strategy == "in-place" else size
+        m_stats.count("bytes_read", size)
+        m_stats.count("bytes_written", written)
+        if strategy == "backup":
+            m_stats.count("backup_bytes", size)
+
+# exiftool options of each --write-strategy
+WRITE_STRATEGIES = OrderedDict([
+    ("backup", []),
+    ("overwrite", ["-overwrite_original"]),
+    ("in-place", ["-overwrite_original_in_place"]),
+])
+STRATEGY_OPTIONS = frozenset(option for options in WRITE_STRATEGIES.values()
+                             for option in options)
+
+def strategy_of(arguments):
+    """@param return: the --write-strategy which exiftool arguments ask for"""
+    for strategy, options in WRITE_STRATEGIES.items():
+        if options and options[0] in arguments:
+            return strategy
+    return "backup"
+
+def with_strategy(jobs, strategy):
+    """Add the exiftool options of a --write-strategy to the arguments of jobs, see run_jobs"""
+    options = WRITE_STRATEGIES[strategy]
+    for filename, arguments in jobs:
+        if options and arguments is not None:
+            arguments = options + list(arguments)
+        yield filename, arguments
+
+def sync_files(files):
+    """Flush files, and the directories they were renamed in, to disk"""
+    files = list(files)
+    directories = set()
+    with m_stats.timer("fsync", len(files)):
+        for filename in files:
+            directories.add(os.path.dirname(os.path.abspath(filename)))
+        for name in files + sorted(directories):
+            try:
+                handle = os.open(name, os.O_RDONLY)
+            except OSError:
+                continue
+            try:
+                os.fsync(handle)
+            except OSError:
+                pass        # not every platform syncs directories
+            finally:
+                os.close(handle)
+    m_stats.count("fsyncs", len(files) + len(directories))
+
+def synced(results, every):
+    """
+    Flush the files written to disk every so many files, see sync_files.
+    Results are passed on once their files are flushed, so that whoever
+    records them, like the journal of --apply, never gets ahead of the disk.
+
+    @param results: iterable of FileResult
+    @param every: number of files to flush at a time
+    @param return: generator of FileResult, in the order of results
+    """
+    pending = []
+    for result in chain(results, [None]):
+        if result is not None:
+            pending.append(result)
+            if len(pending) < every:
+                continue
+        sync_files(r.filename for r in pending if r.returncode == 0)
+        for done in pending:
+            yield done
+        pending = []
+
+def read_chunk(arguments, chunk, engine):
+    """
+    @param arguments: list of exiftool arguments selecting the tags to read
+    @param chunk: list of file names
+    @param engine: ExiftoolEngine to run the command with
+    @param return: list of (file name, dictionary of tags), in the order of chunk
+    """
+    with m_stats.timer("read_back", len(chunk)):
+        result = execute_with_argfile(["-j"] + list(arguments), chunk, engine)
+    try:
+        records = json.loads(result.stdout) if result.stdout.strip() else []
+    except ValueError:
+        raise ExiftoolError("Cannot parse exiftool output: {}".format(result.stdout[:200]))
+    by_name = dict((record.get("SourceFile"), record) for record in records)
+    return [(filename, by_name.get(filename, {})) for filename in chunk]
+
+class ExiftoolPool(object):
+    """Several ExiftoolEngines, each driven by its own worker thread.
+
+    exiftool is single-threaded, so running one engine per core is
+    what makes a large run use the whole machine. The engines start
+    lazily: a worker which never gets a file never spawns exiftool.
+    """
+    def __init__(self, jobs, executable=EXIFTOOL):
+        self.engines = [ExiftoolEngine(executable) for _ in range(max(1, jobs))]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(force=exc_type is not None)
+        return False
+
+    def close(self, force=False):
+        """Shut down all exiftool processes"""
+        for engine in self.engines:
+            engine.close(force)
+
+def shard_by_size(files, count, loads=None):
+    """
+    Distribute files over count shards so that every shard gets about
+    the same number of bytes (largest files first, each to the
+    currently lightest shard).
+
+    @param files: list of file names
+    @param count: number of shards
+    @param loads: list of bytes already assigned to each shard, updated in place
+    @param return: list of count lists of file names, each in the order of files
+    """
+    if loads is None:
+        loads = [0] * count
+    sizes = []
+    for index, filename in enumerate(files):
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            size = 0
+        sizes.append((-size, index))
+    sizes.sort()
+
+    heap = [(load, shard) for shard, load in enumerate(loads)]
+    heapq.heapify(heap)
+    assigned = [[] for _ in range(count)]
+    for size, index in sizes:
+        load, shard = heapq.heappop(heap)
+        assigned[shard].append(index)
+        loads[shard] = load - size
+        heapq.heappush(heap, (loads[shard], shard))
+
+    return [[files[index] for index in sorted(indices)] for indices in assigned]
+
+def run_tasks(engines, tasks, function=execute_chunk):
+    """
+    Execute exiftool commands on several engines in parallel.
+
+    @param engines: list of ExiftoolEngine
+    @param tasks: list with one list of (arguments, chunk) per engine
+    @param function: called as function(arguments, chunk, engine) for
+                     every task, returns a list of results
+    @param return: list of the results of all tasks
+    """
+    results = [[] for _ in engines]
+    errors = []
+
+    def worker(index):
+        """Run the tasks of one engine"""
+        try:
+            for arguments, chunk in tasks[index]:
+                results[index].extend(function(arguments, chunk, engines[index]))
+        except Exception as exception:       #pylint: disable=broad-except
+            errors.append(exception)
+
+    busy = [index for index, worker_tasks in enumerate(tasks) if worker_tasks]
+    if len(busy) == 1:
+        worker(busy[0])
+    else:
+        threads = [threading.Thread(target=worker, args=(index,)) for index in busy]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            # join() with a timeout keeps Ctrl-C working
+            while thread.is_alive():
+                thread.join(0.1)
+
+    if errors:
+        raise errors[0]
+    return [result for worker_results in results for result in worker_results]
+
+def read_tags(files, arguments, engine=None):
+    """
+    Read tags of many files with as few exiftool commands as possible.
+
+    @param files: list of file names
+    @param arguments: list of exiftool arguments selecting the tags, e.g. ["-n", "-GPS:all"]
+    @param engine: ExiftoolEngine or ExiftoolPool to run the commands with
+    @param return: list of (file name, dictionary of tags), in the order of files
+    """
+    if engine is None:
+        with ExiftoolEngine() as engine:
+            return read_tags(files, arguments, engine)
+
+    engines = getattr(engine, "engines", [engine])
+    tasks = [[] for _ in engines]
+    for index, chunk in enumerate(argfile_chunks(files)):
+        tasks[index % len(engines)].append((arguments, chunk))
+    found = dict(run_tasks(engines, tasks, read_chunk))
+    return [(filename, found.get(filename, {})) for filename in files]
+
+def gps_arguments(lat, lon, alt):
+    """Return the exiftool arguments which write lat, lon and alt"""
+    return lat.arguments() + lon.arguments() + alt.arguments()
+
+def group_by_arguments(jobs):
+    """
+    @param jobs: iterable of (file name, list of exiftool arguments)
+    @param return: OrderedDict mapping argument tuples to lists of file names
+    """
+    groups = OrderedDict()
+    for filename, arguments in jobs:
+        groups.setdefault(tuple(arguments), []).append(filename)
+    return groups
+
+def batches(items, size, ready=None, key=None):
+    """
+    Split items into lists of at most size items.
+
+    @param items: iterable
+    @param size: number of items in a list at most
+    @param ready: function telling if the next item can be had without
+                  waiting, given how many were taken so far, see
+                  StreamedLines.ready; when it cannot, the list is passed
+                  on as it is rather than waiting for more
+    @param key: function of an item; an item with the key of one already
+                in the list starts the next list
+    @param return: generator of lists
+    """
+    items = iter(items)
+    queued = []
+    taken = 0
+    while True:
+        batch = []
+        keys = set()
+        for item in chain(queued, items):
+            queued = []
+            if key is not None:
+                if key(item) in keys:
+                    queued = [item]
+                    break
+                keys.add(key(item))
+            batch.append(item)
+            taken += 1
+            if len(batch) >= size or (ready is not None and not ready(taken)):
+                break
+        if not batch:
+            return
+        yield batch
+
+def run_jobs(jobs, dryrun, engine=None, batch_size=BATCH_SIZE, native=False,      #pylint: disable=too-many-arguments,too-many-locals,too-many-branches
+             sidecars=(), ready=None):
+    """
+    Run exiftool for a stream of files with per-file arguments.
+    Files which get identical arguments share exiftool commands. With
+    an ExiftoolPool, the files are spread over its engines by size.
+    A file listed more than once is written once per job, in order.
+
+    @param jobs: iterable of (file name, list of exiftool arguments);
+                 arguments of None mark a file which has no valid coordinates
+    @param dryrun: boolean which defines if files should be changed (False) or not (True)
+    @param engine: ExiftoolEngine or ExiftoolPool to run the commands with
+    @param batch_size: number of jobs grouped at a time, per engine
+    @param native: boolean, write JPEG files without exiftool where possible
+    @param sidecars: extensions of the files to write XMP sidecars for, see sidecar_extensions
+    @param ready: function cutting a batch short when the next job is not
+                  there yet, see batches
+    @param return: generator of FileResult, in the order of jobs
+    """
+    if engine is None and not dryrun:
+        with ExiftoolEngine() as engine:
+            for result in run_jobs(jobs, dryrun, engine, batch_size, native, sidecars, ready):
+                yield result
+        return
+
+    engines = getattr(engine, "engines", [engine])
+    for jobs_batch in batches(jobs, batch_size * len(engines), ready, itemgetter(0)):
+        batch = []
+        results = dict()
+        for filename, arguments in jobs_batch:
+            if arguments is None:
+                results[filename] = FileResult(filename, 1, "No coordinates")
+            elif bad_filename(filename, dryrun):
+                results[filename] = FileResult(filename, 1, "Not a file")
+                arguments = None
+            batch.append((filename, arguments))
+
+        if sidecars:
+            written = 0
+            for filename, arguments in batch:
+                if arguments is not None and wants_sidecar(filename, sidecars):
+                    results[filename] = sidecar_job(filename, arguments, dryrun)
+                    written += 1
+            if written:
+                m_logger.info("Wrote %d XMP sidecars", written)
+        if native:
+            written = 0
+            for filename, arguments in batch:
+                if arguments is not None and filename not in results:
+                    result = native_job(filename, arguments, dryrun)
+                    if result is not None:
+                        results[filename] = result
+                        written += 1
+            if written:
+                m_logger.info("Wrote %d files without exiftool", written)
+        groups = group_by_arguments((f, a) for f, a in batch
+                                    if a is not None and f not in results)
+
+        tasks = [[] for _ in engines]
+        loads = [0] * len(engines)
+        for arguments, files in groups.items():
+            for index, shard in enumerate(shard_by_size(files, len(engines), loads)):
+                for chunk in argfile_chunks(shard):
+                    tasks[index].append((list(arguments), chunk))
+
+        # Log from here rather than from the workers, so the log
+        # does not depend on thread scheduling
+        for worker_tasks in tasks:
+            for arguments, chunk in worker_tasks:
+                log_chunk(arguments, chunk)
+
+        if dryrun:
+            for filename, arguments in batch:
+                if filename not in results:
+                    results[filename] = FileResult(filename, 0, "")
+        else:
+            for result in run_tasks(engines, tasks):
+                results[result.filename] = result
+
+        for filename, _ in batch:
+            yield results[filename]
+
+class ResultCounter(object):
+    """Count FileResults as they come in, logging the failures"""
+    def __init__(self):
+        self.done = 0
+        self.skipped = 0
+        self.failed = 0
+
+    def add(self, result):
+        """Count one FileResult; a returncode of None means skipped"""
+        m_stats.file_done(result)
+        m_events.file_done(result)
+        if result.returncode is None:
+            self.skipped += 1
+        elif result.returncode == 0:
+            self.done += 1
+            if result.message:
+                m_logger.warning("%s", result.message)
+        else:
+            self.failed += 1
+            m_logger.error("Failed to process \"%s\": %s", result.filename, result.message)
+
+    def log(self):
+        """Log the totals"""
+        if self.skipped:
+            m_logger.info("%d files processed, %d skipped, %d failed",
+                          self.done, self.skipped, self.failed)
+        else:
+            m_logger.info("%d files processed, %d failed", self.done, self.failed)
+
+def report_results(results):
+    """
+    Log the outcome of a batch run.
+
+    @param results: iterable of FileResult; a returncode of None means skipped
+    @param return: number of files which could not be processed
+    """
+    counter = ResultCounter()
+    for result in results:
+        counter.add(result)
+    counter.log()
+    return counter.failed
+
+# Largest difference in degrees (about one meter) and in meters of
+# altitude for which a file counts as already tagged
+TOLERANCE = 0.00001
+ALTITUDE_TOLERANCE = 0.5
+
+def unquoted(value):
+    """
+    Return an argument value without the double quotes around it,
+    which earlier versions wrote into plans
+    """
+    if len(value) >= 2 and value[0] == value[-1] == '"':
+        return value[1:-1]
+    return value
+
+def argument_tags(arguments):
+    """
+    @param arguments: list of exiftool arguments
+    @param return: dictionary of the tags they assign ("-Tag=value"), or
+                   None if there are other arguments than these and the
+                   options of a --write-strategy
+    """
+    tags = dict()
+    for argument in arguments:
+        if argument in STRATEGY_OPTIONS:
+            continue
+        i = re.search(r'^-([\w:-]+)=(.*)$', argument)
+        if not i:
+            return None
+        tags[i.group(1)] = unquoted(i.group(2))
+    return tags
+
+def signed_coordinates(tags):
+    """
+    @param tags: dictionary of GPS tags, as returned by argument_tags
+    @param return: (lat, lon, alt), north, east and up being positive;
+                   alt is None if there is none; None if lat or lon are missing
+    """
+    try:
+        lat = float(tags["GPSLatitude"])
+        lon = float(tags["GPSLongitude"])
+        if tags.get("GPSLatitudeRef", "N").startswith("S"):
+            lat = -lat
+        if tags.get("GPSLongitudeRef", "E").startswith("W"):
+            lon = -lon
+        alt = None
+        if tags.get("GPSAltitude") not in (None, ""):
+            alt = float(tags["GPSAltitude"])
+            if tags.get("GPSAltitudeRef", "").startswith("Below"):
+                alt = -alt
+    except (KeyError, ValueError):
+        return None
+    return lat, lon, alt
+
+def gps_ifd_coordinates(tags):
+    """
+    @param tags: dictionary of GPS IFD tag numbers and values, see read_jpeg_gps
+    @param return: signed (lat, lon, alt) or None, like signed_coordinates
+    """
+    try:
+        lat = sum(value / 60.0 ** n for n, value in enumerate(tags[2]))
+        lon = sum(value / 60.0 ** n for n, value in enumerate(tags[4]))
+        if tags.get(1, "N").startswith("S"):
+            lat = -lat
+        if tags.get(3, "E").startswith("W"):
+            lon = -lon
+        alt = None
+        if 6 in tags:
+            alt = tags[6][0] * (-1 if tags.get(5, [0])[0] == 1 else 1)
+    except (KeyError, IndexError, TypeError):
+        return None
+    return lat, lon, alt
+
+def read_gps_bulk(files, engine=None, sidecars=()):
+    """
+    Read the current GPS position of many files. JPEG files are read
+    natively, everything else with one exiftool command per chunk.
+    Files which get an XMP sidecar are read from their sidecar.
+
+    @param files: list of file names
+    @param engine: ExiftoolEngine or ExiftoolPool to run the commands with
+    @param sidecars: extensions of the files with sidecars, see sidecar_extensions
+    @param return: dictionary of file names and signed (lat, lon, alt), or None;
+                   for a sidecar which cannot be read, its NativeWriterError
+    """
+    positions = dict()
+    others = []
+    with m_stats.timer("read_back", len(files)):
+        for filename in files:
+            if wants_sidecar(filename, sidecars):
+                try:
+                    positions[filename] = read_sidecar_gps(sidecar_name(filename))
+                except (IOError, OSError):
+                    positions[filename] = None
+                except NativeWriterError as exception:
+                    positions[filename] = exception
+                continue
+            if os.path.splitext(filename)[1].lower() in JPEG_EXTENSIONS:
+                try:
+                    positions[filename] = gps_ifd_coordinates(read_jpeg_gps(filename))
+                    continue
+                except (NativeWriterError, IOError, OSError, struct.error):
+                    pass
+            others.append(filename)
+
+    if others:
+        arguments = ["-n", "-Composite:GPSLatitude", "-Composite:GPSLongitude",
+                     "-Composite:GPSAltitude"]
+        for filename, tags in read_tags(others, arguments, engine):
+            positions[filename] = signed_coordinates(tags)
+    return positions
+
+def same_position(wanted, current, tolerance=TOLERANCE):
+    """Tell if position current is close enough to position wanted"""
+    if wanted is None or current is None:
+        return False
+    if abs(wanted[0] - current[0]) > tolerance:
+        return False
+    if abs((wanted[1] - current[1] + 180) % 360 - 180) > tolerance:
+        return False
+    if wanted[2] is None:
+        return True   # exiftool leaves an existing altitude alone
+    return current[2] is not None and abs(wanted[2] - current[2]) <= ALTITUDE_TOLERANCE
+
+def file_key(status):
+    """Return what tells whether a file changed since it was recorded"""
+    mtime_ns = getattr(status, "st_mtime_ns", None)
+    if mtime_ns is None:
+        mtime_ns = int(status.st_mtime * 1000000000)
+    return (status.st_ino, status.st_size, mtime_ns)
+
+class Manifest(object):
+    """Record of the GPS positions addgps wrote, kept in SQLite.
+
+    A file is identified by its path, and its entry is only trusted as
+    long as inode, size and modification time are unchanged.
+    """
+    def __init__(self, filename):
+        self.connection = sqlite3.connect(filename)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, inode INTEGER, " +
+            "size INTEGER, mtime_ns INTEGER, lat REAL, lon REAL, alt REAL)")
+        self.connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        """Close the database"""
+        self.connection.close()
+
+    def lookup(self, paths):
+        """
+        @param paths: list of absolute file names
+        @param return: dictionary of path and ((inode, size, mtime_ns), (lat, lon, alt))
+        """
+        found = dict()
+        for start in range(0, len(paths), 500):
+            part = paths[start:start + 500]
+            rows = self.connection.execute(
+                "SELECT path, inode, size, mtime_ns, lat, lon, alt FROM files " +
+                "WHERE path IN ({})".format(",".join("?" * len(part))), part)
+            for row in rows:
+                found[row[0]] = (tuple(row[1:4]), tuple(row[4:7]))
+        return found
+
+    def record(self, entries):
+        """
+        @param entries: list of (path, (inode, size, mtime_ns), (lat, lon, alt))
+        """
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(path,) + tuple(key) + tuple(position) for path, key, position in entries])
+
+    def forget(self, paths):
+        """Drop the entries of files which no longer have the recorded position"""
+        with self.connection:
+            self.connection.executemany("DELETE FROM files WHERE path = ?",
+                                        [(path,) for path in paths])
+
+def run_incremental(jobs, dryrun, engine, manifest, native=False,     #pylint: disable=too-many-arguments,too-many-locals
+                    batch_size=BATCH_SIZE, ready=None):
+    """
+    Like run_jobs, but skip files which already have the position
+    their arguments would write, according to the manifest or, for
+    files it does not know, to a bulk read of their GPS tags.
+
+    @param manifest: Manifest
+    @param batch_size: number of jobs checked and written at a time, per engine
+    @param ready: function cutting a batch short, see batches
+    @param return: generator of FileResult, in the order of jobs;
+                   skipped files have a returncode of None
+    """
+    engines = getattr(engine, "engines", [engine])
+    for batch in batches(jobs, batch_size * len(engines), ready, itemgetter(0)):
+        wanted = dict()
+        keys = dict()
+        for filename, arguments in batch:
+            position = signed_coordinates(argument_tags(arguments or []) or {})
+            if position is not None:
+                try:
+                    keys[filename] = file_key(os.stat(filename))
+                    wanted[filename] = position
+                except OSError:
+                    pass
+
+        paths = dict((filename, os.path.abspath(filename)) for filename in wanted)
+        known = manifest.lookup(list(paths.values()))
+        skipped = set()
+        unknown = []
+        for filename, position in wanted.items():
+            entry = known.get(paths[filename])
+            if entry is not None and entry[0] == keys[filename]:
+                if same_position(position, entry[1]):
+                    skipped.add(filename)
+            else:
+                unknown.append(filename)
+
+        current = read_gps_bulk(unknown, engine)
+        fresh = []
+        for filename in unknown:
+            if same_position(wanted[filename], current.get(filename)):
+                skipped.add(filename)
+                fresh.append((paths[filename], keys[filename], current[filename]))
+        if fresh and not dryrun:
+            manifest.record(fresh)
+        m_logger.debug("%d of %d files are already tagged", len(skipped), len(batch))
+
+        results = dict((filename, FileResult(filename, None, "Already tagged"))
+                       for filename in skipped)
+        written = []
+        for result in run_jobs([job for job in batch if job[0] not in skipped],
+                               dryrun, engine, batch_size, native):
+            results[result.filename] = result
+            if result.returncode == 0 and result.filename in wanted and not dryrun:
+                try:
+                    key = file_key(os.stat(result.filename))
+                except OSError:
+                    continue
+                written.append((paths[result.filename], key, wanted[result.filename]))
+        manifest.record(written)
+
+        for filename, _ in batch:
+            yield results[filename]
+
+# Bytes read at a time when hashing image data
+HASH_CHUNK_SIZE = 1 << 20
+
+def jpeg_image_offset(stream):
+    """
+    Find where the image data of a JPEG file starts, reading only the
+    headers of the segments before it.
+
+    @param stream: binary file object, at the start of the file
+    @param return: offset of the first SOS marker, or of EOI
+    """
+    if stream.read(2) != b"\xff\xd8":
+        raise NativeWriterError("Not a JPEG file")
+    while True:
+        marker = stream.read(2)
+        if marker[0:1] != b"\xff":
+            raise NativeWriterError("Bad JPEG marker at {}".format(stream.tell() - len(marker)))
+        while marker[1:2] == b"\xff":
+            marker = b"\xff" + stream.read(1)   # fill bytes
+        code = ord(marker[1:2] or b"\xd9")
+        if code in (0xda, 0xd9):
+            return stream.tell() - 2
+        if 0xd0 <= code <= 0xd7 or code == 0x01:
+            continue
+        length = stream.read(2)
+        if len(length) < 2 or struct.unpack(">H", length)[0] < 2:
+            raise NativeWriterError("Truncated JPEG segment at {}".format(stream.tell() - 4))
+        stream.seek(struct.unpack(">H", length)[0] - 2, os.SEEK_CUR)
+
+def image_data_hash(filename):
+    """
+    @param filename: string containing the name of a JPEG file
+    @param return: hex SHA-256 of its image data, from the first scan to
+                   the end of the file, read a chunk at a time
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as stream:
+        stream.seek(jpeg_image_offset(stream))
+        for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+        m_stats.count("bytes_read", stream.tell())
+    return digest.hexdigest()
+
+def image_hashes(files, engine=None):
+    """
+    Hash the image data of many files, leaving out their metadata.
+    JPEG files are hashed natively, everything else by exiftool's
+    ImageDataMD5, with one command per chunk.
+
+    @param files: list of file names
+    @param engine: ExiftoolEngine to run the commands with
+    @param return: dictionary of file names and hashes, None where
+                   there is none (e.g. for an exiftool older than 11.39)
+    """
+    hashes = dict()
+    others = []
+    with m_stats.timer("hash", len(files)):
+        for filename in files:
+            if os.path.splitext(filename)[1].lower() in JPEG_EXTENSIONS:
+                try:
+                    hashes[filename] = image_data_hash(filename)
+                    continue
+                except (NativeWriterError, IOError, OSError, struct.error):
+                    pass
+            others.append(filename)
+    if others:
+        for filename, tags in read_tags(others, ["-ImageDataMD5"], engine):
+            hashes[filename] = tags.get("ImageDataMD5")
+    return hashes
+
+def written_position(arguments):
+    """
+    @param arguments: list of exiftool arguments, or None
+    @param return: ("add", signed (lat, lon, alt)) for arguments which
+                   write a position, ("remove", None) for "-GPS*=", or
+                   None for anything else
+    """
+    if arguments is None:
+        return None
+    if [argument for argument in arguments if argument not in STRATEGY_OPTIONS] == ["-GPS*="]:
+        return "remove", None
+    position = signed_coordinates(argument_tags(arguments) or {})
+    return None if position is None else ("add", position)
+
+class Verifier(object):
+    """Read back what was written, for --verify.
+
+    Written files are checked a batch at a time: their GPS positions
+    are read back in bulk, see read_gps_bulk, and with hashes, their
+    image data is hashed before and after writing. A batch is checked
+    in a thread of its own, with exiftool processes of its own, while
+    the next one is written.
+    """
+    def __init__(self, hashes=False, sidecars=(), executable=EXIFTOOL):
+        self.hashes = hashes
+        self.sidecars = sidecars
+        # One engine hashes the files about to be written, the
+        # other checks those written, at the same time
+        self.before_engine = ExiftoolEngine(executable)
+        self.engine = ExiftoolEngine(executable)
+        self.expected = deque()
+
+    def close(self, force=False):
+        """Shut down the exiftool processes"""
+        self.before_engine.close(force)
+        self.engine.close(force)
+
+    def jobs(self, jobs, batch_size=BATCH_SIZE, ready=None):
+        """
+        Pass jobs on to be written, see run_jobs, remembering what they
+        write and, with hashes, the hashes of their image data.
+        """
+        for batch in batches(jobs, batch_size, ready):
+            self.expected.extend(self.expect(batch))
+            for job in batch:
+                yield job
+
+    def expect(self, jobs):
+        """
+        @param jobs: list of (file name, list of exiftool arguments or None), not written yet
+        @param return: list of what check takes for them, in the order of jobs
+        """
+        before = dict()
+        if self.hashes:
+            before = image_hashes([filename for filename, arguments in jobs
+                                   if written_position(arguments) is not None
+                                   and os.path.isfile(filename)], self.before_engine)
+        return [(written_position(arguments), before.get(filename))
+                for filename, arguments in jobs]
+
+    def check(self, results, expected):
+        """
+        @param results: list of FileResult
+        @param expected: list of what jobs remembered, in the order of results
+        @param return: list of FileResult, failed where the check fails
+        """
+        written = [(result.filename, wanted, before)
+                   for result, (wanted, before) in zip(results, expected)
+                   if result.returncode == 0 and wanted is not None]
+        with m_stats.timer("verify", len(written)):
+            current = read_gps_bulk([filename for filename, _, _ in written], self.engine,
+                                    self.sidecars)
+            after = dict()
+            if self.hashes:
+                after = image_hashes([filename for filename, _, before in written
+                                      if before is not None], self.engine)
+
+        failures = dict()
+        for filename, (action, position), before in written:
+            found = current.get(filename)
+            if isinstance(found, NativeWriterError):
+                failures[filename] = "cannot read the sidecar back: {}".format(found)
+            elif action == "remove" and found is not None:
+                failures[filename] = "the GPS position is still there"
+            elif action == "add" and found is None:
+                failures[filename] = "no GPS position was read back"
+            elif action == "add" and not same_position(position, found):
+                failures[filename] = "read back {:.6f}, {:.6f} instead of {:.6f}, {:.6f}".format(
+                    found[0], found[1], position[0], position[1])
+            elif before is not None and after.get(filename) not in (None, before):
+                failures[filename] = "the image data changed"
+        if failures:
+            m_stats.count("verify_failures", len(failures))
+        return [FileResult(result.filename, 1, "Verification failed: " +
+                           failures[result.filename])
+                if result.filename in failures else result
+                for result in results]
+
+    def start(self, results, expected):
+        """Check results in a thread, see check; return what finish takes"""
+        outcome = []
+
+        def worker():
+            """Thread body"""
+            try:
+                outcome.append(self.check(results, expected))
+            except Exception as exception:       #pylint: disable=broad-except
+                outcome.append(exception)
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        return thread, outcome
+
+    @staticmethod
+    def finish(pending):
+        """Wait for the check started by start, return its results"""
+        thread, outcome = pending
+        # join() with a timeout keeps Ctrl-C working
+        while thread.is_alive():
+            thread.join(0.1)
+        if isinstance(outcome[0], Exception):
+            raise outcome[0]
+        return outcome[0]
+
+    def results(self, results, batch_size=BATCH_SIZE, ready=None):
+        """
+        Check the files written, a batch behind the writes.
+
+        @param results: iterable of FileResult, in the order of the jobs
+                        passed on by jobs
+        @param ready: function cutting a batch short, see batches
+        @param return: generator of FileResult, in the same order
+        """
+        results = batches(results, batch_size, ready)
+        pending = None
+        try:
+            while True:
+                # Taking the next batch writes it, while the last one is checked
+                batch = next(results, [])
+                expected = [self.expected.popleft() for _ in batch]
+                checked = self.finish(pending) if pending is not None else []
+                pending = self.start(batch, expected) if batch else None
+                for result in checked:
+                    yield result
+                if pending is None:
+                    break
+        except BaseException:
+            self.close(force=True)
+            raise
+        self.close()
+
+def verifier(args, executable=EXIFTOOL):
+    """Return the Verifier of --verify, or None"""
+    if not args.verify or args.dryrun:
+        return None
+    return Verifier(args.verify_hash, sidecar_extensions(args), executable)
+
+# First field of the header line of a plan file
+PLAN_FORMAT = u"addgps-plan"
+PLAN_VERSION = 1
+
+class PlanWriter(object):
+    """Record jobs in a plan file for --apply, instead of running them.
+
+    A plan is a text file of JSON lines: a header with a random plan id,
+    then the argument lists, each written once as {"set": n, "arguments":
+    [...]}, and one [n, "absolute file name"] per file. Files are numbered
+    by their position in the plan, which is what --range selects. The
+    plan only appears under its name once it is complete.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        handle, self.tempname = tempfile.mkstemp(prefix=".addgps-", suffix=".plan",
+                                                 dir=os.path.dirname(filename) or ".")
+        self.stream = os.fdopen(handle, "w")
+        self.sets = dict()
+        self.count = 0
+        self.write({"format": PLAN_FORMAT, "version": PLAN_VERSION,
+                    "id": binascii.hexlify(os.urandom(8)).decode("ascii")})
+
+    def write(self, record):
+        """Append one JSON line"""
+        self.stream.write(json.dumps(record, separators=(",", ":")) + "\n")
+
+    def record(self, jobs):
+        """
+        @param jobs: iterable of (file name, list of exiftool arguments or None), see run_jobs
+        @param return: generator of FileResult, in the order of jobs
+        """
+        for filename, arguments in jobs:
+            if arguments is None:
+                yield FileResult(filename, 1, "No coordinates")
+                continue
+            key = tuple(arguments)
+            number = self.sets.get(key)
+            if number is None:
+                number = self.sets[key] = len(self.sets)
+                self.write({"set": number, "arguments": list(arguments)})
+            self.write([number, os.path.abspath(filename)])
+            self.count += 1
+            yield FileResult(filename, 0, "")
+
+    def close(self):
+        """Complete the plan"""
+        self.stream.flush()
+        os.fsync(self.stream.fileno())
+        self.stream.close()
+        os.rename(self.tempname, self.filename)
+        m_logger.info("Planned %d files in \"%s\"", self.count, self.filename)
+
+    def abort(self):
+        """Drop the incomplete plan"""
+        self.stream.close()
+        os.remove(self.tempname)
+
+class Plan(object):
+    """A plan file written by PlanWriter"""
+    def __init__(self, filename):
+        self.stream = io.open(filename, encoding="utf-8")
+        try:
+            header = json.loads(self.stream.readline())
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get("format") != PLAN_FORMAT:
+            self.stream.close()
+            raise ValueError("\"{}\" is not an addgps plan".format(filename))
+        if header.get("version") != PLAN_VERSION:
+            self.stream.close()
+            raise ValueError("\"{}\" is a plan of an unknown version {}".format(
+                filename, header.get("version")))
+        self.id = header["id"]      #pylint: disable=invalid-name
+
+    def entries(self, start=0, end=None):
+        """
+        @param start: number of the first file to return
+        @param end: number of the file to stop before, None for the end of the plan
+        @param return: generator of (number, file name, list of exiftool arguments)
+        """
+        sets = dict()
+        number = 0
+        for line in self.stream:
+            record = json.loads(line)
+            if isinstance(record, dict):
+                sets[record["set"]] = record["arguments"]
+                continue
+            if end is not None and number >= end:
+                return
+            if number >= start:
+                yield number, record[1], sets[record[0]]
+            number += 1
+
+    def close(self):
+        """Close the plan file"""
+        self.stream.close()
+
+def parse_range(text):
+    """
+    @param text: "START:END", both optional, e.g. "0:50000" or "50000:"
+    @param return: (start, end), end is None for the end of the plan
+    """
+    i = re.search(r'^\s*(\d*)\s*:\s*(\d*)\s*$', text)
+    if not i or (i.group(1) and i.group(2) and int(i.group(1)) > int(i.group(2))):
+        raise ValueError("Unrecognized range \"{}\", use START:END".format(text))
+    return int(i.group(1) or 0), int(i.group(2)) if i.group(2) else None
+
+class Journal(object):
+    """Numbers of the files of a plan written so far.
+
+    Each --range keeps its own journal next to the plan, starting with
+    the plan id, followed by one number per line. The journal is
+    fsync'd every JOURNAL_INTERVAL files and when closed, so after a
+    crash at most that many files are written again. All journals of a
+    plan count when resuming, so it can be resharded between runs.
+    """
+    def __init__(self, plan_filename, plan_id, plan_range=(0, None)):
+        self.plan_id = plan_id
+        suffix = "" if plan_range == (0, None) else ".{}-{}".format(
+            plan_range[0], "" if plan_range[1] is None else plan_range[1])
+        self.filename = plan_filename + suffix + ".journal"
+        self.prefix = os.path.basename(plan_filename) + "."
+        self.directory = os.path.dirname(plan_filename) or "."
+        self.stream = None
+        self.pending = 0
+
+    def journals(self):
+        """@param return: list of the journal files of the plan"""
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.startswith(self.prefix) and name.endswith(".journal")]
+
+    def completed(self):
+        """@param return: set of the numbers of the files written according to all journals"""
+        done = set()
+        for filename in self.journals():
+            with open(filename) as stream:
+                if stream.readline().strip() != self.plan_id:
+                    m_logger.warning("Ignoring \"%s\", which belongs to another plan", filename)
+                    continue
+                # A line without newline was cut short by a crash
+                done.update(int(line) for line in stream if line.endswith("\n"))
+        return done
+
+    def start(self):
+        """Open the journal for appending, afresh if it belongs to another plan"""
+        header = (self.plan_id + "\n").encode("ascii")
+        try:
+            with open(self.filename, "r+b") as stream:
+                data = stream.read()
+                if data.startswith(header):
+                    # Drop a line cut short by a crash
+                    stream.truncate(data.rfind(b"\n") + 1)
+                    return open(self.filename, "a")
+        except (IOError, OSError):
+            pass
+        stream = open(self.filename, "w")
+        stream.write(self.plan_id + "\n")
+        return stream
+
+    def record(self, number):
+        """Note that the file numbered number is written"""
+        if self.stream is None:
+            self.stream = self.start()
+        self.stream.write("{}\n".format(number))
+        self.pending += 1
+        if self.pending >= JOURNAL_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        """Make the journal durable"""
+        if self.stream is not None and self.pending:
+            self.stream.flush()
+            os.fsync(self.stream.fileno())
+        self.pending = 0
+
+    def close(self):
+        """Sync and close the journal"""
+        self.sync()
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+# Number of files written between two fsyncs of the journal
+JOURNAL_INTERVAL = BATCH_SIZE
+
+def apply_plan(args, engine, manifest=None):
+    """
+    Write the files of a plan, or of the --range of it, which are not
+    journaled as written yet.
+
+    @param args: parsed command line arguments
+    @param engine: ExiftoolEngine or ExiftoolPool to run the commands with
+    @param manifest: Manifest of --manifest, or None
+    @param return: number of files which could not be processed
+    """
+    plan = Plan(args.apply)
+    start, end = parse_range(args.range or ":")
+    journal = Journal(args.apply, plan.id, (start, end))
+    done = journal.completed()
+    numbers = deque()
+    skipped = [0]
+
+    def jobs():
+        """The entries still to write, remembering their numbers"""
+        for number, filename, arguments in plan.entries(start, end):
+            if number in done:
+                skipped[0] += 1
+                continue
+            numbers.append(number)
+            yield filename, arguments
+
+    def journaled(results):
+        """Journal the files written, in the order of jobs"""
+        for result in results:
+            number = numbers.popleft()
+            if result.returncode == 0 and not args.dryrun:
+                journal.record(number)
+            yield result
+
+    try:
+        failed = report_results(journaled(write_jobs(jobs(), args, engine, manifest)))
+    finally:
+        journal.close()
+        plan.close()
+    if skipped[0]:
+        m_logger.info("%d files were written by an earlier run", skipped[0])
+    return failed
+
+def write_jobs(jobs, args, engine, manifest=None, plan=None, ready=None):     #pylint: disable=too-many-arguments
+    """
+    Write jobs the way the command line asks for, see run_jobs, and
+    check them with --verify. With a PlanWriter, record them in the
+    plan instead. With ready, see StreamedLines.ready, batches are cut
+    short when the next job is not there yet.
+    """
+    jobs = geocoded(jobs, args, ready)
+    if plan is not None:
+        return plan.record(jobs)
+    jobs = with_strategy(m_events.jobs(jobs), args.write_strategy)
+    native = args.backend == "native"
+    checker = verifier(args)
+    if checker is not None:
+        jobs = checker.jobs(jobs, BATCH_SIZE, ready)
+    if manifest is not None:
+        results = run_incremental(jobs, args.dryrun, engine, manifest, native, BATCH_SIZE,
+                                  ready)
+    else:
+        results = run_jobs(jobs, args.dryrun, engine, BATCH_SIZE, native,
+                           sidecar_extensions(args), ready)
+    if checker is not None:
+        results = checker.results(results, BATCH_SIZE, ready)
+    if args.fsync_every and not args.dryrun:
+        results = synced(results, args.fsync_every)
+    return results
+
+def write_and_report(jobs, args, engine, manifest=None, plan=None, ready=None):     #pylint: disable=too-many-arguments
+    """
+    Write jobs the way the command line asks for and log the outcome.
+
+    @param return: number of files which could not be processed
+    """
+    if args.pipeline:
+        import addgps_async     # Python 3 only
+        return addgps_async.run_pipeline(
+            with_strategy(m_events.jobs(geocoded(jobs, args, ready)), args.write_strategy), args)
+    return report_results(write_jobs(jobs, args, engine, manifest, plan, ready))
+
+# exiftool's default for the largest time between track points to
+# interpolate over (GeoMaxIntSecs)
+MAX_GAP = 1800
+
+def parse_iso_time(text):
+    """
+    @param text: ISO 8601 time, e.g. "2015-01-08T15:24:10Z" or "2015-01-08T16:24:10.5+01:00"
+    @param return: seconds since the epoch, as float
+    """
+    i = re.search(r'^\s*(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(\.\d*)?\s*' +
+                  r'(Z|[+-]\d\d:?\d\d)?\s*$', text)
+    if not i:
+        raise ValueError("Unrecognized time \"{}\"".format(text))
+    seconds = calendar.timegm([int(v) for v in i.group(1, 2, 3, 4, 5, 6)])
+    if i.group(7):
+        seconds += float("0" + i.group(7))
+    return seconds - parse_time_offset(i.group(8))
+
+def parse_exif_time(text, offset=0):
+    """
+    @param text: EXIF time, e.g. "2015:01:08 15:24:10", maybe with a time zone
+    @param offset: seconds the camera clock is ahead of UTC, used if text has no time zone
+    @param return: seconds since the epoch, as float, or None
+    """
+    i = re.search(r'^\s*(\d{4}):(\d\d):(\d\d) (\d\d):(\d\d):(\d\d)(\.\d*)?\s*' +
+                  r'(Z|[+-]\d\d:?\d\d)?', text or "")
+    if not i:
+        return None
+    seconds = calendar.timegm([int(v) for v in i.group(1, 2, 3, 4, 5, 6)])
+    if i.group(7):
+        seconds += float("0" + i.group(7))
+    if i.group(8):
+        return seconds - parse_time_offset(i.group(8))
+    return seconds - offset
+
+def parse_time_offset(text):
+    """
+    @param text: "Z", "+02:00", "-0800", "-8" (hours) or None
+    @param return: offset in seconds
+    """
+    if not text or text == "Z":
+        return 0
+    i = re.search(r'^([+-]?)(\d\d?)(?::?(\d\d))?$', text.strip())
+    if not i:
+        raise ValueError("Unrecognized time offset \"{}\"".format(text))
+    seconds = int(i.group(2)) * 3600 + int(i.group(3) or 0) * 60
+    return -seconds if i.group(1) == "-" else seconds
+
+class GPSTrack(object):
+    """A track log, kept as four parallel, time-sorted columns.
+
+    Arrays of doubles take 32 bytes per point, so even tracks with
+    millions of points stay small.
+    """
+    def __init__(self):
+        self.times = array('d')
+        self.lats = array('d')
+        self.lons = array('d')
+        self.eles = array('d')
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, time_, lat, lon, ele):
+        """Add one point. Call sort() when done."""
+        self.times.append(time_)
+        self.lats.append(lat)
+        self.lons.append(lon)
+        self.eles.append(ele)
+
+    def extend(self, other):
+        """Add all points of another track. Call sort() when done."""
+        for mine, theirs in ((self.times, other.times), (self.lats, other.lats),
+                             (self.lons, other.lons), (self.eles, other.eles)):
+            mine.extend(theirs)
+
+    def sort(self):
+        """Put the points in time order"""
+        times = self.times
+        if all(times[i] <= times[i + 1] for i in range(len(times) - 1)):
+            return
+        order = sorted(range(len(times)), key=times.__getitem__)
+        for name in ("times", "lats", "lons", "eles"):
+            column = getattr(self, name)
+            setattr(self, name, array('d', [column[i] for i in order]))
+
+    def point(self, index, time_, max_gap):
+        """
+        Interpolate between points index - 1 and index.
+
+        @param return: (lat, lon, ele) or None; ele may be NaN
+        """
+        times = self.times
+        if index < len(times) and times[index] == time_:
+            return self.lats[index], self.lons[index], self.eles[index]
+        if index == 0 or index == len(times):
+            return None
+        before, after = index - 1, index
+        span = times[after] - times[before]
+        if span > max_gap:
+            return None
+        fraction = (time_ - times[before]) / span
+        lon_before, lon_after = self.lons[before], self.lons[after]
+        if abs(lon_after - lon_before) > 180:   # across the antimeridian
+            lon_after += 360 if lon_after < lon_before else -360
+        lon = lon_before + (lon_after - lon_before) * fraction
+        if lon > 180:
+            lon -= 360
+        elif lon < -180:
+            lon += 360
+        return (self.lats[before] + (self.lats[after] - self.lats[before]) * fraction,
+                lon,
+                self.eles[before] + (self.eles[after] - self.eles[before]) * fraction)
+
+    def locate(self, time_, max_gap=MAX_GAP):
+        """
+        @param time_: seconds since the epoch
+        @param max_gap: largest time in seconds between two points to interpolate over
+        @param return: (lat, lon, ele) or None
+        """
+        return self.point(bisect_left(self.times, time_), time_, max_gap)
+
+    def locate_all(self, times, max_gap=MAX_GAP):
+        """
+        Locate many times at once. Sorted times are merged against the
+        track in one pass, others are looked up one by one.
+
+        @param times: list of seconds since the epoch, or None
+        @param return: list of (lat, lon, ele) or None
+        """
+        known = [t for t in times if t is not None]
+        if any(known[i] > known[i + 1] for i in range(len(known) - 1)):
+            return [None if t is None else self.locate(t, max_gap) for t in times]
+
+        positions = []
+        index = 0
+        track_times = self.times
+        for time_ in times:
+            if time_ is None:
+                positions.append(None)
+                continue
+            while index < len(track_times) and track_times[index] < time_:
+                index += 1
+            positions.append(self.point(index, time_, max_gap))
+        return positions
+
+    @classmethod
+    def from_gpx(cls, filename):
+        """
+        Read the track points of a GPX file without building its whole
+        document tree in memory.
+        """
+        track = cls()
+        parents = []
+        point = None
+        for event, element in ElementTree.iterparse(filename, events=("start", "end")):
+            tag = element.tag.rsplit("}", 1)[-1]
+            if event == "start":
+                if tag == "trkpt":
+                    point = element
+                else:
+                    parents.append(element)
+                continue
+
+            if tag != "trkpt":
+                if parents and parents[-1] is element:
+                    parents.pop()
+                continue
+
+            time_ = ele = None
+            for child in point:
+                name = child.tag.rsplit("}", 1)[-1]
+                if name == "time":
+                    time_ = child.text
+                elif name == "ele":
+                    ele = child.text
+            try:
+                if time_ is not None:
+                    track.append(parse_iso_time(time_),
+                                 float(element.get("lat")),
+                                 float(element.get("lon")),
+                                 float(ele) if ele else float("nan"))
+            except (TypeError, ValueError) as exception:
+                m_logger.warning("Skipping track point in \"%s\": %s", filename, exception)
+            # Drop the point, so memory use does not grow with the file
+            element.clear()
+            if parents:
+                parents[-1].remove(element)
+
+        track.sort()
+        m_logger.debug("Read %d track points from \"%s\"", len(track), filename)
+        return track
+
+    @classmethod
+    def from_nmea(cls, filename):
+        """
+        Read the fixes of an NMEA 0183 log: the position and date of its
+        RMC sentences, with the altitude of the GGA sentence of the same
+        time. GGA sentences before the first RMC have no date and are
+        skipped.
+        """
+        track = cls()
+        date = None
+        fix = None      # [time of day, date, lat, lon, ele]
+
+        def add(fix):
+            """Add a complete fix to the track"""
+            if fix is not None and fix[1] is not None:
+                try:
+                    track.append(nmea_time(fix[1], fix[0]), fix[2], fix[3], fix[4])
+                except ValueError as exception:
+                    m_logger.warning("Skipping fix in \"%s\": %s", filename, exception)
+
+        with open(filename, "rb") as stream:
+            for number, line in enumerate(stream, 1):
+                fields = line.decode("ascii", "replace").strip().split("*")[0].split(",")
+                kind = fields[0][3:] if fields[0].startswith("$") else None
+                try:
+                    if kind == "RMC" and len(fields) > 9 and fields[2] == "A":
+                        lat, lon = nmea_position(fields[3:7])
+                        date = fields[9]
+                        ele = None
+                    elif kind == "GGA" and len(fields) > 9 and fields[6] not in ("", "0"):
+                        lat, lon = nmea_position(fields[2:6])
+                        ele = float(fields[9]) if fields[9] else float("nan")
+                    else:
+                        continue
+                except ValueError as exception:
+                    m_logger.warning("Skipping line %d of \"%s\": %s", number, filename, exception)
+                    continue
+                if fix is None or fix[0] != fields[1]:
+                    add(fix)
+                    fix = [fields[1], date, lat, lon, float("nan")]
+                if kind == "RMC":
+                    fix[1] = date
+                else:
+                    fix[4] = ele
+        add(fix)
+
+        track.sort()
+        m_logger.debug("Read %d track points from \"%s\"", len(track), filename)
+        return track
+
+    @classmethod
+    def from_file(cls, filename):
+        """Read a GPX log or, by its extension, an NMEA log"""
+        if os.path.splitext(filename)[1].lower() in NMEA_EXTENSIONS:
+            return cls.from_nmea(filename)
+        return cls.from_gpx(filename)
+
+    def records(self):
+        """Return the points as TRACK_RECORD records, see TrackStore"""
+        points = array('d', [0.0]) * (4 * len(self))
+        points[0::4] = self.times
+        points[1::4] = self.lats
+        points[2::4] = self.lons
+        points[3::4] = self.eles
+        if sys.byteorder == "big":
+            points.byteswap()
+        return points.tobytes() if hasattr(points, "tobytes") else points.tostring()
+
+NMEA_EXTENSIONS = (".nmea", ".nma")
+TRACK_EXTENSIONS = (".gpx",) + NMEA_EXTENSIONS
+
+def nmea_position(fields):
+    """
+    @param fields: NMEA "ddmm.mmmm", "N" or "S", "dddmm.mmmm", "E" or "W"
+    @param return: (lat, lon), signed, east is positive
+    """
+    lat, north, lon, east = fields
+    if north not in ("N", "S") or east not in ("E", "W"):
+        raise ValueError("Unrecognized position \"{}\"".format(",".join(fields)))
+    lat = float(lat)
+    lon = float(lon)
+    lat = (lat // 100) + (lat % 100) / 60.0
+    lon = (lon // 100) + (lon % 100) / 60.0
+    return (lat if north == "N" else -lat), (lon if east == "E" else -lon)
+
+def nmea_time(date, time_of_day):
+    """
+    @param date: NMEA "ddmmyy"
+    @param time_of_day: NMEA "hhmmss" or "hhmmss.ss", UTC
+    @param return: seconds since the epoch, as float
+    """
+    i = re.search(r'^(\d\d)(\d\d)(\d\d)$', date)
+    j = re.search(r'^(\d\d)(\d\d)(\d\d)(\.\d*)?$', time_of_day)
+    if not i or not j:
+        raise ValueError("Unrecognized time \"{} {}\"".format(date, time_of_day))
+    year = int(i.group(3))
+    seconds = calendar.timegm([year + (2000 if year < 80 else 1900), int(i.group(2)),
+                               int(i.group(1))] + [int(v) for v in j.group(1, 2, 3)])
+    if j.group(4):
+        seconds += float("0" + j.group(4))
+    return seconds
+
+# One point of a TrackStore: time, lat, lon and ele, as little endian doubles
+TRACK_RECORD = struct.Struct("<4d")
+# Points per block of a TrackStore; a lookup reads a single block
+TRACK_BLOCK = 1024
+# Number of blocks a TrackStore keeps unpacked
+TRACK_CACHE = 64
+TRACK_STORE_VERSION = 1
+
+def track_records(data):
+    """Yield the (time, lat, lon, ele) of TRACK_RECORD records"""
+    for offset in range(0, len(data) - TRACK_RECORD.size + 1, TRACK_RECORD.size):
+        yield TRACK_RECORD.unpack_from(data, offset)
+
+def utc_text(seconds):
+    """Return seconds since the epoch as ISO 8601 UTC time"""
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(seconds))
+
+class TrackStore(object):
+    """
+    The track points of many logs in one time-sorted file, kept in a
+    directory, see "addgps track-index":
+
+        store.json      the logs read, with their file key and segment
+        segments/NAME   the points of one log, as TRACK_RECORD records
+        points-N        the points of all logs, in time order
+        blocks-N        the time of every TRACK_BLOCK-th point
+
+    A lookup searches the small list of block times, then unpacks the
+    one block of the mapped points file that holds the time, so years
+    of logs cost a few kilobytes per photo. Building reads only the logs
+    which are new or changed, and merges the points of all segments into
+    a new generation N, which store.json names once it is complete.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.state = self.read_state()
+        self.blocks = None
+        self.data = None
+        self.cache = {}
+
+    def __len__(self):
+        return self.state["points"]
+
+    def path(self, *names):
+        """Return the name of a file in the store"""
+        return os.path.join(self.directory, *names)
+
+    def read_state(self):
+        """Return the contents of store.json, or those of an empty store"""
+        try:
+            with open(self.path("store.json")) as stream:
+                state = json.load(stream)
+        except (IOError, OSError):
+            return {"version": TRACK_STORE_VERSION, "generation": 0, "points": 0,
+                    "block": TRACK_BLOCK, "sources": {}}
+        except ValueError:
+            state = None
+        if not isinstance(state, dict) or state.get("version") != TRACK_STORE_VERSION:
+            raise ValueError("\"{}\" is not a track store".format(self.directory))
+        return state
+
+    def write(self, name, data):
+        """Replace a file of the store by data"""
+        handle, tempname = tempfile.mkstemp(dir=self.directory)
+        try:
+            with os.fdopen(handle, "wb") as stream:
+                stream.write(data)
+            os.rename(tempname, self.path(name))
+        except BaseException:
+            os.remove(tempname)
+            raise
+
+    def build(self, paths):
+        """
+        Read the logs in paths which are new or changed since the last
+        build, drop the logs below them which are gone, and merge the
+        points of all logs.
+
+        @param paths: list of log files and directories to look for logs in
+        @param return: (number of logs read, number of logs dropped, number of failures)
+        """
+        sources = self.state["sources"]
+        if not os.path.isdir(self.path("segments")):
+            os.makedirs(self.path("segments"))
+        read = failed = 0
+        for filename in walk_files(paths, recursive=True, extensions=TRACK_EXTENSIONS):
+            path = os.path.abspath(filename)
+            try:
+                key = list(file_key(os.stat(path)))
+                if path in sources and sources[path]["key"] == key:
+                    continue
+                track = GPSTrack.from_file(path)
+            except (IOError, OSError, ElementTree.ParseError) as exception:
+                m_logger.error("Cannot read \"%s\": %s", path, exception)
+                failed += 1
+                continue
+            segment = binascii.hexlify(os.urandom(8)).decode("ascii")
+            self.write(os.path.join("segments", segment), track.records())
+            self.drop(path)
+            sources[path] = {"key": key, "segment": segment, "points": len(track),
+                             "first": track.times[0] if track else None,
+                             "last": track.times[-1] if track else None}
+            m_logger.debug("Read %d track points from \"%s\"", len(track), path)
+            read += 1
+
+        # Only logs below the paths given are gone; those of a directory
+        # which is missing altogether, like an unmounted disk, are kept
+        roots = [os.path.join(os.path.abspath(path), "") for path in paths
+                 if os.path.isdir(path)]
+        gone = [path for path in sources if not os.path.exists(path) and
+                any(path.startswith(root) for root in roots)]
+        for path in gone:
+            m_logger.debug("Dropping \"%s\"", path)
+            self.drop(path)
+        if read or gone:
+            self.merge()
+        return read, len(gone), failed
+
+    def drop(self, path):
+        """Forget a log and remove its segment"""
+        entry = self.state["sources"].pop(path, None)
+        if entry is not None:
+            os.remove(self.path("segments", entry["segment"]))
+
+    def merge(self):
+        """Merge the points of all segments into a new generation"""
+        entries = sorted((entry for entry in self.state["sources"].values() if entry["points"]),
+                         key=lambda entry: (entry["first"], entry["last"]))
+        generation = self.state["generation"] + 1
+        points = "points-{}".format(generation)
+        handle, tempname = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(handle, "wb") as stream:
+            if all(a["last"] <= b["first"] for a, b in zip(entries, entries[1:])):
+                # Logs one after the other, as usual: just concatenate them
+                for entry in entries:
+                    with open(self.path("segments", entry["segment"]), "rb") as segment:
+                        shutil.copyfileobj(segment, stream)
+            else:
+                merged = heapq.merge(*[track_records(map_file(self.path("segments",
+                                                                        entry["segment"])))
+                                       for entry in entries])
+                for chunk in iter(lambda: list(islice(merged, BATCH_SIZE)), []):
+                    stream.write(b"".join(TRACK_RECORD.pack(*point) for point in chunk))
+        os.rename(tempname, self.path(points))
+
+        count = sum(entry["points"] for entry in entries)
+        times = []
+        if count:
+            data = map_file(self.path(points))
+            try:
+                times = [TRACK_RECORD.unpack_from(data, offset)[0] for offset in
+                         range(0, count * TRACK_RECORD.size, TRACK_BLOCK * TRACK_RECORD.size)]
+            finally:
+                data.close()
+        self.write("blocks-{}".format(generation),
+                   struct.pack("<{}d".format(len(times)), *times))
+
+        old = self.state["generation"]
+        self.state.update(generation=generation, points=count, block=TRACK_BLOCK)
+        self.write("store.json", json.dumps(self.state, indent=1, sort_keys=True).encode("utf-8"))
+        for name in ("points-{}".format(old), "blocks-{}".format(old)):
+            if os.path.exists(self.path(name)):
+                os.remove(self.path(name))
+        self.close()
+
+    def open(self):
+        """Map the points of the current generation, if not done yet"""
+        if self.blocks is not None:
+            return
+        generation = self.state["generation"]
+        blocks = array('d')
+        if self.state["points"]:
+            with open(self.path("blocks-{}".format(generation)), "rb") as stream:
+                data = stream.read()
+            blocks.extend(struct.unpack("<{}d".format(len(data) // 8), data))
+            self.data = map_file(self.path("points-{}".format(generation)))
+        self.blocks = blocks
+
+    def close(self):
+        """Unmap the points"""
+        if self.data is not None:
+            self.data.close()
+        self.blocks = self.data = None
+        self.cache.clear()
+
+    def block(self, number):
+        """Return block number, and the first point of the next one, as a GPSTrack"""
+        track = self.cache.get(number)
+        if track is None:
+            if len(self.cache) >= TRACK_CACHE:
+                self.cache.clear()
+            start = number * self.state["block"]
+            count = min(self.state["block"] + 1, self.state["points"] - start)
+            values = struct.unpack_from("<{}d".format(4 * count), self.data,
+                                        start * TRACK_RECORD.size)
+            track = GPSTrack()
+            track.times = array('d', values[0::4])
+            track.lats = array('d', values[1::4])
+            track.lons = array('d', values[2::4])
+            track.eles = array('d', values[3::4])
+            self.cache[number] = track
+        return track
+
+    def locate(self, time_, max_gap=MAX_GAP):
+        """See GPSTrack.locate"""
+        self.open()
+        if not self.blocks:
+            return None
+        number = max(bisect_right(self.blocks, time_) - 1, 0)
+        return self.block(number).locate(time_, max_gap)
+
+    def locate_all(self, times, max_gap=MAX_GAP):
+        """See GPSTrack.locate_all"""
+        return [None if time_ is None else self.locate(time_, max_gap) for time_ in times]
+
+def gps_from_degrees(lat, lon, ele=None):
+    """
+    @param lat: signed latitude, north is positive
+    @param lon: signed longitude, east is positive
+    @param ele: elevation in meters, None or NaN if unknown
+    @param return: (GPSLatitude, GPSLongitude, GPSAltitude)
+    """
+    lat, lon = degrees_text(lat, lon)
+    return (GPSLatitude(lat), GPSLongitude(lon),
+            GPSAltitude(None if ele is None or math.isnan(ele) else "{:.1f}".format(ele)))
+
+def geotag_from_track(files, track, args, engine=None, manifest=None, snapper=None,     #pylint: disable=too-many-arguments
+                      plan=None):
+    """
+    Add the position each file was taken at according to a track log.
+
+    @param files: iterable of file names
+    @param track: GPSTrack or TrackStore
+    @param args: parsed command line arguments
+    @param engine: ExiftoolEngine or ExiftoolPool to run the commands with
+    @param manifest: Manifest of files tagged before, or None
+    @param snapper: AliasSnapper to snap the positions with, or None
+    @param plan: PlanWriter to record the jobs in instead of writing them, or None
+    @param return: generator of FileResult, in the order of files
+    """
+    offset = parse_time_offset(args.time_offset)
+    files = iter(files)
+    while True:
+        batch = list(islice(files, BATCH_SIZE))
+        if not batch:
+            return
+
+        results = dict((filename, FileResult(filename, 1, "Not a file")) for filename in batch)
+        readable = [filename for filename in batch if not bad_filename(filename, args.dryrun)]
+        times = [parse_exif_time(tags.get("DateTimeOriginal"), offset)
+                 for _, tags in read_tags(readable, ["-DateTimeOriginal"], engine)]
+        positions = track.locate_all(times, args.max_gap)
+
+        jobs = []
+        for filename, time_, position in zip(readable, times, positions):
+            if time_ is None:
+                results[filename] = FileResult(filename, 1, "No DateTimeOriginal")
+            elif position is None:
+                results[filename] = FileResult(filename, 1, "Not covered by the track log")
+            else:
+                jobs.append((filename, gps_arguments(*gps_from_degrees(*position))))
+        if snapper is not None:
+            jobs = list(snapper.jobs(jobs))
+
+        for result in write_jobs(jobs, args, engine, manifest, plan):
+            results[result.filename] = result
+        for filename in batch:
+            yield results[filename]
+
+def coordinate_text(value):
+    """Return a coordinate from a mapping record as a string for GPSxyz"""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        return "{:.8f}".format(value).rstrip("0").rstrip(".")
+    return "{}".format(value).strip()
+
+def mapping_records(lines, mapping_format=None):
+    """
+    Parse mapping lines as they come in.
+
+    @param lines: iterable of lines, CSV or JSON Lines
+    @param mapping_format: "csv", "jsonl" or None to guess from the first line
+    @param return: generator of (line number, list of fields); the fields are
+                   [path, lat, lon, alt] or [path, alias], None if unparseable
+    """
+    lines = iter(lines)
+    first = next(lines, "")
+    if mapping_format is None:
+        mapping_format = "jsonl" if first.lstrip().startswith("{") else "csv"
+    lines = chain([first], lines)
+
+    if mapping_format == "csv":
+        numbered = ((n, line) for n, line in enumerate(lines, 1)
+                    if line.strip() and not line.lstrip().startswith("#"))
+        numbers = []
+        def source():
+            """Feed csv.reader, remembering line numbers"""
+            for number, line in numbered:
+                numbers.append(number)
+                yield line
+        for row in csv.reader(source()):
+            number = numbers[-1]
+            del numbers[:]
+            if number == 1 and row and row[0].strip().lower() in ("path", "file", "filename"):
+                continue   # header
+            yield number, row
+        return
+
+    for number, line in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if "alias" in record and "lat" not in record:
+                yield number, [record["path"], record["alias"]]
+            else:
+                yield number, [record["path"], coordinate_text(record["lat"]),
+                               coordinate_text(record["lon"]),
+                               coordinate_text(record.get("alt"))]
+        except (ValueError, KeyError, TypeError, AttributeError) as exception:
+            m_logger.error("Line %d of the mapping: %s", number, exception)
+            yield number, None
+
+def mapping_jobs(lines, alias_dict, mapping_format=None, batch_size=1):
+    """
+    Turn mapping lines into jobs for run_jobs, validating every record.
+
+    @param lines: iterable of lines, CSV or JSON Lines
+    @param alias_dict: dictionary of aliases, see handle_aliases
+    @param mapping_format: "csv", "jsonl" or None to guess from the first line
+    @param batch_size: number of records parsed together by parse_coordinates_batch;
+                       1 handles every line as soon as it is read
+    @param return: generator of (file name, list of exiftool arguments or None)
+    """
+    records = mapping_records(lines, mapping_format)
+    while True:
+        rows = []
+        for number, fields in records:
+            if not fields:
+                continue
+            try:
+                fields = [field.strip() for field in fields]
+                if len(fields) == 2:
+                    if fields[1] in alias_dict:
+                        lat, lon, alt = alias_dict[fields[1]]
+                    elif geohash_coordinates(fields[1]):
+                        lat, lon = geohash_coordinates(fields[1])
+                        alt = ""
+                    else:
+                        raise ValueError("Unknown alias \"{}\"".format(fields[1]))
+                elif len(fields) in (3, 4):
+                    lat, lon, alt = (fields[1:] + [""])[:3]
+                else:
+                    raise ValueError("Expected path, latitude, longitude and altitude, "
+                                     "or path and alias")
+                rows.append((number, fields[0], lat, lon, alt))
+            except ValueError as exception:
+                m_logger.error("Line %d of the mapping: %s", number, exception)
+                rows.append((number, fields[0], None, None, None))
+            if len(rows) >= batch_size:
+                break
+        if not rows:
+            return
+
+        valid = [row for row in rows if row[2] is not None]
+        batch = parse_coordinates_batch([row[2] for row in valid], [row[3] for row in valid],
+                                        [row[4] for row in valid])
+        arguments = {}
+        for index, (number, _, _, _, _) in enumerate(valid):
+            arguments[number] = batch_arguments(batch, index)
+            if index in batch.messages:
+                m_logger.error("Line %d of the mapping: %s", number, batch.messages[index])
+        for number, filename, _, _, _ in rows:
+            yield filename, arguments.get(number)
+
+def open_mapping(name):
+    """Return the stream to read a mapping from, "-" being stdin"""
+    if name == "-":
+        return sys.stdin
+    return open(name)
+
+def read_lines(stream):
+    """
+    Iterate over the lines of a stream without reading ahead, so
+    lines are handled as soon as a producer writes them.
+    """
+    return iter(stream.readline, "")
+
+class StreamedLines(object):
+    """
+    The lines of a mapping piped in, read in a thread of their own as
+    the producer writes them. Stages which handle jobs a batch at a
+    time ask ready whether their next job is there already, and pass
+    on a partial batch rather than wait for the producer, see batches.
+    """
+    def __init__(self, stream):
+        self.lines = queue.Queue()
+        # Jobs made of the lines so far, see count
+        self.made = 0
+        thread = threading.Thread(target=self.read, args=(stream,))
+        thread.daemon = True
+        thread.start()
+
+    def read(self, stream):
+        """Thread body"""
+        try:
+            for line in read_lines(stream):
+                self.lines.put(line)
+        except Exception as exception:       #pylint: disable=broad-except
+            self.lines.put(exception)
+        self.lines.put(None)
+
+    def __iter__(self):
+        while True:
+            try:
+                # A timeout keeps Ctrl-C working
+                line = self.lines.get(True, 0.1)
+            except queue.Empty:
+                continue
+            if isinstance(line, Exception):
+                raise line
+            if line is None:
+                self.lines.put(None)
+                return
+            yield line
+
+    def count(self, jobs):
+        """Pass on the jobs made of the lines, counting them"""
+        for job in jobs:
+            self.made += 1
+            yield job
+
+    def ready(self, taken):
+        """
+        Tell if a stage which took so many jobs can have the next one
+        without waiting: a stage before it holds one, or a line was
+        read already.
+        """
+        return taken < self.made or not self.lines.empty()
+
+def add_gps_to_file(filename, lat, lon, alt, dryrun, engine=None, native=False):       #pylint: disable=too-many-arguments
+    """
+    @param filename: string containing one file name
+    @param lat: Latitude, in exiftool-acceptable format
+    @param lon: Longitude, in exiftool-acceptable format
+    @param alt: Altitude, in exiftool-acceptable format
+    @param dryrun: boolean which defines if files should be changed (False) or not (True)
+    @param engine: ExiftoolEngine to run the command with
+    @param native: boolean, write JPEG files without exiftool where possible
+    @param return: error value
+    """
+
+    if bad_filename(filename, dryrun):
+        return
+#    import pdb; pdb.set_trace()
+
+    cmdlist = [EXIFTOOL,]
+    cmdlist.extend(lat.arguments())
+    cmdlist.extend(lon.arguments())
+    cmdlist.extend(alt.arguments())
+    cmdlist.append(filename)
+
+    if native:
+        result = native_job(filename, cmdlist[1:-1], dryrun)
+        if result is not None:
+            m_logger.info("Wrote GPS tags to \"%s\" without exiftool", filename)
+            return result.returncode
+
+    m_logger.info("Processing command \"%s\"", cmdlist)
+
+    if not dryrun:
+        retcode = run_exiftool(cmdlist, engine)
+    else:
+        retcode = 0
+
+    return retcode
+
+def remove_gps_from_file(filename, dryrun, engine=None):
+    """
+    @param filename: string containing one file name
+    @param dryrun: boolean which defines if files should be changed (False) or not (True)
+    @param engine: ExiftoolEngine to run the command with
+    @param return: error value
+    """
+    m_logger.debug("Removing gps info from \"%s\"", filename)
+    cmd = [EXIFTOOL,
+           "-GPS*=",
+           filename]
+
+    m_logger.info("Processing command \"%s\"", cmd)
+
+    if not dryrun:
+        retcode = run_exiftool(cmd, engine)
+    else:
         retcode = 0
 
     return retcode
 
+ALIAS_DEFINITION = re.compile(
+    r'^\s*(\w+)\s*=\s*([^\s,]+)\s*,\s*([^\s,]+)\s*,?\s*((?:\d+f?)?)\s*$')
+
 def handle_aliases(alias_list):
     """Given a list of alias definitions, make a dictionary from them."""
     m_logger.debug("alias_list is %s", alias_list)
     aliases = dict()
     for alias in alias_list:
-        i = re.search(r'^\s*(\w+)\s*=\s*([^\s,]+)\s*,\s*([^\s,]+)\s*,?\s*((?:\d+f?)?)\s*$', alias)
+        i = ALIAS_DEFINITION.search(alias)
         if i:
             aliases[i.group(1)] = (i.group(2), i.group(3), i.group(4))
         else:
@@ -404,6 +4330,804 @@ def handle_aliases(alias_list):
 
     return aliases
 
+def alias_definitions(lines):
+    """
+    Parse the lines of an alias file, skipping blank lines and comments.
+
+    @param lines: iterable of lines, either "name=lat, lon[, alt]" as for
+                  --alias or CSV "name, lat, lon[, alt]"
+    @param return: generator of (line number, name, (lat, lon, alt)), the
+                   name being None for a line which isn't an alias
+    """
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        if "=" not in line:
+            line = line.replace(",", "=", 1)
+        i = ALIAS_DEFINITION.search(line)
+        if i:
+            yield number, i.group(1), (i.group(2), i.group(3), i.group(4))
+        else:
+            yield number, None, line
+
+def config_directory():
+    """Return the directory addgps keeps its configuration in"""
+    base = os.environ.get("XDG_CONFIG_HOME") or os.path.join(os.path.expanduser("~"), ".config")
+    return os.path.join(base, "addgps")
+
+def alias_store_path(args):
+    """Return the alias store to use, from --alias-file or the configuration directory"""
+    return args.alias_file or os.path.join(config_directory(), "aliases")
+
+def track_store_path():
+    """Return the track store used by default"""
+    base = (os.environ.get("XDG_DATA_HOME") or
+            os.path.join(os.path.expanduser("~"), ".local", "share"))
+    return os.path.join(base, "addgps", "tracks")
+
+def gazetteer_path(args):
+    """Return the gazetteer to use, from --gazetteer or the data directory"""
+    return args.gazetteer or os.path.join(os.path.dirname(track_store_path()), "gazetteer")
+
+def write_atomically(filename, data):
+    """Replace filename by data, logging instead of failing if that's impossible"""
+    try:
+        handle, tempname = tempfile.mkstemp(dir=os.path.dirname(filename) or ".")
+        with os.fdopen(handle, "wb") as stream:
+            stream.write(data)
+        os.rename(tempname, filename)
+    except (IOError, OSError) as exception:
+        m_logger.debug("Could not write \"%s\": %s", filename, exception)
+
+class AliasStore(object):
+    """
+    Aliases kept in a text file, one "name=lat, lon[, alt]" per line.
+
+    Loading parses a binary copy (marshal) kept next to the file, which
+    is rebuilt whenever the file's inode, size or modification time change.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.cachename = filename + ".cache"
+
+    def load(self):
+        """
+        @param return: dictionary of aliases like handle_aliases, empty if
+                       there is no alias file
+        """
+        try:
+            key = (sys.version_info[0],) + file_key(os.stat(self.filename))
+        except OSError:
+            return {}
+
+        try:
+            with open(self.cachename, "rb") as cache:
+                cached = marshal.load(cache)
+            if cached[0] == key:
+                return dict(zip(cached[1], zip(*cached[2:])))
+        except (IOError, OSError, EOFError, ValueError, TypeError, IndexError):
+            pass
+
+        aliases = {}
+        with open(self.filename) as stream:
+            for number, name, value in alias_definitions(stream):
+                if name is None:
+                    m_logger.error("Line %d of \"%s\": unrecognized alias \"%s\"",
+                                   number, self.filename, value)
+                else:
+                    aliases[name] = value
+        self.write_cache(key, aliases)
+        return aliases
+
+    def write_cache(self, key, aliases):
+        """Store aliases in binary form, if the directory is writable"""
+        names = sorted(aliases)
+        columns = tuple(zip(*[aliases[name] for name in names])) or ((), (), ())
+        write_atomically(self.cachename, marshal.dumps((key, tuple(names)) + columns))
+
+    def index(self, aliases, overrides=None):
+        """
+        Return the AliasIndex of the aliases, cached next to the store.
+
+        @param aliases: dictionary of the aliases of the store, updated by overrides
+        @param overrides: dictionary of the aliases given on the command line
+        """
+        overrides = tuple(sorted((overrides or {}).items()))
+        try:
+            key = (sys.version_info[0],) + file_key(os.stat(self.filename)) + (overrides,)
+        except OSError:
+            return AliasIndex.from_aliases(aliases)
+
+        indexname = self.filename + ".index"
+        try:
+            with open(indexname, "rb") as stream:
+                if marshal.load(stream) == key:
+                    return AliasIndex.loads(stream.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+
+        index = AliasIndex.from_aliases(aliases)
+        write_atomically(indexname, marshal.dumps(key) + index.dumps())
+        return index
+
+    def save(self, aliases):
+        """Replace the aliases in the store"""
+        directory = os.path.dirname(self.filename) or "."
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        handle, tempname = tempfile.mkstemp(dir=directory)
+        with os.fdopen(handle, "w") as stream:
+            for name in sorted(aliases):
+                lat, lon, alt = aliases[name]
+                stream.write("{}={}, {}{}\n".format(name, lat, lon, ", " + alt if alt else ""))
+        os.rename(tempname, self.filename)
+
+EARTH_RADIUS = 6371008.8    # mean radius in meters
+
+def unit_vector(lat, lon):
+    """Return the point on the unit sphere at signed lat and lon, in degrees"""
+    lat = math.radians(lat)
+    lon = math.radians(lon)
+    return (math.cos(lat) * math.cos(lon), math.cos(lat) * math.sin(lon), math.sin(lat))
+
+def chord_length(distance):
+    """Return the straight line length of a great circle distance in meters on the unit sphere"""
+    return 2 * math.sin(min(distance / EARTH_RADIUS, math.pi) / 2)
+
+def arc_distance(chord):
+    """Return the great circle distance in meters of a chord on the unit sphere"""
+    return 2 * EARTH_RADIUS * math.asin(min(chord / 2, 1.0))
+
+class AliasIndex(object):
+    """
+    k-d tree of alias positions, as points on the unit sphere so that
+    straight line distances order like great circle distances.
+
+    The tree is implicit: in every range of the point arrays the middle
+    point splits the rest by the coordinate of its depth, the points
+    before it being smaller. Nothing but the point arrays needs storing.
+    """
+    def __init__(self, names, xs, ys, zs):
+        self.names = names
+        self.columns = tuple(column if isinstance(column, (array, memoryview))
+                             else array('d', column) for column in (xs, ys, zs))
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_aliases(cls, aliases):
+        """Build the tree of a dictionary of aliases, see handle_aliases"""
+        names = sorted(aliases)
+        batch = parse_coordinates_batch([aliases[name][0] for name in names],
+                                        [aliases[name][1] for name in names])
+        points = []
+        for row, name in enumerate(names):
+            if batch.errors[row]:
+                m_logger.warning("Alias \"%s\": %s", name, batch.messages[row])
+                continue
+            lat = batch.latitudes[row] * (-1 if batch.latitude_refs[row] == 'S' else 1)
+            lon = batch.longitudes[row] * (-1 if batch.longitude_refs[row] == 'W' else 1)
+            points.append(unit_vector(lat, lon) + (name,))
+        return cls.from_points(points)
+
+    @classmethod
+    def from_points(cls, points):
+        """
+        Build the tree of a list of (x, y, z, name), which it reorders.
+        See unit_vector for x, y and z.
+        """
+        ranges = [(0, len(points), 0)]
+        while ranges:
+            low, high, axis = ranges.pop()
+            if high - low > 1:
+                points[low:high] = sorted(points[low:high], key=lambda point: point[axis])
+                middle = (low + high) // 2
+                ranges.append((low, middle, (axis + 1) % 3))
+                ranges.append((middle + 1, high, (axis + 1) % 3))
+        columns = list(zip(*points)) or [(), (), (), ()]
+        return cls(list(columns[3]), *columns[:3])
+
+    def nearest(self, lat, lon, count=1, radius=None):
+        """
+        @param lat: signed latitude, north is positive
+        @param lon: signed longitude, east is positive
+        @param count: largest number of aliases to return, None for all
+        @param radius: largest distance in meters, None for any
+        @param return: list of (distance in meters, alias name), nearest first
+        """
+        target = unit_vector(lat, lon)
+        limit = 5.0 if radius is None else chord_length(radius) ** 2
+        found = []  # heap of (-squared distance, index)
+        xs, ys, zs = columns = self.columns
+
+        def bound():
+            """Return the squared distance a point has to be within to be found"""
+            if count is not None and len(found) >= count:
+                return min(limit, -found[0][0])
+            return limit
+
+        def search(low, high, axis):
+            """Find the points in the subtree of a range"""
+            if low >= high:
+                return
+            middle = (low + high) // 2
+            distance = ((xs[middle] - target[0]) ** 2 + (ys[middle] - target[1]) ** 2 +
+                        (zs[middle] - target[2]) ** 2)
+            if distance <= bound():
+                if count is not None and len(found) >= count:
+                    heapq.heapreplace(found, (-distance, middle))
+                else:
+                    heapq.heappush(found, (-distance, middle))
+            difference = target[axis] - columns[axis][middle]
+            near, far = (low, middle), (middle + 1, high)
+            if difference > 0:
+                near, far = far, near
+            search(near[0], near[1], (axis + 1) % 3)
+            if difference ** 2 <= bound():
+                search(far[0], far[1], (axis + 1) % 3)
+
+        if count != 0:
+            search(0, len(self.names), 0)
+        return [(arc_distance(math.sqrt(-distance)), self.names[index])
+                for distance, index in sorted(found, reverse=True)]
+
+    def within(self, lat, lon, radius):
+        """Return all aliases within radius meters, nearest first, see nearest"""
+        return self.nearest(lat, lon, None, radius)
+
+    def dumps(self):
+        """Return the tree in binary form, see loads"""
+        return marshal.dumps((tuple(self.names),) + tuple(tuple(column) for column in self.columns))
+
+    @classmethod
+    def loads(cls, data):
+        """Return the tree stored by dumps"""
+        names, xs, ys, zs = marshal.loads(data)
+        return cls(list(names), xs, ys, zs)
+
+class AliasSnapper(object):
+    """Replace coordinates by those of the nearest alias within a radius"""
+    def __init__(self, aliases, index, radius):
+        self.aliases = aliases
+        self.index = index
+        self.radius = radius
+        self.arguments = dict()
+
+    def snap(self, arguments):
+        """
+        @param arguments: exiftool arguments writing a position, see gps_arguments
+        @param return: (arguments, (distance, alias name) or None) where the
+                       arguments are those of the alias the position snapped to
+        """
+        tags = argument_tags(arguments)
+        position = signed_coordinates(tags) if tags else None
+        if position is None:
+            return arguments, None
+        found = self.index.nearest(position[0], position[1], 1, self.radius)
+        if not found:
+            return arguments, None
+        name = found[0][1]
+        if name not in self.arguments:
+            lat, lon, alt = self.aliases[name]
+            self.arguments[name] = gps_arguments(GPSLatitude(lat), GPSLongitude(lon),
+                                                 GPSAltitude(alt))
+        return self.arguments[name], found[0]
+
+    def jobs(self, jobs):
+        """Snap the arguments of jobs, see run_jobs"""
+        for filename, arguments in jobs:
+            if arguments is not None:
+                arguments, found = self.snap(arguments)
+                if found:
+                    m_logger.debug("Snapped \"%s\" to alias \"%s\", %.0f m away",
+                                   filename, found[1], found[0])
+            yield filename, arguments
+
+def alias_snapper(args, aliases):
+    """Return the AliasSnapper for --snap, None if not snapping"""
+    if not args.snap:
+        return None
+    index = AliasStore(alias_store_path(args)).index(aliases, handle_aliases(args.alias))
+    return AliasSnapper(aliases, index, args.snap)
+
+def load_aliases(args):
+    """Return the aliases of the store, overridden by those given with --alias"""
+    aliases = AliasStore(alias_store_path(args)).load()
+    aliases.update(handle_aliases(args.alias))
+    return aliases
+
+def valid_aliases(definitions):
+    """
+    Check the coordinates of new aliases, all at once.
+
+    @param definitions: list of (description, name, (lat, lon, alt))
+    @param return: (dictionary of valid aliases, number of invalid ones)
+    """
+    batch = parse_coordinates_batch([value[0] for _, _, value in definitions],
+                                    [value[1] for _, _, value in definitions],
+                                    [value[2] for _, _, value in definitions])
+    aliases = {}
+    for row, (description, name, value) in enumerate(definitions):
+        if batch.errors[row]:
+            m_logger.error("%s: %s", description, batch.messages[row])
+        else:
+            aliases[name] = value
+    return aliases, len(definitions) - len(aliases)
+
+def print_nearest_aliases(targets, index, count=1, radius=None, engine=None):     #pylint: disable=too-many-arguments
+    """
+    Print the aliases nearest to files or positions.
+
+    @param targets: list of file names or "lat, lon" strings
+    @param index: AliasIndex
+    @param count: number of aliases to print per target
+    @param radius: largest distance in meters, None for any
+    @param engine: ExiftoolEngine to read files other than JPEG with
+    @param return: number of targets without a position
+    """
+    files = [target for target in targets if os.path.isfile(target)]
+    positions = read_gps_bulk(files, engine) if files else {}
+    failed = 0
+    for target in targets:
+        position = positions.get(target)
+        if target not in positions:
+            try:
+                lat, lon = extract_coords_from_argument(target)
+                position = signed_coordinates(argument_tags(
+                    GPSLatitude(lat).arguments() + GPSLongitude(lon).arguments()))
+            except ValueError:
+                position = None
+        if position is None:
+            print("{}: no GPS position".format(target))
+            failed += 1
+            continue
+        found = index.nearest(position[0], position[1], count, radius)
+        print("{}: {}".format(target, ", ".join(
+            "{} ({:.0f} m)".format(name, distance) for distance, name in found) or "no alias"))
+    return failed
+
+def alias_command(arglist):
+    """Maintain the alias store: "alias add|remove|import|list" """
+    parser = ArgumentParser(prog=os.path.basename(sys.argv[0]) + " alias",
+                            description="Maintain the aliases kept in the alias store.")
+    parser.add_argument("--alias-file", dest="alias_file", metavar="FILE",
+                        help=("alias store to use. Default is " +
+                              "$XDG_CONFIG_HOME/addgps/aliases."))
+    parser.add_argument("-v", "--verbose", dest="verbose", action="store_true",
+                        help="enable verbose mode")
+    parser.add_argument("-q", "--quiet", dest="quiet", action="store_true",
+                        help="enable quiet mode")
+    commands = parser.add_subparsers(dest="command")
+    command = commands.add_parser("add", help="add or replace aliases")
+    command.add_argument("definitions", nargs="+", metavar="NAME=LAT,LON[,ALT]")
+    command = commands.add_parser("remove", help="remove aliases")
+    command.add_argument("names", nargs="+", metavar="NAME")
+    command = commands.add_parser(
+        "import", help=("add the aliases in files (\"-\" for stdin), one " +
+                        "\"name=lat, lon[, alt]\" or \"name, lat, lon[, alt]\" per line"))
+    command.add_argument("files", nargs="+", metavar="FILE")
+    commands.add_parser("list", help="print the aliases")
+    command = commands.add_parser(
+        "near", help="print the aliases nearest to files or to \"lat, lon\" positions")
+    command.add_argument("-k", dest="count", type=int, default=1,
+                         help="number of aliases to print. Default is %(default)s.")
+    command.add_argument("--radius", dest="radius", type=float, metavar="METERS",
+                         help="only print aliases within this distance")
+    command.add_argument("targets", nargs="+", metavar="FILE|LAT,LON")
+    args = parser.parse_args(arglist)
+    if args.command is None:
+        parser.error("a command is required: add, remove, import, list or near")
+    args.logfile = None
+    initialize_logging(args)
+
+    store = AliasStore(alias_store_path(args))
+    aliases = store.load()
+    failed = 0
+    if args.command == "list":
+        for name in sorted(aliases):
+            print("{}={}, {}{}".format(name, aliases[name][0], aliases[name][1],
+                                       ", " + aliases[name][2] if aliases[name][2] else ""))
+        return 0
+    elif args.command == "near":
+        with ExiftoolEngine() as engine:
+            failed = print_nearest_aliases(args.targets, store.index(aliases), args.count,
+                                           args.radius, engine)
+        return 1 if failed else 0
+    elif args.command == "remove":
+        for name in args.names:
+            if aliases.pop(name, None) is None:
+                m_logger.error("No alias \"%s\"", name)
+                failed += 1
+    else:
+        if args.command == "add":
+            definitions = [(definition, name, value) for definition in args.definitions
+                           for _, name, value in alias_definitions([definition])]
+        else:
+            definitions = []
+            for filename in args.files:
+                stream = open_mapping(filename)
+                try:
+                    for number, name, value in alias_definitions(stream):
+                        definitions.append(("Line {} of \"{}\"".format(number, filename),
+                                            name, value))
+                finally:
+                    if stream is not sys.stdin:
+                        stream.close()
+        for description, name, value in definitions:
+            if name is None:
+                m_logger.error("%s: unrecognized alias \"%s\"", description, value)
+                failed += 1
+        new, invalid = valid_aliases([d for d in definitions if d[1] is not None])
+        failed += invalid
+        aliases.update(new)
+        m_logger.info("Added %d aliases", len(new))
+
+    store.save(aliases)
+    return 1 if failed else 0
+
+def track_index_command(arglist):
+    """Maintain the track store: "track-index build|list" """
+    parser = ArgumentParser(prog=os.path.basename(sys.argv[0]) + " track-index",
+                            description=("Maintain the store of track logs which " +
+                                         "--track-index takes the coordinates from."))
+    parser.add_argument("--track-store", dest="track_store", metavar="DIR",
+                        help=("track store to use. Default is " +
+                              "$XDG_DATA_HOME/addgps/tracks."))
+    parser.add_argument("-v", "--verbose", dest="verbose", action="store_true",
+                        help="enable verbose mode")
+    parser.add_argument("-q", "--quiet", dest="quiet", action="store_true",
+                        help="enable quiet mode")
+    commands = parser.add_subparsers(dest="command")
+    command = commands.add_parser(
+        "build", help=("read the GPX and NMEA logs in directories which are new or " +
+                       "changed since the last build, and drop those which are gone"))
+    command.add_argument("paths", nargs="+", metavar="DIR|FILE")
+    commands.add_parser("list", help="print the logs in the store")
+    args = parser.parse_args(arglist)
+    if args.command is None:
+        parser.error("a command is required: build or list")
+    args.logfile = None
+    initialize_logging(args)
+
+    try:
+        store = TrackStore(args.track_store or track_store_path())
+    except ValueError as exception:
+        m_logger.error("%s", exception)
+        return 1
+    if args.command == "list":
+        for path, entry in sorted(store.state["sources"].items()):
+            print("{}: {} points{}".format(path, entry["points"], ", {} to {}".format(
+                utc_text(entry["first"]), utc_text(entry["last"])) if entry["points"] else ""))
+        return 0
+
+    if not os.path.isdir(store.directory):
+        os.makedirs(store.directory)
+    read, dropped, failed = store.build(args.paths)
+    m_logger.info("Read %d logs, dropped %d; %d track points in the store",
+                  read, dropped, len(store))
+    return 1 if failed else 0
+
+GAZETTEER_MAGIC = b"ADDGPSGZ"
+GAZETTEER_VERSION = 1
+# magic, version, number of places, number of strings, reserved
+GAZETTEER_HEADER = struct.Struct("<8sIIII")
+# Nearest place --geocode looks for, in meters
+GEOCODE_RADIUS = 50000
+# The tags --geocode writes: the field of the place they take (city,
+# state, country) and the longest value IPTC allows, in bytes
+LOCATION_TAGS = (("XMP-photoshop:City", 0, None),
+                 ("XMP-photoshop:State", 1, None),
+                 ("XMP-photoshop:Country", 2, None),
+                 ("IPTC:City", 0, 32),
+                 ("IPTC:Province-State", 1, 32),
+                 ("IPTC:Country-PrimaryLocationName", 2, 64))
+
+def mapped_doubles(data, offset, count):
+    """
+    Return count little endian doubles of a mapped file as a sequence,
+    without copying them where memoryview can
+    """
+    if hasattr(memoryview, "cast") and sys.byteorder == "little":
+        return memoryview(data)[offset:offset + 8 * count].cast("d")
+    return array('d', struct.unpack_from("<{}d".format(count), data, offset))
+
+class GazetteerPlaces(object):
+    """The (city, state, country) of the places of a Gazetteer, read as needed"""
+    def __init__(self, data, offset, count, strings):
+        self.data = data
+        self.offset = offset
+        self.count = count
+        self.strings = offset + 12 * count
+        self.text = self.strings + 4 * (strings + 1)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return tuple(self.string(number)
+                     for number in struct.unpack_from("<3I", self.data, self.offset + 12 * index))
+
+    def string(self, number):
+        """Return string number of the string table"""
+        start, end = struct.unpack_from("<2I", self.data, self.strings + 4 * number)
+        return self.data[self.text + start:self.text + end].decode("utf-8")
+
+class Gazetteer(object):
+    """
+    Places compiled by "addgps gazetteer build" for reverse geocoding.
+
+    The file holds the k-d tree of an AliasIndex, as three columns of
+    doubles, followed by the place of every point and the table of its
+    strings. It is mapped rather than read, so opening it costs next to
+    nothing and a lookup only touches the pages on its path down the
+    tree.
+
+        header (GAZETTEER_HEADER), x, y, z columns, place table of
+        (city, state, country) string numbers, string offsets, UTF-8 text
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.data = map_file(filename)
+        magic, version, count, strings, _ = GAZETTEER_HEADER.unpack_from(self.data, 0)
+        if magic != GAZETTEER_MAGIC or version != GAZETTEER_VERSION:
+            self.data.close()
+            raise ValueError("\"{}\" is not a gazetteer".format(filename))
+        offset = GAZETTEER_HEADER.size
+        self.columns = [mapped_doubles(self.data, offset + 8 * count * axis, count)
+                        for axis in range(3)]
+        self.index = AliasIndex(GazetteerPlaces(self.data, offset + 24 * count, count, strings),
+                                *self.columns)
+
+    def __len__(self):
+        return len(self.index)
+
+    def nearest(self, lat, lon, radius=GEOCODE_RADIUS):
+        """
+        @param lat: signed latitude, north is positive
+        @param lon: signed longitude, east is positive
+        @param radius: largest distance in meters
+        @param return: (distance in meters, (city, state, country)), or None
+        """
+        found = self.index.nearest(lat, lon, 1, radius)
+        return found[0] if found else None
+
+    def close(self):
+        """Unmap the file"""
+        self.index = None
+        for column in self.columns:
+            if isinstance(column, memoryview):
+                column.release()
+        self.columns = []
+        self.data.close()
+
+    @staticmethod
+    def compile(places, filename):
+        """
+        Write a gazetteer file.
+
+        @param places: iterable of (lat, lon, city, state, country)
+        @param return: number of places written
+        """
+        strings = OrderedDict()
+        points = []
+        for lat, lon, city, state, country in places:
+            numbers = tuple(strings.setdefault(text, len(strings)) for text in (city, state, country))
+            points.append(unit_vector(lat, lon) + (numbers,))
+        index = AliasIndex.from_points(points)
+
+        texts = [text.encode("utf-8") for text in strings]
+        offsets = [0]
+        for text in texts:
+            offsets.append(offsets[-1] + len(text))
+        count = len(index)
+        data = [GAZETTEER_HEADER.pack(GAZETTEER_MAGIC, GAZETTEER_VERSION, count, len(texts), 0)]
+        data.extend(struct.pack("<{}d".format(count), *column) for column in index.columns)
+        data.append(struct.pack("<{}I".format(3 * count),
+                                *[number for numbers in index.names for number in numbers]))
+        data.append(struct.pack("<{}I".format(len(offsets)), *offsets))
+        data.extend(texts)
+        handle, tempname = tempfile.mkstemp(dir=os.path.dirname(filename) or ".")
+        with os.fdopen(handle, "wb") as stream:
+            stream.write(b"".join(data))
+        os.rename(tempname, filename)
+        return count
+
+def geonames_places(stream, admin1=None, countries=None):
+    """
+    Read the populated places of a GeoNames dump, like cities1000.txt,
+    or a CSV file of "lat, lon, city, state, country" lines. Unlike
+    entered coordinates, their longitudes are positive east, as in
+    GeoNames.
+
+    @param stream: binary stream
+    @param admin1: dictionary of state names by "CC.CODE", as in admin1CodesASCII.txt
+    @param countries: dictionary of country names by ISO code, as in countryInfo.txt
+    @param return: generator of (lat, lon, city, state, country)
+    """
+    for number, line in enumerate(stream, 1):
+        line = line.decode("utf-8").rstrip("\r\n")
+        if not line.strip() or line.startswith("#"):
+            continue
+        try:
+            if "\t" in line:
+                fields = line.split("\t")
+                if fields[6] != "P":
+                    continue
+                code = fields[8]
+                yield (float(fields[4]), float(fields[5]), fields[1],
+                       (admin1 or {}).get(code + "." + fields[10], fields[10]),
+                       (countries or {}).get(code, code))
+            else:
+                fields = [field.strip() for field in line.split(",")]
+                yield (float(fields[0]), float(fields[1]), fields[2], fields[3], fields[4])
+        except (IndexError, ValueError):
+            m_logger.warning("Skipping line %d of the gazetteer: \"%s\"", number, line)
+
+def geonames_names(filename, key, name):
+    """Return a dictionary of names from a GeoNames table, by the columns of key and name"""
+    names = dict()
+    with io.open(filename, encoding="utf-8") as stream:
+        for line in stream:
+            fields = line.rstrip("\r\n").split("\t")
+            if not line.startswith("#") and len(fields) > max(key, name):
+                names[fields[key]] = fields[name]
+    return names
+
+def location_arguments(place):
+    """
+    @param place: (city, state, country)
+    @param return: exiftool arguments writing the place, see LOCATION_TAGS
+    """
+    arguments = ["-IPTC:CodedCharacterSet=UTF8"]
+    for tag, field, limit in LOCATION_TAGS:
+        # exiftool takes argfile lines as they are, quotes included
+        value = place[field]
+        if limit is not None:
+            while len(value.encode("utf-8")) > limit:
+                value = value[:-1]
+        if value:
+            arguments.append(u"-{}={}".format(tag, value))
+    return arguments
+
+class Geocoder(object):
+    """Add the place nearest to the position of jobs, see LOCATION_TAGS"""
+    def __init__(self, gazetteer, radius=GEOCODE_RADIUS):
+        self.gazetteer = gazetteer
+        self.radius = radius
+
+    def locate(self, arguments):
+        """Return the arguments writing the place near those of a position, or None"""
+        position = signed_coordinates(argument_tags(arguments) or {})
+        if position is None:
+            return None
+        found = self.gazetteer.nearest(position[0], position[1], self.radius)
+        return location_arguments(found[1]) if found else None
+
+    def jobs(self, jobs, batch_size=BATCH_SIZE, ready=None):
+        """
+        Add the place of each position to jobs, see run_jobs. Positions
+        are looked up a batch at a time, each distinct one once.
+        """
+        for batch in batches(jobs, batch_size, ready):
+            places = dict()
+            with m_stats.timer("geocode", len(batch)):
+                for _, arguments in batch:
+                    if arguments is not None and tuple(arguments) not in places:
+                        places[tuple(arguments)] = self.locate(arguments)
+            for filename, arguments in batch:
+                if arguments is not None and places[tuple(arguments)]:
+                    arguments = arguments + places[tuple(arguments)]
+                yield filename, arguments
+
+def geocoded(jobs, args, ready=None):
+    """Add the places of --geocode to jobs, see Geocoder and batches for ready"""
+    if not args.geocode:
+        return jobs
+    geocoder = Geocoder(Gazetteer(gazetteer_path(args)), args.geocode_radius)
+    return geocoder.jobs(jobs, BATCH_SIZE, ready)
+
+def gazetteer_command(arglist):
+    """Compile the gazetteer of --geocode: "gazetteer build|near" """
+    parser = ArgumentParser(prog=os.path.basename(sys.argv[0]) + " gazetteer",
+                            description="Compile the gazetteer --geocode takes places from.")
+    parser.add_argument("--gazetteer", dest="gazetteer", metavar="FILE",
+                        help=("gazetteer to use. Default is " +
+                              "$XDG_DATA_HOME/addgps/gazetteer."))
+    parser.add_argument("-v", "--verbose", dest="verbose", action="store_true",
+                        help="enable verbose mode")
+    parser.add_argument("-q", "--quiet", dest="quiet", action="store_true",
+                        help="enable quiet mode")
+    commands = parser.add_subparsers(dest="command")
+    command = commands.add_parser(
+        "build", help=("compile a GeoNames dump like cities1000.txt, or a CSV file " +
+                       "of \"lat, lon, city, state, country\" lines, longitudes east positive"))
+    command.add_argument("--admin1", dest="admin1", metavar="admin1CodesASCII.txt",
+                         help="GeoNames names of states")
+    command.add_argument("--countries", dest="countries", metavar="countryInfo.txt",
+                         help="GeoNames names of countries")
+    command.add_argument("places", metavar="FILE")
+    command = commands.add_parser("near", help="print the place nearest to \"lat, lon\"")
+    command.add_argument("--radius", dest="radius", type=float, default=GEOCODE_RADIUS,
+                         metavar="METERS",
+                         help="largest distance to the place. Default is %(default)s.")
+    command.add_argument("targets", nargs="+", metavar="LAT,LON")
+    args = parser.parse_args(arglist)
+    if args.command is None:
+        parser.error("a command is required: build or near")
+    args.logfile = None
+    initialize_logging(args)
+
+    filename = gazetteer_path(args)
+    if args.command == "build":
+        admin1 = geonames_names(args.admin1, 0, 1) if args.admin1 else None
+        countries = geonames_names(args.countries, 0, 4) if args.countries else None
+        if not os.path.isdir(os.path.dirname(filename) or "."):
+            os.makedirs(os.path.dirname(filename))
+        with open(args.places, "rb") as stream:
+            count = Gazetteer.compile(geonames_places(stream, admin1, countries), filename)
+        m_logger.info("Compiled %d places into \"%s\"", count, filename)
+        return 0
+
+    try:
+        gazetteer = Gazetteer(filename)
+    except (ValueError, IOError, OSError, NativeWriterError) as exception:
+        m_logger.error("Cannot open the gazetteer: %s", exception)
+        return 1
+    failed = 0
+    for target in args.targets:
+        try:
+            lat, lon = extract_coords_from_argument(target)
+            position = signed_coordinates(argument_tags(
+                GPSLatitude(lat).arguments() + GPSLongitude(lon).arguments()))
+        except ValueError:
+            position = None
+        if position is None:
+            m_logger.error("Not a position: \"%s\"", target)
+            failed += 1
+            continue
+        found = gazetteer.nearest(position[0], position[1], args.radius)
+        print(u"{}: {}".format(target, u"{} ({:.0f} m)".format(u", ".join(
+            text for text in found[1] if text), found[0]) if found else u"no place"))
+    gazetteer.close()
+    return 1 if failed else 0
+
+def resolve_coordinates(entered_coords, alias_dict, snapper=None):
+    """
+    @param entered_coords: "lat, lon[, alt]", an alias or a geohash, as entered
+    @param alias_dict: dictionary of alias names and (lat, lon, alt)
+    @param snapper: AliasSnapper to snap coordinates which are not an alias with, or None
+    @param return: (list of exiftool arguments, (meters, alias) snapped to or None)
+    """
+    coords = extract_coords_from_argument(entered_coords)
+
+    if len(coords) == 2:
+        lat = coords[0]
+        lon = coords[1]
+        alt = None
+    elif len(coords) == 3:
+        lat = coords[0]
+        lon = coords[1]
+        alt = coords[2]
+    elif len(coords) == 1:
+        shortcut = coords[0].strip()
+        m_logger.info("coords[0] is \"%s\"", shortcut)
+        if shortcut in alias_dict:
+            lat, lon, alt = alias_dict[shortcut]
+        elif geohash_coordinates(shortcut):
+            lat, lon = geohash_coordinates(shortcut)
+            alt = None
+        else:
+            raise ValueError("shortcut must be a geohash or an alias (press TAB to list them)")
+    else:
+        raise ValueError("please enter latitude and longitude, separated by a comma")
+
+    arguments = gps_arguments(GPSLatitude(lat), GPSLongitude(lon), GPSAltitude(alt))
+    if snapper is not None and coords[0] not in alias_dict:
+        return snapper.snap(arguments)
+    return arguments, None
+
 def set_up_input_completion(input_list):
     """Do what is necessary and possible to set up tab completion for input"""
 
@@ -413,10 +5137,11 @@ def set_up_input_completion(input_list):
     # Use the tab key for completion
     readline.parse_and_bind('tab: complete')
 
-def get_lat_lon(files, args):
+def get_lat_lon(files, args, engine=None, manifest=None, plan=None):
     """Processes user entry for adding GPS coordinates to files"""
 
-    alias_dict = handle_aliases(args.alias)
+    alias_dict = load_aliases(args)
+    snapper = alias_snapper(args, alias_dict)
 
     set_up_input_completion(alias_dict.keys())
 
@@ -431,87 +5156,571 @@ def get_lat_lon(files, args):
               "by a comma (','):     (abort with Ctrl-C)")
         #entered_coords = sys.stdin.readline().split(',')
         entered_coords = raw_input('Coordinates: ').strip()
-        coords = extract_coords_from_argument(entered_coords)
-
-        if len(coords) == 2:
-            lat = coords[0]
-            lon = coords[1]
-            alt = None
-        elif len(coords) == 3:
-            lat = coords[0]
-            lon = coords[1]
-            alt = coords[2]
-        elif len(coords) == 1:
-            shortcut = coords[0].strip()
-            m_logger.info("coords[0] is \"%s\"", shortcut)
-            if shortcut in alias_dict:
-                lat, lon, alt = alias_dict[shortcut]
-            else:
-                print("\nError: shortcut must be one of: {}".format(
-                    ", ".join(sorted(alias_dict.keys()))))
-                continue
-        else:
-            print("\nError: please enter latitude and longitude, separated by a comma")
+        try:
+            arguments, found = resolve_coordinates(entered_coords, alias_dict, snapper)
+        except ValueError as exception:
+            print("\nError: {}".format(exception))
             continue
 
+        if found:
+            print("Snapped to \"{}\", {:.0f} m away".format(found[1], found[0]))
         m_logger.debug("Adding coordinates to files ...")
-        try:
-            latitude = GPSLatitude(lat)
-            longitude = GPSLongitude(lon)
-            altitude = GPSAltitude(alt)
-            for filename in files:
-                add_gps_to_file(filename, latitude, longitude, altitude, args.dryrun)
-                break
-        except ValueError as exception:
-            print("Error: {}".format(exception))
+        return write_and_report(((filename, arguments) for filename in files),
+                                args, engine, manifest, plan)
 
+def remove_lat_lon(files, args, engine=None, manifest=None, plan=None):
+    """Processes user entry for adding GPS coordinates to files"""
+    while args.confirm:
+        print("Ok to remove GPS coordinates from files? Y/n:     (abort with Ctrl-C)")
 
-    return
+        confirmation = sys.stdin.readline().strip().lower()
 
-def remove_lat_lon(files, args):
-    """Processes user entry for adding GPS coordinates to files"""
-    while True:
-        if args.confirm:
-            print("Ok to remove GPS coordinates from files? Y/n:     (abort with Ctrl-C)")
+        if confirmation in (u'', u'y', u'yes'):
+            break
+        elif confirmation in (u'n', u'no'):
+            return 0
+        else:
+            print("Unrecognized response \"{}\"".format(confirmation))
+
+    m_logger.debug("Removing coordinates from files ...")
+    if args.within:
+        results = remove_within(files, args, engine, plan)
+    elif args.pipeline or plan is not None:
+        return write_and_report(((filename, ["-GPS*="]) for filename in files), args, engine,
+                                plan=plan)
+    else:
+        results = write_jobs(((filename, ["-GPS*="]) for filename in files), args, engine)
+    if manifest is not None and not args.dryrun:
+        results = forget_removed(results, manifest)
+    return report_results(results)
 
-            confirmation = sys.stdin.readline().strip().lower()
+def forget_removed(results, manifest):
+    """Drop files from the manifest as their GPS information is removed"""
+    for result in results:
+        if result.returncode == 0:
+            manifest.forget([os.path.abspath(result.filename)])
+        yield result
 
-            if confirmation in (u'', u'y', u'yes'):
-                pass
-            elif confirmation in (u'n', u'no'):
+def parse_geofence(text, aliases):
+    """
+    @param text: "NAME_OR_COORD:RADIUS" of --within, e.g. "home:200" or
+                 "33.36, -116.86:500", the radius in meters
+    @param aliases: dictionary of alias names and (lat, lon, alt)
+    @param return: (place as given, signed lat, signed lon, radius)
+    @raise ValueError: if text is no such geofence
+    """
+    place, _, radius = text.rpartition(":")
+    try:
+        radius = float(radius)
+    except ValueError:
+        place = ""
+    if not place.strip():
+        raise ValueError("please give --within as NAME_OR_COORD:RADIUS, not \"{}\"".format(text))
+    if not radius > 0:
+        raise ValueError("please use a positive radius with --within, not \"{}\"".format(text))
+    try:
+        arguments, _ = resolve_coordinates(place, aliases)
+    except ValueError as exception:
+        raise ValueError("--within \"{}\": {}".format(text, exception))
+    lat, lon, _ = signed_coordinates(argument_tags(arguments))
+    return place.strip(), lat, lon, radius
+
+def geofences(args):
+    """Return the geofences of --within, see parse_geofence"""
+    aliases = load_aliases(args)
+    return [parse_geofence(text, aliases) for text in args.within]
+
+def geofence_matches(positions, fences):
+    """
+    Find the geofence each position lies in, testing all positions
+    against all fences in one pass, vectorized with NumPy if it is
+    installed. Like AliasIndex, it compares chords on the unit sphere
+    rather than great circle distances, which comes to the same.
+
+    @param positions: list of signed (lat, lon, alt), or None
+    @param fences: list of (place, signed lat, signed lon, radius), see parse_geofence
+    @param return: list with the (index of the first fence, distance in
+                   meters) of every position, or None if it lies in none
+    """
+    rows = [row for row, position in enumerate(positions) if position is not None]
+    found = [None] * len(positions)
+    if not rows or not fences:
+        return found
+    limits = [chord_length(radius) ** 2 for _, _, _, radius in fences]
+
+    if numpy is not None:
+        def vectors(lats, lons):
+            """Points on the unit sphere, one per row"""
+            lats = numpy.radians(numpy.asarray(lats, dtype=numpy.float64))
+            lons = numpy.radians(numpy.asarray(lons, dtype=numpy.float64))
+            return numpy.column_stack((numpy.cos(lats) * numpy.cos(lons),
+                                       numpy.cos(lats) * numpy.sin(lons), numpy.sin(lats)))
+        points = vectors([positions[row][0] for row in rows],
+                         [positions[row][1] for row in rows])
+        centers = vectors([fence[1] for fence in fences], [fence[2] for fence in fences])
+        # The squared chord between unit vectors a and b is 2 - 2 a.b
+        squared = numpy.maximum(2 - 2 * points.dot(centers.T), 0)
+        inside = squared <= numpy.asarray(limits)
+        first = inside.argmax(axis=1)
+        for index in numpy.flatnonzero(inside.any(axis=1)):
+            fence = int(first[index])
+            found[rows[index]] = (fence, arc_distance(math.sqrt(squared[index, fence])))
+        return found
+
+    centers = [unit_vector(lat, lon) for _, lat, lon, _ in fences]
+    for row in rows:
+        point = unit_vector(positions[row][0], positions[row][1])
+        for fence, (center, limit) in enumerate(zip(centers, limits)):
+            squared = sum((a - b) ** 2 for a, b in zip(point, center))
+            if squared <= limit:
+                found[row] = (fence, arc_distance(math.sqrt(squared)))
                 break
+    return found
+
+def remove_within(files, args, engine=None, plan=None):
+    """
+    Remove the GPS information of the files whose position lies in a
+    geofence of --within, leaving all others alone. Positions are read
+    in bulk, a batch of files at a time, from the XMP sidecar of files
+    which get one with --sidecar. With --dryrun, print which
+    files would lose it.
+
+    @param files: iterable of file names
+    @param args: parsed command line arguments
+    @param engine: ExiftoolEngine or ExiftoolPool to run the commands with
+    @param plan: PlanWriter to record the jobs in instead of writing them, or None
+    @param return: generator of FileResult, in the order of files; files
+                   outside the geofences are skipped, with a returncode of None
+    """
+    fences = geofences(args)
+    files = iter(files)
+    while True:
+        batch = list(islice(files, BATCH_SIZE))
+        if not batch:
+            return
+
+        results = dict((filename, FileResult(filename, 1, "Not a file")) for filename in batch)
+        readable = [filename for filename in batch if not bad_filename(filename, args.dryrun)]
+        positions = read_gps_bulk(readable, engine, sidecar_extensions(args))
+        for filename in readable:
+            if isinstance(positions.get(filename), NativeWriterError):
+                results[filename] = FileResult(filename, 1, "\"{}\": {}".format(
+                    sidecar_name(filename), positions[filename]))
+        readable = [filename for filename in readable
+                    if not isinstance(positions.get(filename), NativeWriterError)]
+        with m_stats.timer("geofence", len(readable)):
+            matches = geofence_matches([positions.get(filename) for filename in readable],
+                                       fences)
+
+        jobs = []
+        for filename, match in zip(readable, matches):
+            if match is None:
+                results[filename] = FileResult(filename, None, "Not within --within")
+                continue
+            jobs.append((filename, ["-GPS*="]))
+            if args.dryrun:
+                print("{}: within {:.0f} m of {} ({:.0f} m)".format(
+                    filename, fences[match[0]][3], fences[match[0]][0], match[1]))
             else:
-                print("Unrecognized response \"{}\"".format(confirmation))
+                m_logger.debug("\"%s\" is %.0f m from \"%s\"", filename, match[1],
+                               fences[match[0]][0])
+        m_logger.info("%d of %d files are within --within", len(jobs), len(batch))
+
+        for result in write_jobs(jobs, args, engine, plan=plan):
+            results[result.filename] = result
+        for filename in batch:
+            yield results[filename]
+
+# Number of files a --scan worker process reads at a time
+SCAN_CHUNK_SIZE = 256
+# Seconds to wait for a worker process at most
+SCAN_TIMEOUT = 24 * 3600
+SCAN_FIELDS = ("path", "has_gps", "lat", "lon")
+
+def scan_chunk(files):
+    """
+    Read the GPS positions of files natively, in a worker process of --scan.
+
+    @param files: list of file names
+    @param return: list of (file name, signed (lat, lon, alt) or None,
+                   error message or None, whether exiftool may do better)
+    """
+    found = []
+    for filename in files:
+        try:
+            found.append((filename, read_gps_native(filename), None, False))
+        except NativeWriterError as exception:
+            found.append((filename, None, "{}".format(exception), True))
+        except (IOError, OSError) as exception:
+            found.append((filename, None, "{}".format(exception), False))
+    return found
+
+def scanned_chunks(chunks, pool, jobs):
+    """
+    Hand chunks of files to scan_chunk in the worker processes, keeping
+    only a few chunks per worker in flight, so that a huge walk is not
+    queued up in memory.
+
+    @param pool: multiprocessing.Pool, or None to scan in this process
+    @param return: generator of the results of scan_chunk, in the order of chunks
+    """
+    if pool is None:
+        for chunk in chunks:
+            yield scan_chunk(chunk)
+        return
+    pending = deque()
+    for chunk in chain(chunks, [None]):
+        if chunk is not None:
+            pending.append(pool.apply_async(scan_chunk, (chunk,)))
+            if len(pending) < 4 * jobs:
                 continue
+        while pending and (chunk is None or len(pending) >= 4 * jobs):
+            # With a timeout, waiting can be interrupted by Ctrl-C on Python 2
+            yield pending.popleft().get(SCAN_TIMEOUT)
 
-        m_logger.debug("Removing coordinates from files ...")
-        for filename in files:
-            remove_gps_from_file(filename, args.dryrun)
-            break
+def scan_positions(files, jobs, engine=None):
+    """
+    Read the GPS positions of files, natively in a pool of worker
+    processes. Files the native reader does not handle are read with
+    exiftool, a chunk at a time.
+
+    @param files: iterable of file names
+    @param jobs: number of worker processes
+    @param engine: ExiftoolEngine or ExiftoolPool for the other files
+    @param return: generator of (file name, signed (lat, lon, alt) or None,
+                   error message or None), in the order of files
+    """
+    files = iter(files)
+    chunks = iter(lambda: list(islice(files, SCAN_CHUNK_SIZE)), [])
+    pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+    try:
+        for chunk in scanned_chunks(chunks, pool, jobs):
+            others = [filename for filename, _, _, retry in chunk if retry]
+            positions = dict()
+            if others:
+                try:
+                    positions = read_gps_bulk(others, engine)
+                except ExiftoolError as exception:
+                    m_logger.debug("Cannot read with exiftool: %s", exception)
+            for filename, position, error, retry in chunk:
+                if retry and filename in positions:
+                    position, error = positions[filename], None
+                yield filename, position, error
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+def csv_value(value):
+    """Spell a value of the --scan report like JSON does, for CSV"""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return value
+
+def scan(files, args, engine=None, stream=None):
+    """
+    Report which files have a GPS position, as JSON lines or CSV with
+    the fields of SCAN_FIELDS (signed decimal degrees) and, for files
+    which could not be read, an error.
+
+    @param files: iterable of file names
+    @param args: parsed command line arguments
+    @param engine: ExiftoolEngine or ExiftoolPool for files the native reader does not handle
+    @param stream: where to write the report, None for stdout
+    @param return: number of files which could not be read
+    """
+    stream = stream or sys.stdout
+    writer = None
+    if args.scan_format == "csv":
+        writer = csv.writer(stream)
+        writer.writerow(SCAN_FIELDS + ("error",))
+    count = failed = 0
+    for filename, position, error in scan_positions(files, args.jobs, engine):
+        count += 1
+        if error is not None:
+            failed += 1
+            m_logger.debug("Cannot read \"%s\": %s", filename, error)
+        m_stats.file_done(FileResult(filename, 1 if error else 0, error))
+        row = (filename, None if error else position is not None,
+               position[0] if position else None, position[1] if position else None)
+        if writer is not None:
+            writer.writerow([csv_value(value) for value in row] + [error or ""])
+        else:
+            record = OrderedDict(zip(SCAN_FIELDS, row))
+            if error is not None:
+                record["error"] = error
+            stream.write(json.dumps(record) + "\n")
+    stream.flush()
+    m_logger.info("%d files scanned, %d could not be read", count, failed)
+    return failed
+
+class Daemon(object):
+    """What "addgps --daemon" keeps warm between requests: the aliases,
+    their snapper and the exiftool processes. See addgps_client for the
+    requests it answers.
+
+    Requests are handled concurrently, but files are written one
+    request at a time, as the exiftool processes can only run one
+    command each.
+    """
+    def __init__(self, args, engine):
+        self.args = args
+        self.engine = engine
+        self.write_lock = threading.Lock()
+        self.alias_lock = threading.Lock()
+        self.alias_key = None
+        self.aliases = None
+        self.snapper = None
+
+    def load_aliases(self):
+        """@param return: (aliases, AliasSnapper or None), reloaded if the alias store changed"""
+        try:
+            key = file_key(os.stat(alias_store_path(self.args)))
+        except OSError:
+            key = None
+        with self.alias_lock:
+            if self.aliases is None or key != self.alias_key:
+                self.aliases = load_aliases(self.args)
+                self.snapper = alias_snapper(self.args, self.aliases)
+                self.alias_key = key
+            return self.aliases, self.snapper
 
-    return
+    def handle(self, request):
+        """
+        @param request: dictionary sent by the client
+        @param return: dictionary to answer with
+        """
+        command = request.get("command")
+        if command == "aliases":
+            return {"aliases": sorted(self.load_aliases()[0])}
+        if command not in ("add", "remove"):
+            return {"error": "Unknown command \"{}\"".format(command)}
+
+        names = request.get("files") or []
+        files = [os.path.join(request.get("cwd", "/"), name) for name in names]
+        dryrun = bool(request.get("dryrun")) or self.args.dryrun
+        found = None
+        if command == "add":
+            aliases, snapper = self.load_aliases()
+            try:
+                arguments, found = resolve_coordinates(request.get("coordinates", ""),
+                                                       aliases, snapper)
+            except ValueError as exception:
+                return {"error": "{}".format(exception)}
+            jobs = [(filename, arguments) for filename in files]
+        else:
+            jobs = [(filename, ["-GPS*="]) for filename in files]
+
+        counter = ResultCounter()
+        results = []
+        with self.write_lock:
+            written = run_jobs(with_strategy(m_events.jobs(jobs), self.args.write_strategy),
+                               dryrun, self.engine, native=self.args.backend == "native",
+                               sidecars=sidecar_extensions(self.args))
+            if self.args.fsync_every and not dryrun:
+                written = synced(written, self.args.fsync_every)
+            for name, result in zip(names, written):
+                counter.add(result)
+                results.append([name, result.returncode, result.message])
+        counter.log()
+        return {"results": results, "snapped": found}
+
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    """Answer one JSON line with one JSON line"""
+    def handle(self):
+        try:
+            response = self.server.daemon.handle(json.loads(self.rfile.readline().decode("utf-8")))
+        except (ValueError, AttributeError) as exception:
+            response = {"error": "Bad request: {}".format(exception)}
+        except Exception as exception:      #pylint: disable=broad-except
+            m_logger.exception("Request failed")
+            response = {"error": "{}".format(exception)}
+        self.wfile.write((json.dumps(response) + "\n").encode("utf-8"))
+
+class DaemonServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket server handling each connection in a thread"""
+    daemon_threads = True
+    daemon = None
+
+def serve(args, executable=EXIFTOOL):
+    """
+    Run as daemon until interrupted, see Daemon.
+
+    @param args: parsed command line arguments
+    @param executable: exiftool program to run
+    @param return: exit status
+    """
+    path = args.socket or addgps_client.socket_path()
+    if os.path.exists(path):
+        try:
+            addgps_client.request(path, {"command": "aliases"})
+            m_logger.error("A daemon is already listening on \"%s\"", path)
+            return 1
+        except (socket.error, ValueError):
+            os.remove(path)     # left over from a daemon which died
+
+    # Only the user may connect
+    umask = os.umask(0o177)
+    try:
+        server = DaemonServer(path, DaemonRequestHandler)
+    finally:
+        os.umask(umask)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    pool = ExiftoolPool(args.jobs, executable)
+    try:
+        for engine in pool.engines:
+            engine.start()
+    except ExiftoolError as exception:
+        m_logger.warning("%s", exception)
+    server.daemon = Daemon(args, pool)
+    server.daemon.load_aliases()
+    m_logger.info("Listening on \"%s\"", path)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.remove(path)
+        pool.close()
+    return 0
+
+def write_stats(args):
+    """Print the statistics as --stats and --stats-json ask for"""
+    if args.stats:
+        sys.stderr.write(m_stats.table() + "\n")
+    if args.stats_json == "-":
+        print(json.dumps(m_stats.summary(), indent=2))
+    elif args.stats_json:
+        with open(args.stats_json, "w") as f:
+            json.dump(m_stats.summary(), f, indent=2)
+            f.write("\n")
 
 def main(arglist):
     """Main routine"""
-    args = handle_arguments(arglist)
+    try:
+        if arglist[:1] == ["alias"]:
+            return alias_command(arglist[1:])
+        if arglist[:1] == ["track-index"]:
+            return track_index_command(arglist[1:])
+        if arglist[:1] == ["gazetteer"]:
+            return gazetteer_command(arglist[1:])
+        return run_command(handle_arguments(arglist))
+    finally:
+        stop_logging()
 
+def run_command(args):
+    """Run addgps itself, as the parsed command line arguments ask for"""
     initialize_logging(args)
 
-    files = args.filelist
+    if args.log_format == "jsonl":
+        set_events(FileEvents())
+    if args.stats or args.stats_json:
+        # The number of files is only known up front if they are all named
+        set_stats(Stats(None if args.recursive or args.mapping or args.files_from
+                        else len(args.filelist),
+                        args.write_strategy))
+    try:
+        if args.profile:
+            profiler = cProfile.Profile()
+            try:
+                return profiler.runcall(run, args)
+            finally:
+                profiler.dump_stats(args.profile)
+        return run(args)
+    finally:
+        if m_stats.enabled:
+            write_stats(args)
+            set_stats(NullStats())
+        set_events(NullEvents())
 
-    m_logger.debug("%d filenames found: [%s]", len(files), '], ['.join(files))
+def run(args):
+    """Process the files as the parsed command line arguments ask for"""
+    if args.daemon:
+        return serve(args)
 
-    if args.action == "add":
-        get_lat_lon(files, args)
-    else:
-        remove_lat_lon(files, args)
+    files = expand_files(args)
+
+    if args.scan:
+        with ExiftoolEngine() as engine:
+            return 1 if scan(files, args, engine) else 0
+
+    manifest = Manifest(args.manifest) if args.manifest else None
+    plan = PlanWriter(args.plan) if args.plan else None
+    try:
+        with ExiftoolPool(args.jobs) as engine:
+            failed = process(files, args, engine, manifest, plan)
+    except BaseException:
+        if plan is not None:
+            plan.abort()
+        raise
+    if plan is not None:
+        plan.close()
+    if manifest is not None:
+        manifest.close()
+
+    if failed:
+        m_logger.debug("finished with %d failures.", failed)
+        return 1
 
     m_logger.debug("successfully finished.")
+    return 0
+
+def process(files, args, engine, manifest=None, plan=None):
+    """
+    Add or remove GPS information the way the command line asks for.
+
+    @param return: number of files which could not be processed
+    """
+    if args.apply:
+        failed = apply_plan(args, engine, manifest)
+    elif args.action == "add" and args.mapping:
+        stream = open_mapping(args.mapping)
+        try:
+            aliases = load_aliases(args)
+            ready = None
+            if args.mapping == "-":
+                # A mapping piped in is parsed line by line as it is
+                # written, and written in batches of what is there
+                lines = StreamedLines(stream)
+                jobs = lines.count(mapping_jobs(lines, aliases, args.mapping_format))
+                ready = lines.ready
+            else:
+                jobs = mapping_jobs(read_lines(stream), aliases, args.mapping_format,
+                                    BATCH_SIZE)
+            snapper = alias_snapper(args, aliases)
+            if snapper is not None:
+                jobs = snapper.jobs(jobs)
+            failed = write_and_report(jobs, args, engine, manifest, plan, ready)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+    elif args.action == "add" and args.track_index:
+        track = TrackStore(args.track_store or track_store_path())
+        snapper = alias_snapper(args, load_aliases(args)) if args.snap else None
+        try:
+            failed = report_results(geotag_from_track(files, track, args, engine, manifest,
+                                                      snapper, plan))
+        finally:
+            track.close()
+    elif args.action == "add" and args.gpx:
+        track = GPSTrack()
+        for filename in args.gpx:
+            track.extend(GPSTrack.from_file(filename))
+        track.sort()
+        snapper = alias_snapper(args, load_aliases(args)) if args.snap else None
+        failed = report_results(geotag_from_track(files, track, args, engine, manifest,
+                                                  snapper, plan))
+    elif args.action == "add":
+        failed = get_lat_lon(files, args, engine, manifest, plan)
+    else:
+        failed = remove_lat_lon(files, args, engine, manifest, plan)
+    return failed
 
 
 if __name__ == "__main__":
     try:
-        main(sys.argv)
+        sys.exit(main(sys.argv[1:]))
     except KeyboardInterrupt:
 
         m_logger.info("Received KeyboardInterrupt")
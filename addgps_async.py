@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+addgps_async
+~~~~~~~~~~~~
+
+The asyncio pipeline behind "addgps --pipeline" (Python 3 only).
+
+Jobs flow through stages connected by bounded queues:
+
+    discover -> check -> write (one task per exiftool) -> verify -> report
+
+The verify stage only runs with --verify: it reads back the files
+written, see addgps.Verifier.
+
+A stage that falls behind fills the queue in front of it, which
+suspends the stages before it. So a slow disk or writer throttles
+reading the file list instead of letting pending files pile up in
+memory. exiftool runs as "-stay_open" processes driven through
+asyncio pipes, and the event loop stays free to log progress and to
+react to Ctrl-C while writes are in flight.
+"""
+import asyncio
+import os
+import tempfile
+import threading
+import time
+from itertools import islice
+
+import addgps
+from addgps import m_logger, FileResult
+
+# Number of jobs read from the file list at a time
+CHUNK_SIZE = 100
+# Number of chunks or commands buffered between two stages
+QUEUE_SIZE = 4
+# Seconds between two progress lines
+PROGRESS_INTERVAL = 5.0
+# Put into a queue after the last item
+DONE = None
+
+class AsyncExiftool(object):
+    """One exiftool "-stay_open" process, see addgps.ExiftoolEngine"""
+    def __init__(self, executable=addgps.EXIFTOOL):
+        self.executable = executable
+        self.process = None
+        self.sequence = 0
+
+    async def start(self):
+        """Start the exiftool process, if it is not already running"""
+        if self.process is None:
+            cmd = [self.executable, "-stay_open", "True", "-@", "-"]
+            m_logger.debug("Starting exiftool engine \"%s\"", cmd)
+            try:
+                self.process = await asyncio.create_subprocess_exec(
+                    *cmd, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.PIPE)
+            except OSError as exception:
+                raise addgps.ExiftoolError("Cannot start {}: {}".format(
+                    self.executable, exception))
+
+    async def close(self, force=False):
+        """Shut down the exiftool process"""
+        process, self.process = self.process, None
+        if process is None:
+            return
+        if not force:
+            try:
+                process.stdin.write(b"-stay_open\nFalse\n")
+                await process.stdin.drain()
+            except (ConnectionError, OSError):
+                force = True
+        if force and process.returncode is None:
+            process.terminate()
+        process.stdin.close()
+        await process.wait()
+
+    async def execute(self, arguments):
+        """
+        @param arguments: list of exiftool arguments, without the program name
+        @param return: ExiftoolResult with return code, stdout and stderr
+        """
+        await self.start()
+        self.sequence += 1
+        addgps.m_stats.count("exiftool_commands")
+        marker, payload = addgps.command_payload(arguments, self.sequence)
+        try:
+            self.process.stdin.write(payload)
+            await self.process.stdin.drain()
+        except (ConnectionError, OSError) as exception:
+            raise addgps.ExiftoolError("Lost connection to exiftool: {}".format(exception))
+
+        stdout, stderr = await asyncio.gather(
+            read_until(self.process.stdout, marker.encode("ascii")),
+            read_until(self.process.stderr, marker.encode("ascii")))
+        return addgps.parse_exiftool_output(stdout, stderr, marker)
+
+async def read_until(stream, marker):
+    """Read a stream until it ends with the marker of a command"""
+    output = bytearray()
+    while not addgps.ends_with_marker(output, marker):
+        chunk = await stream.read(65536)
+        if not chunk:
+            raise addgps.ExiftoolError("exiftool exited unexpectedly")
+        output.extend(chunk)
+    return bytes(output)
+
+def in_daemon_thread(function, *arguments):
+    """
+    Run a blocking function in a daemon thread. Unlike the default
+    executor's threads, it doesn't keep the program from exiting on
+    Ctrl-C while it waits, e.g. for a line on stdin.
+
+    @param return: future of the result of function
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def settle(result, exception):
+        """Hand the outcome to the future, unless it was cancelled"""
+        if future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(result)
+
+    def run():
+        """Thread body"""
+        result = exception = None
+        try:
+            result = function(*arguments)
+        except Exception as error:       #pylint: disable=broad-except
+            exception = error
+        try:
+            loop.call_soon_threadsafe(settle, result, exception)
+        except RuntimeError:
+            pass    # the loop is gone already
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return future
+
+def check_chunk(chunk, dryrun, native, sidecars=()):
+    """
+    Check a chunk of jobs and write what can be written natively.
+
+    @param chunk: list of (file name, list of exiftool arguments or None)
+    @param dryrun: boolean which defines if files should be changed (False) or not (True)
+    @param native: boolean, write JPEG files without exiftool where possible
+    @param sidecars: extensions of the files to write XMP sidecars for
+    @param return: (list of FileResult of finished files,
+                    OrderedDict of arguments and the files still to write with them)
+    """
+    finished = []
+    pending = []
+    for filename, arguments in chunk:
+        if arguments is None:
+            finished.append(FileResult(filename, 1, "No coordinates"))
+        elif addgps.bad_filename(filename, dryrun):
+            finished.append(FileResult(filename, 1, "Not a file"))
+        elif addgps.wants_sidecar(filename, sidecars):
+            finished.append(addgps.sidecar_job(filename, arguments, dryrun))
+        else:
+            result = addgps.native_job(filename, arguments, dryrun) if native else None
+            if result is None:
+                pending.append((filename, arguments))
+            else:
+                finished.append(result)
+    return finished, addgps.group_by_arguments(pending)
+
+async def discover(jobs, outbox):
+    """First stage: read the jobs, chunk by chunk"""
+    jobs = iter(jobs)
+    while True:
+        chunk = await in_daemon_thread(lambda: list(islice(jobs, CHUNK_SIZE)))
+        if not chunk:
+            break
+        await outbox.put(chunk)
+    await outbox.put(DONE)
+
+async def check(inbox, outbox, results, dryrun, native, writers, sidecars=(),     #pylint: disable=too-many-arguments
+                verifier=None, expected=None):
+    """
+    Second stage: drop bad files, write natively, group the rest into
+    exiftool commands. With a Verifier, note in expected what verify
+    checks for each file, before it is written.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        chunk = await inbox.get()
+        if chunk is DONE:
+            break
+        if verifier is not None:
+            expected.update(zip((filename for filename, _ in chunk),
+                                await loop.run_in_executor(None, verifier.expect, chunk)))
+        # Native writes run in the default executor, whose threads are
+        # waited for on exit, so that Ctrl-C never interrupts one
+        finished, groups = await loop.run_in_executor(None, check_chunk, chunk, dryrun, native,
+                                                      sidecars)
+        if finished:
+            await results.put(finished)
+        for arguments, files in groups.items():
+            for files_chunk in addgps.argfile_chunks(files):
+                await outbox.put((list(arguments), files_chunk))
+    for _ in range(writers):
+        await outbox.put(DONE)
+
+async def write(engine, inbox, results, dryrun):
+    """Third stage: run exiftool commands on one engine"""
+    try:
+        while True:
+            command = await inbox.get()
+            if command is DONE:
+                break
+            arguments, files = command
+            addgps.log_chunk(arguments, files)
+            if dryrun:
+                await results.put([FileResult(filename, 0, "") for filename in files])
+                continue
+            with tempfile.NamedTemporaryFile(prefix="addgps-", suffix=".args",
+                                             delete=False) as argfile:
+                for line in arguments + files:
+                    argfile.write(addgps.encode_argument(line) + b"\n")
+            try:
+                with addgps.m_stats.timer("exiftool", len(files)):
+                    result = await engine.execute(["-@", argfile.name])
+            finally:
+                os.remove(argfile.name)
+            written = addgps.split_batch_result(files, result)
+            if addgps.m_stats.enabled:
+                addgps.count_rewritten((r.filename for r in written if r.returncode == 0),
+                                       addgps.strategy_of(arguments))
+            await results.put(written)
+    except BaseException:
+        # After an error or Ctrl-C the process may be in the middle of a command
+        await engine.close(force=True)
+        raise
+    await engine.close()
+
+async def verify(inbox, outbox, verifier, expected):
+    """Fourth stage, with --verify: check the files written, see addgps.Verifier.check"""
+    loop = asyncio.get_running_loop()
+    while True:
+        results = await inbox.get()
+        if results is DONE:
+            break
+        wanted = [expected.pop(result.filename, (None, None)) for result in results]
+        checked = await loop.run_in_executor(None, verifier.check, results, wanted)
+        await outbox.put(checked)
+    await outbox.put(DONE)
+
+async def report(inbox, counter):
+    """Last stage: count the results"""
+    while True:
+        results = await inbox.get()
+        if results is DONE:
+            break
+        for result in results:
+            counter.add(result)
+
+async def show_progress(counter, interval=PROGRESS_INTERVAL):
+    """Log how far the pipeline got, every interval seconds"""
+    start = time.time()
+    last = 0
+    while True:
+        await asyncio.sleep(interval)
+        count = counter.done + counter.skipped + counter.failed
+        if count != last:
+            m_logger.info("%d files done, %d failed, %.0f files/s", count, counter.failed,
+                          count / (time.time() - start))
+            last = count
+
+async def pipeline(jobs, jobs_count, dryrun, native=False, executable=addgps.EXIFTOOL,     #pylint: disable=too-many-arguments,too-many-locals
+                   counter=None, sidecars=(), verifier=None):
+    """
+    @param jobs: iterable of (file name, list of exiftool arguments or None), see run_jobs
+    @param jobs_count: number of exiftool processes
+    @param dryrun: boolean which defines if files should be changed (False) or not (True)
+    @param native: boolean, write JPEG files without exiftool where possible
+    @param executable: exiftool program to run
+    @param counter: ResultCounter to count the results with, None for a new one
+    @param sidecars: extensions of the files to write XMP sidecars for
+    @param verifier: Verifier to check the files written with, or None
+    @param return: the ResultCounter
+    """
+    chunks = asyncio.Queue(QUEUE_SIZE)
+    commands = asyncio.Queue(QUEUE_SIZE * jobs_count)
+    results = asyncio.Queue(QUEUE_SIZE * jobs_count)
+    checked = asyncio.Queue(QUEUE_SIZE * jobs_count) if verifier is not None else results
+    expected = dict()
+    if counter is None:
+        counter = addgps.ResultCounter()
+
+    stages = [asyncio.ensure_future(discover(jobs, chunks)),
+              asyncio.ensure_future(check(chunks, commands, results, dryrun, native,
+                                          jobs_count, sidecars, verifier, expected))]
+    stages.extend(asyncio.ensure_future(write(AsyncExiftool(executable), commands, results,
+                                              dryrun))
+                  for _ in range(jobs_count))
+    verifiers = []
+    if verifier is not None:
+        verifiers.append(asyncio.ensure_future(verify(results, checked, verifier, expected)))
+    reporter = asyncio.ensure_future(report(checked, counter))
+    progress = asyncio.ensure_future(show_progress(counter))
+    try:
+        await asyncio.gather(*stages)
+        await results.put(DONE)
+        await asyncio.gather(*verifiers)
+        await reporter
+    finally:
+        for task in stages + verifiers + [reporter, progress]:
+            task.cancel()
+        # Let the writers shut their exiftool down
+        await asyncio.gather(*stages, return_exceptions=True)
+    return counter
+
+def run_pipeline(jobs, args, executable=addgps.EXIFTOOL):
+    """
+    Write jobs through the pipeline, as the command line asks for.
+
+    @param jobs: iterable of (file name, list of exiftool arguments or None), see run_jobs
+    @param args: parsed command line arguments
+    @param executable: exiftool program to run
+    @param return: number of files which could not be processed
+    """
+    verifier = addgps.verifier(args, executable)
+    try:
+        counter = asyncio.run(pipeline(jobs, args.jobs, args.dryrun, args.backend == "native",
+                                       executable, sidecars=addgps.sidecar_extensions(args),
+                                       verifier=verifier))
+    except BaseException:
+        if verifier is not None:
+            verifier.close(force=True)
+        raise
+    if verifier is not None:
+        verifier.close()
+    counter.log()
+    return counter.failed
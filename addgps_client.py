@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+addgps_client
+~~~~~~~~~~~~~
+
+A thin client for "addgps --daemon", for binding to a key in a file
+manager. It only imports what it needs to talk to the daemon over its
+Unix socket, so tagging a file doesn't pay for starting addgps and
+exiftool every time. Without a daemon, or for options it does not
+know, it runs addgps in-process instead.
+
+Usage: addgps_client.py [-r] [-s] [-q] FILE...
+
+Each request is one JSON line, answered by one JSON line:
+
+    {"command": "aliases"}
+    {"command": "add", "cwd": DIR, "files": [...], "coordinates": TEXT, "dryrun": BOOL}
+    {"command": "remove", "cwd": DIR, "files": [...], "dryrun": BOOL}
+"""
+from __future__ import print_function
+
+import json
+import os
+import socket
+import sys
+
+# Overrides where the daemon listens
+SOCKET_ENVIRONMENT = "ADDGPS_SOCKET"
+# The options the daemon handles; everything else runs in-process
+CLIENT_OPTIONS = frozenset(["-r", "--remove", "-s", "--dryrun", "-q", "--quiet"])
+
+def socket_path():
+    """Return where the daemon listens by default"""
+    if os.environ.get(SOCKET_ENVIRONMENT):
+        return os.environ[SOCKET_ENVIRONMENT]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "addgps.sock")
+    return os.path.join(os.environ.get("TMPDIR", "/tmp"), "addgps-{}.sock".format(os.getuid()))
+
+def request(path, message):
+    """
+    Send one request to the daemon.
+
+    @param path: the daemon's socket
+    @param message: dictionary, see the module documentation
+    @param return: dictionary answered by the daemon
+    @raise socket.error: if no daemon listens on path
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(path)
+        connection.sendall((json.dumps(message) + "\n").encode("utf-8"))
+        stream = connection.makefile("rb")
+        try:
+            line = stream.readline()
+        finally:
+            stream.close()
+    finally:
+        connection.close()
+    if not line:
+        raise socket.error("The daemon closed the connection")
+    return json.loads(line.decode("utf-8"))
+
+def set_up_completion(names):
+    """Complete alias names with the TAB key, if readline is available"""
+    try:
+        import readline     # only when prompting
+    except ImportError:
+        return
+    names = sorted(names)
+
+    def complete(text, state):
+        """readline completer"""
+        matches = [name for name in names if name.startswith(text)]
+        return matches[state] if state < len(matches) else None
+
+    readline.set_completer(complete)
+    readline.parse_and_bind('tab: complete')
+
+def prompt(path, message):
+    """
+    Ask for coordinates until the daemon accepts them.
+
+    @param return: answer of the daemon to the "add" request
+    """
+    set_up_completion(request(path, {"command": "aliases"})["aliases"])
+    try:
+        read = raw_input        #pylint: disable=invalid-name
+    except NameError:
+        read = input            #pylint: disable=invalid-name
+    while True:
+        print("Please enter latitude and longitude, separated " +
+              "by a comma (','):     (abort with Ctrl-C)")
+        message["coordinates"] = read("Coordinates: ").strip()
+        answer = request(path, message)
+        if "results" in answer:
+            return answer
+        print("\nError: {}".format(answer.get("error")))
+
+def in_process(argv):
+    """Run addgps itself, for want of a daemon"""
+    import addgps
+    return addgps.main(argv)
+
+def main(argv):
+    """Entry point"""
+    options = set(argument for argument in argv if argument.startswith("-"))
+    files = [argument for argument in argv if not argument.startswith("-")]
+    if not files or not options <= CLIENT_OPTIONS:
+        return in_process(argv)
+
+    path = socket_path()
+    message = {"command": "remove" if options & set(["-r", "--remove"]) else "add",
+               "cwd": os.getcwd(), "files": files,
+               "dryrun": bool(options & set(["-s", "--dryrun"]))}
+    try:
+        if message["command"] == "add":
+            answer = prompt(path, message)
+        else:
+            answer = request(path, message)
+    except socket.error:
+        return in_process(argv)
+    if "results" not in answer:
+        print("Error: {}".format(answer.get("error")), file=sys.stderr)
+        return 1
+
+    if answer.get("snapped"):
+        print("Snapped to \"{}\", {:.0f} m away".format(answer["snapped"][1],
+                                                       answer["snapped"][0]))
+    failed = 0
+    for filename, returncode, text in answer["results"]:
+        if returncode:
+            failed += 1
+            print("Failed to process \"{}\": {}".format(filename, text), file=sys.stderr)
+    if not options & set(["-q", "--quiet"]):
+        print("{} files processed, {} failed".format(len(answer["results"]) - failed, failed))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    try:
+        sys.exit(main(sys.argv[1:]))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+bench
+~~~~~
+
+Throughput benchmarks for addgps.
+
+A corpus is made of copies of data/saturn.jpg, in one directory or
+nested in subdirectories. Every benchmark case runs in a child process
+on a fresh copy of it, so that its peak memory can be measured on its
+own. The results are printed as JSON and can be compared against a
+baseline saved by an earlier run.
+
+Examples:
+
+    benchmarks/bench.py --files 10000 --fake --save-baseline base.json
+    benchmarks/bench.py --files 10000 --fake --baseline base.json
+
+With --fake, the tests' exiftool stand-in (tests/fake_exiftool.py) is
+used, which measures addgps' own overhead without exiftool installed.
+
+Latency is the time from handing a file to addgps until its result
+comes back.
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import platform
+import tempfile
+import subprocess
+import multiprocessing
+from collections import OrderedDict
+from argparse import ArgumentParser, SUPPRESS
+
+import resource
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOP = os.path.dirname(HERE)
+sys.path.insert(0, TOP)
+
+import addgps   #pylint: disable=wrong-import-position
+
+SAMPLE = os.path.join(TOP, "data", "saturn.jpg")
+FAKE_EXIFTOOL = os.path.join(TOP, "tests", "fake_exiftool.py")
+# Files per directory in nested corpora
+DIRECTORY_SIZE = 100
+# Largest slowdown of files/s against the baseline which is no regression
+THRESHOLD = 0.1
+
+def make_corpus(directory, count, layout):
+    """
+    Fill directory with count copies of the sample image.
+
+    @param layout: "flat" for one directory, "nested" for two levels of
+                   subdirectories with DIRECTORY_SIZE files each
+    """
+    with open(SAMPLE, "rb") as stream:
+        data = stream.read()
+    for number in range(count):
+        if layout == "nested":
+            subdirectory = os.path.join(directory, "d{:03d}".format(number // DIRECTORY_SIZE // 10),
+                                        "s{}".format(number // DIRECTORY_SIZE % 10))
+        else:
+            subdirectory = directory
+        if number % DIRECTORY_SIZE == 0 and not os.path.isdir(subdirectory):
+            os.makedirs(subdirectory)
+        with open(os.path.join(subdirectory, "img{:06d}.jpg".format(number)), "wb") as stream:
+            stream.write(data)
+
+def corpus_files(directory):
+    """Return the files of a corpus, in walking order"""
+    return list(addgps.walk_files([directory], recursive=True))
+
+def gps_arguments():
+    """Return the exiftool arguments the add cases write"""
+    return addgps.gps_arguments(addgps.GPSLatitude("33.356593"),
+                                addgps.GPSLongitude("116.864816"),
+                                addgps.GPSAltitude("1200"))
+
+class Timer(object):
+    """Remember when each file was handed out and when its result came back"""
+    def __init__(self):
+        self.start = time.time()
+        self.submitted = dict()
+        self.latencies = []
+        self.failed = 0
+
+    def jobs(self, files, arguments):
+        """Hand out (file name, arguments), noting the time"""
+        for filename in files:
+            self.submitted[filename] = time.time()
+            yield filename, arguments
+
+    def result(self, filename, returncode):
+        """Note the result of a file"""
+        self.latencies.append(time.time() - self.submitted.pop(filename))
+        if returncode:
+            self.failed += 1
+
+    def results(self, results):
+        """Note a stream of FileResult"""
+        for result in results:
+            self.result(result.filename, result.returncode)
+
+def case_serial_add(directory, files, jobs, timer):     #pylint: disable=unused-argument
+    """One add_gps_to_file call per file, the way interactive runs used to work"""
+    lat = addgps.GPSLatitude("33.356593")
+    lon = addgps.GPSLongitude("116.864816")
+    alt = addgps.GPSAltitude("1200")
+    with addgps.ExiftoolEngine() as engine:
+        for filename, _ in timer.jobs(files, None):
+            timer.result(filename, addgps.add_gps_to_file(filename, lat, lon, alt, False, engine))
+
+def case_serial_remove(directory, files, jobs, timer):     #pylint: disable=unused-argument
+    """One remove_gps_from_file call per file"""
+    with addgps.ExiftoolEngine() as engine:
+        for filename, _ in timer.jobs(files, None):
+            timer.result(filename, addgps.remove_gps_from_file(filename, False, engine))
+
+def case_batch_add(directory, files, jobs, timer):
+    """Batched exiftool commands on a pool of engines"""
+    with addgps.ExiftoolPool(jobs) as pool:
+        timer.results(addgps.run_jobs(timer.jobs(files, gps_arguments()), False, pool))
+
+def case_batch_remove(directory, files, jobs, timer):
+    """Batched removal on a pool of engines"""
+    with addgps.ExiftoolPool(jobs) as pool:
+        timer.results(addgps.run_jobs(timer.jobs(files, ["-GPS*="]), False, pool))
+
+def case_native_add(directory, files, jobs, timer):
+    """The native JPEG writer, with the exiftool pool as fallback"""
+    with addgps.ExiftoolPool(jobs) as pool:
+        timer.results(addgps.run_jobs(timer.jobs(files, gps_arguments()), False, pool,
+                                      native=True))
+
+def case_pipeline_add(directory, files, jobs, timer):
+    """The asyncio pipeline, with exiftool only"""
+    import asyncio
+    import addgps_async
+
+    class Counter(addgps.ResultCounter):
+        """Note the results as the pipeline counts them"""
+        def add(self, result):
+            super(Counter, self).add(result)
+            timer.result(result.filename, result.returncode)
+
+    asyncio.run(addgps_async.pipeline(timer.jobs(files, gps_arguments()), jobs, False,
+                                      counter=Counter()))
+
+def case_walk(directory, files, jobs, timer):     #pylint: disable=unused-argument
+    """Walking the corpus directory"""
+    timer.submitted = dict((filename, timer.start) for filename in files)
+    for filename in addgps.walk_files([directory], recursive=True):
+        timer.result(filename, 0)
+
+def case_parse(directory, files, jobs, timer):     #pylint: disable=unused-argument
+    """Parsing one mapping line per file, in batches"""
+    lines = ["{},33.{}N,116.{}W,{}f\n".format(filename, n % 1000, n % 997, n % 5000)
+             for n, filename in enumerate(files)]
+    timer.submitted = dict((filename, timer.start) for filename in files)
+    for filename, arguments in addgps.mapping_jobs(lines, {}, batch_size=addgps.BATCH_SIZE):
+        timer.result(filename, arguments is None)
+
+CASES = OrderedDict([
+    ("serial_add", case_serial_add),
+    ("serial_remove", case_serial_remove),
+    ("batch_add", case_batch_add),
+    ("batch_remove", case_batch_remove),
+    ("native_add", case_native_add),
+    ("pipeline_add", case_pipeline_add),
+    ("walk", case_walk),
+    ("parse", case_parse),
+])
+
+# Cases which start from a corpus which has GPS tags already
+NEEDS_TAGS = ("serial_remove", "batch_remove")
+
+def percentile(values, fraction):
+    """Return the value below which fraction of the sorted values lie"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def run_case(name, directory, jobs):
+    """Run one case in this process, return its measurements"""
+    logging.getLogger(addgps.LOGGER_NAME).addHandler(logging.NullHandler())
+    logging.getLogger(addgps.LOGGER_NAME).propagate = False
+    files = corpus_files(directory)
+    if name in NEEDS_TAGS:
+        with addgps.ExiftoolPool(jobs) as pool:
+            for _ in addgps.run_jobs(((f, gps_arguments()) for f in files), False, pool):
+                pass
+
+    timer = Timer()
+    CASES[name](directory, files, jobs, timer)
+    seconds = time.time() - timer.start
+    latencies = sorted(timer.latencies)
+    return OrderedDict([
+        ("files", len(latencies)),
+        ("failed", timer.failed),
+        ("seconds", round(seconds, 4)),
+        ("files_per_second", round(len(latencies) / seconds, 1) if seconds else 0.0),
+        ("latency_p50_ms", round(percentile(latencies, 0.5) * 1000, 3)),
+        ("latency_p99_ms", round(percentile(latencies, 0.99) * 1000, 3)),
+        # ru_maxrss is in kilobytes on Linux
+        ("peak_rss_kb", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss),
+        ("peak_children_rss_kb", resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+    ])
+
+def compare(results, baseline, threshold=THRESHOLD):
+    """
+    Print the results next to the baseline.
+
+    @param results: dictionary of case names and their measurements
+    @param baseline: results of an earlier run, or None
+    @param return: list of the cases which got slower by more than threshold
+    """
+    regressions = []
+    print("{:16} {:>10} {:>10} {:>10} {:>10} {:>9}".format(
+        "case", "files/s", "p50 ms", "p99 ms", "RSS kB", "vs base"), file=sys.stderr)
+    for name, measured in results.items():
+        change = ""
+        before = (baseline or {}).get(name)
+        if before and before.get("files_per_second"):
+            ratio = measured["files_per_second"] / before["files_per_second"]
+            change = "{:+.1f}%".format((ratio - 1) * 100)
+            if ratio < 1 - threshold:
+                regressions.append(name)
+                change += " !"
+        print("{:16} {:>10.1f} {:>10.3f} {:>10.3f} {:>10} {:>9}".format(
+            name, measured["files_per_second"], measured["latency_p50_ms"],
+            measured["latency_p99_ms"], measured["peak_rss_kb"], change), file=sys.stderr)
+    return regressions
+
+def handle_arguments(arglist):
+    """Command line argument parsing"""
+    parser = ArgumentParser(description="Measure the throughput of addgps.")
+    parser.add_argument("--files", type=int, default=1000,
+                        help="number of files in the corpus. Default is %(default)s.")
+    parser.add_argument("--layout", choices=("flat", "nested"), default="flat",
+                        help="corpus layout. Default is %(default)s.")
+    parser.add_argument("--case", dest="cases", action="append", choices=list(CASES),
+                        help="case to run. This argument may be given multiple times. " +
+                        "Default is all of them.")
+    parser.add_argument("-j", "--jobs", type=int, default=multiprocessing.cpu_count(),
+                        help="number of exiftool processes. Default is %(default)s.")
+    parser.add_argument("--fake", action="store_true",
+                        help="use the fake exiftool of the tests")
+    parser.add_argument("--corpus", metavar="DIR",
+                        help="keep the corpus template in DIR and reuse it on later runs")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="compare with the results saved in FILE")
+    parser.add_argument("--save-baseline", dest="save_baseline", metavar="FILE",
+                        help="save the results to FILE")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD,
+                        help="largest slowdown against the baseline, as a fraction, " +
+                        "which is not a regression. Default is %(default)s.")
+    # Used for the child processes
+    parser.add_argument("--run-case", dest="run_case", help=SUPPRESS)
+    parser.add_argument("corpus_copy", nargs="?", help=SUPPRESS)
+    args = parser.parse_args(arglist)
+    if not args.cases:
+        args.cases = [name for name in CASES
+                      if name != "pipeline_add" or sys.version_info[0] >= 3]
+    return args
+
+def main(arglist):
+    """Build the corpus, run every case in a child process, report"""
+    args = handle_arguments(arglist)
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args.corpus_copy, args.jobs)))
+        return 0
+
+    scratch = tempfile.mkdtemp(prefix="addgps-bench-")
+    try:
+        environment = dict(os.environ)
+        if args.fake:
+            bindir = os.path.join(scratch, "bin")
+            os.mkdir(bindir)
+            os.symlink(FAKE_EXIFTOOL, os.path.join(bindir, "exiftool"))
+            environment["PATH"] = bindir + os.pathsep + environment.get("PATH", "")
+        elif not any(os.access(os.path.join(directory, addgps.EXIFTOOL), os.X_OK)
+                     for directory in environment.get("PATH", "").split(os.pathsep)):
+            print("exiftool is not installed, use --fake", file=sys.stderr)
+            return 2
+
+        template = args.corpus or os.path.join(scratch, "template")
+        marker = os.path.join(template, ".corpus-{}-{}".format(args.files, args.layout))
+        if not os.path.exists(marker):
+            if os.path.isdir(template) and os.listdir(template):
+                if not any(name.startswith(".corpus-") for name in os.listdir(template)):
+                    print("{} is not a corpus made by this script".format(template),
+                          file=sys.stderr)
+                    return 2
+                shutil.rmtree(template)
+            if not os.path.isdir(template):
+                os.makedirs(template)
+            make_corpus(template, args.files, args.layout)
+            open(marker, "w").close()
+
+        results = OrderedDict()
+        for name in args.cases:
+            corpus = os.path.join(scratch, "corpus")
+            shutil.copytree(template, corpus)
+            os.remove(os.path.join(corpus, os.path.basename(marker)))
+            try:
+                output = subprocess.check_output(
+                    [sys.executable, os.path.abspath(__file__), "--run-case", name,
+                     "--jobs", str(args.jobs), corpus], env=environment)
+            finally:
+                shutil.rmtree(corpus)
+            results[name] = json.loads(output.decode("utf-8"), object_pairs_hook=OrderedDict)
+    finally:
+        shutil.rmtree(scratch)
+
+    report = OrderedDict([
+        ("corpus", OrderedDict([("files", args.files), ("layout", args.layout),
+                                ("file_bytes", os.path.getsize(SAMPLE))])),
+        ("exiftool", "fake" if args.fake else "exiftool"),
+        ("jobs", args.jobs),
+        ("python", platform.python_version()),
+        ("cases", results),
+    ])
+    print(json.dumps(report, indent=2))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as stream:
+            baseline = json.load(stream)["cases"]
+    regressions = compare(results, baseline, args.threshold)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as stream:
+            json.dump(report, stream, indent=2)
+    if regressions:
+        print("Slower than the baseline: {}".format(", ".join(regressions)), file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+fake_exiftool
+~~~~~~~~~~~~~
+
+A tiny stand-in for exiftool which speaks just enough of its command
+line and "-stay_open" protocol for the addgps tests. Written tags are
+kept in a JSON file next to each image ("<file>.fake.json") instead of
+in the image itself.
+
+Files whose name contains "corrupt" fail to be written.
+"""
+from __future__ import print_function
+
+import io
+import json
+import os
+import re
+import sys
+
+def tag_store(filename):
+    """Return the name of the JSON file holding the tags of filename"""
+    return filename + ".fake.json"
+
+def read_tags(filename):
+    """Return the tags written to filename so far"""
+    try:
+        with open(tag_store(filename)) as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+def write_tags(filename, tags):
+    """Replace the tags of filename"""
+    with open(tag_store(filename), "w") as f:
+        json.dump(tags, f, sort_keys=True)
+
+def matches(wanted, name):
+    """Tell if tag name is selected by an argument like "GPS*" or "GPS:all" """
+    wanted = wanted.split(":")[-1]
+    if wanted == "all":
+        wanted = "*"
+    return re.match(wanted.replace("*", ".*") + "$", name) is not None
+
+def number(value):
+    """Return value as a number, like exiftool -n does, if it is one"""
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+def composite(name, value, tags):
+    """Sign a GPS coordinate by its reference, like exiftool's Composite tags"""
+    ref = str(tags.get(name + "Ref", ""))
+    if ref[:1] in ("S", "W", "B", "1"):
+        return -value
+    return value
+
+def expand_argfiles(arguments):
+    """Replace "-@ FILE" by the arguments in FILE"""
+    expanded = []
+    i = 0
+    while i < len(arguments):
+        if arguments[i] == "-@" and i + 1 < len(arguments):
+            with io.open(arguments[i + 1], encoding="utf-8") as f:
+                expanded.extend(line.rstrip("\n") for line in f if line.strip())
+            i += 2
+        else:
+            expanded.append(arguments[i])
+            i += 1
+    return expanded
+
+def run(arguments, out, err):
+    """Run one exiftool command, return its exit status"""
+    arguments = expand_argfiles(arguments)
+    assignments = []
+    wanted = []
+    files = []
+    options = set()
+    echo = {3: [], 4: []}
+    i = 0
+    while i < len(arguments):
+        arg = arguments[i]
+        if arg in ("-echo3", "-echo4"):
+            echo[int(arg[-1])].append(arguments[i + 1])
+            i += 1
+        elif arg in ("-j", "-n", "-q", "-overwrite_original", "-overwrite_original_in_place"):
+            options.add(arg)
+        elif arg.startswith("-") and "=" in arg:
+            tag, value = arg[1:].split("=", 1)
+            assignments.append((tag, value))
+        elif arg.startswith("-"):
+            wanted.append(arg[1:])
+        else:
+            files.append(arg)
+        i += 1
+
+    status = 0
+    updated = 0
+    failed = 0
+    if assignments:
+        for filename in files:
+            if "corrupt" in filename or not os.path.isfile(filename):
+                print("Error: Not a valid JPG - {}".format(filename), file=err)
+                failed += 1
+                continue
+            tags = read_tags(filename)
+            for tag, value in assignments:
+                if tag.endswith("*"):
+                    for name in [t for t in tags if t.startswith(tag[:-1])]:
+                        del tags[name]
+                elif value == "":
+                    tags.pop(tag, None)
+                else:
+                    tags[tag] = value
+            write_tags(filename, tags)
+            updated += 1
+        print("    {} image files updated".format(updated), file=out)
+        if failed:
+            print("    {} files weren't updated due to errors".format(failed), file=out)
+            status = 1
+    elif "-j" in options:
+        records = []
+        for filename in files:
+            record = {"SourceFile": filename}
+            tags = read_tags(filename)
+            for name, value in tags.items():
+                selected = [w for w in wanted if matches(w, name)]
+                if not selected:
+                    continue
+                if "-n" in options:
+                    value = number(value)
+                    if selected[0].startswith("Composite:"):
+                        value = composite(name, value, tags)
+                record[name] = value
+            records.append(record)
+        if records:
+            print(json.dumps(records, indent=2, sort_keys=True), file=out)
+    else:
+        for filename in files:
+            tags = read_tags(filename)
+            for name in sorted(tags):
+                if any(matches(w, name) for w in wanted):
+                    print("{:32}: {}".format(name, tags[name]), file=out)
+
+    for num, stream in ((3, out), (4, err)):
+        for text in echo[num]:
+            print(text.replace("${status}", str(status)), file=stream)
+    return status
+
+def main(argv):
+    """Entry point"""
+    if argv[:4] == ["-stay_open", "True", "-@", "-"]:
+        command = []
+        for line in iter(sys.stdin.readline, ""):
+            line = line.rstrip("\n")
+            i = re.match(r'^-execute(\d*)$', line)
+            if i:
+                run(command, sys.stdout, sys.stderr)
+                print("{{ready{}}}".format(i.group(1)))
+                sys.stdout.flush()
+                sys.stderr.flush()
+                command = []
+            elif command[-1:] == ["-stay_open"] and line == "False":
+                break
+            else:
+                command.append(line)
+        return 0
+    return run(argv, sys.stdout, sys.stderr)
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -7,13 +7,31 @@
 from __future__ import print_function
 import unittest
 import addgps
+import addgps_client
 import tempfile
 import os
 import subprocess
 import shutil
 import stat
+import struct
+import json
+import io
+import sys
+import random
+import logging
+import threading
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which    # Python 2
+try:
+    import asyncio
+except ImportError:
+    asyncio = None
 
-here = os.getcwdu()
+here = getattr(os, "getcwdu", os.getcwd)()
+fake_exiftool = os.path.join(here, 'tests', 'fake_exiftool.py')
+have_exiftool = which('exiftool') is not None
 
 def does_file_have_gps_tags(filename):
     retval = subprocess.check_output(
@@ -191,6 +209,68 @@ class TestGPSValues(unittest.TestCase):
         with self.assertRaisesRegexp(ValueError, r'Unrecognized altitude value .*'):
             a = addgps.GPSAltitude("-cat")
 
+class TestCoordinates(unittest.TestCase):
+    def test_dms(self):
+        for text in ["33°21'23.7\"N", "33 21 23.7 N", "33:21:23.7N", "33d21m23.7s", "N 33 21 23.7"]:
+            a = addgps.GPSLatitude(text)
+            self.assertAlmostEqual(a.value(), 33.356583, places=5)
+            self.assertEqual(a.ref(), "N")
+        a = addgps.GPSLongitude("-116 51 53")
+        self.assertAlmostEqual(a.value(), 116.864722, places=5)
+        self.assertEqual(a.ref(), "E")
+        with self.assertRaisesRegexp(ValueError, r'Unrecognized latitude value .*'):
+            addgps.GPSLatitude("33 75 00 N")
+        with self.assertRaisesRegexp(ValueError, r'Unrecognized longitude value .*'):
+            addgps.GPSLongitude("33 21 23 N")
+
+    def test_altitude_units(self):
+        self.assertAlmostEqual(addgps.GPSAltitude("100ft").value(), 30.4)
+        self.assertAlmostEqual(addgps.GPSAltitude("100 feet").value(), 30.4)
+        self.assertAlmostEqual(addgps.GPSAltitude("100m").value(), 100.0)
+        self.assertEqual(addgps.GPSAltitude("-10f").ref(), "Below sea level")
+
+    def test_geohash(self):
+        lat, lon = addgps.decode_geohash("9q8yyk8yutp")
+        self.assertAlmostEqual(lat, 37.7749, places=3)
+        self.assertAlmostEqual(lon, -122.4194, places=3)
+        self.assertEqual(addgps.geohash_coordinates("9q8yyk"), ("37.773743N", "122.415161W"))
+        self.assertEqual(addgps.geohash_coordinates("home"), None)
+        aliases = addgps.handle_aliases(("abcd=1, 2",))
+        jobs = list(addgps.mapping_jobs(["a.jpg,9q8yyk\n", "b.jpg,abcd\n"], aliases))
+        self.assertEqual(jobs[0][1][:2], ['-GPSLatitude=37.773743', '-GPSLatitudeRef=N'])
+        self.assertEqual(jobs[1][1][:2], ['-GPSLatitude=1.0', '-GPSLatitudeRef=N'])
+
+    def test_batch(self):
+        batch = addgps.parse_coordinates_batch(
+            ["33.3", "-12", "95", "cat", "1"], ["44.4E", "7", "10", "1", "200"],
+            ["", "100f", None, "1", "2"])
+        self.assertEqual(list(batch.errors), [False, False, True, True, True])
+        self.assertEqual(batch.latitude_refs[:2], ["N", "S"])
+        self.assertAlmostEqual(batch.altitudes[1], 30.4)
+        self.assertEqual(sorted(batch.messages), [2, 3, 4])
+        self.assertEqual(batch.messages[2], "Latitude value is out of range: 95.0")
+        self.assertEqual(batch.messages[4], "Longitude value is out of range: 200.0")
+        # A batch produces exactly the arguments of the scalar classes
+        self.assertEqual(addgps.batch_arguments(batch, 1), addgps.gps_arguments(
+            addgps.GPSLatitude("-12"), addgps.GPSLongitude("7"), addgps.GPSAltitude("100f")))
+        self.assertEqual(addgps.batch_arguments(batch, 0)[-1], '-GPSLongitudeRef=E')
+        self.assertEqual(addgps.batch_arguments(batch, 2), None)
+
+    def test_batch_without_numpy(self):
+        numpy = addgps.numpy
+        addgps.numpy = None
+        try:
+            batch = addgps.parse_coordinates_batch(["1", "91"], ["2", "3"])
+        finally:
+            addgps.numpy = numpy
+        self.assertEqual(list(batch.errors), [False, True])
+        self.assertEqual(batch.messages, {1: "Latitude value is out of range: 91.0"})
+
+    def test_batched_mapping(self):
+        lines = ["a.png,1,2\n", "b.png,95,2\n", "c.png,nowhere\n", "d.png,3,4,5\n"]
+        self.assertEqual(list(addgps.mapping_jobs(lines, {}, batch_size=3)),
+                         list(addgps.mapping_jobs(lines, {})))
+
 class TestFiles(unittest.TestCase):
     tempdir = None
     datadir = os.path.join(here, 'data')
@@ -223,5 +303,1528 @@ class TestFiles(unittest.TestCase):
 
         shutil.rmtree(self.tempdir)
 
+class TestExiftoolEngine(unittest.TestCase):
+    tempdir = None
+    datadir = os.path.join(here, 'data')
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        shutil.copy(os.path.join(self.datadir, "saturn.jpg"), "./")
+
+    def test_parse_output(self):
+        r = addgps.parse_exiftool_output(b"    1 image files updated\n{ready3}\n",
+                                         b"Warning: foo\n1{ready3}\n", "{ready3}")
+        self.assertEqual(r, (1, "    1 image files updated", "Warning: foo"))
+
+    def test_parse_output_without_status(self):
+        r = addgps.parse_exiftool_output(b"{ready1}\n",
+                                         b"Error: Not a valid JPG - x\n${status}{ready1}\n",
+                                         "{ready1}")
+        self.assertEqual(r, (1, "", "Error: Not a valid JPG - x"))
+
+    def test_engine_sequence(self):
+        with addgps.ExiftoolEngine(fake_exiftool) as engine:
+            r = engine.execute(["-GPSLatitude=33.3", "saturn.jpg"])
+            self.assertEqual(r.returncode, 0)
+            self.assertEqual(r.stdout, "    1 image files updated")
+            r = engine.execute(["-GPSLatitude=33.3", "corrupt.jpg"])
+            self.assertEqual(r.returncode, 1)
+            self.assertEqual(r.stderr, "Error: Not a valid JPG - corrupt.jpg")
+            r = engine.execute(["-GPS*", "saturn.jpg"])
+            self.assertIn("33.3", r.stdout)
+            process = engine.process
+        self.assertIsNone(engine.process)
+        self.assertIsNotNone(process.returncode)
+
+    def test_engine_lazy_start(self):
+        with addgps.ExiftoolEngine(fake_exiftool) as engine:
+            addgps.add_gps_to_file("saturn.jpg", addgps.GPSLatitude("1"),
+                                   addgps.GPSLongitude("2"), addgps.GPSAltitude("10"),
+                                   True, engine)
+            self.assertIsNone(engine.process)
+
+    def tearDown(self):
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+class TestBatch(unittest.TestCase):
+    tempdir = None
+    datadir = os.path.join(here, 'data')
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        for name in ("a.jpg", "b.jpg", "corrupt.jpg"):
+            shutil.copy(os.path.join(self.datadir, "saturn.jpg"), name)
+
+    def test_argfile_chunks(self):
+        files = ["f{}.jpg".format(i) for i in range(10)]
+        self.assertEqual([len(c) for c in addgps.argfile_chunks(files, size=4)], [4, 4, 2])
+        self.assertEqual([len(c) for c in addgps.argfile_chunks(files, limit=16)],
+                         [2, 2, 2, 2, 2])
+
+    def test_split_batch_result(self):
+        result = addgps.ExiftoolResult(
+            1, "    1 image files updated\n    1 files weren't updated due to errors",
+            "Error: Not a valid JPG - b.jpg\nWarning: [minor] odd - a.jpg")
+        self.assertEqual(addgps.split_batch_result(["a.jpg", "b.jpg", "c.jpg"], result),
+                         [("a.jpg", 0, "Warning: [minor] odd - a.jpg"),
+                          ("b.jpg", 1, "Error: Not a valid JPG - b.jpg"),
+                          ("c.jpg", 0, "")])
+
+    def test_run_jobs(self):
+        files = ["a.jpg", "corrupt.jpg", "missing.jpg", "b.jpg"]
+        arguments = addgps.gps_arguments(addgps.GPSLatitude("33.3"), addgps.GPSLongitude("44.4"),
+                                         addgps.GPSAltitude(None))
+        with addgps.ExiftoolEngine(fake_exiftool) as engine:
+            results = list(addgps.run_jobs([(name, arguments) for name in files], False, engine))
+            self.assertEqual(engine.sequence, 1)
+        self.assertEqual([r.filename for r in results], files)
+        self.assertEqual([r.returncode for r in results], [0, 1, 1, 0])
+
+    def test_shard_by_size(self):
+        sizes = {"a.jpg": 100, "b.jpg": 10, "corrupt.jpg": 60, "c.jpg": 50}
+        for name, size in sizes.items():
+            with open(name, "wb") as f:
+                f.write(b"x" * size)
+        shards = addgps.shard_by_size(["a.jpg", "b.jpg", "corrupt.jpg", "c.jpg"], 2)
+        self.assertEqual(shards, [["a.jpg", "b.jpg"], ["corrupt.jpg", "c.jpg"]])
+
+    def test_pool(self):
+        files = ["a.jpg", "corrupt.jpg", "b.jpg"] * 3
+        with addgps.ExiftoolPool(3, fake_exiftool) as pool:
+            results = list(addgps.run_jobs([(name, ["-GPS*="]) for name in files], False, pool))
+            started = [engine.process is not None for engine in pool.engines]
+        self.assertEqual([r.filename for r in results], files)
+        self.assertEqual([r.returncode for r in results], [0, 1, 0] * 3)
+        self.assertEqual(started, [True, True, True])
+
+    def test_group_by_arguments(self):
+        groups = addgps.group_by_arguments([("a", ["-x"]), ("b", ["-y"]), ("c", ["-x"])])
+        self.assertEqual(list(groups.items()), [(("-x",), ["a", "c"]), (("-y",), ["b"])])
+
+    def tearDown(self):
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+class TestNativeWriter(unittest.TestCase):
+    tempdir = None
+    datadir = os.path.join(here, 'data')
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        shutil.copy(os.path.join(self.datadir, "saturn.jpg"), "./")
+        self.lat = addgps.GPSLatitude("33.356593")
+        self.lon = addgps.GPSLongitude("116.864816")
+        self.alt = addgps.GPSAltitude("-12")
+
+    def test_new_exif(self):
+        with open("saturn.jpg", "rb") as f:
+            original = f.read()
+        self.assertEqual(addgps.add_gps_to_file("saturn.jpg", self.lat, self.lon, self.alt,
+                                                False, native=True), 0)
+        tags = addgps.read_jpeg_gps("saturn.jpg")
+        self.assertEqual(tags[1], "N")
+        self.assertEqual(tags[2][:2], [33.0, 21.0])
+        self.assertAlmostEqual(tags[2][2], 23.7348)
+        self.assertEqual(tags[3], "W")
+        self.assertEqual(tags[5], [1])
+        self.assertAlmostEqual(tags[6][0], 12.0)
+        with open("saturn.jpg", "rb") as f:
+            self.assertTrue(f.read().endswith(original[20:]))
+
+    def test_large_altitude(self):
+        arguments = addgps.gps_arguments(self.lat, self.lon, addgps.GPSAltitude("5000000"))
+        self.assertTrue(addgps.write_gps_native("saturn.jpg", arguments))
+        self.assertAlmostEqual(addgps.read_jpeg_gps("saturn.jpg")[6][0], 5000000.0)
+        arguments = [argument.replace("5000000", "50000000000") for argument in arguments]
+        self.assertIsNone(addgps.native_job("saturn.jpg", arguments, False))
+
+    def test_damaged_gps(self):
+        arguments = addgps.gps_arguments(self.lat, self.lon, self.alt)
+        self.assertTrue(addgps.write_gps_native("saturn.jpg", arguments))
+        with open("saturn.jpg", "rb") as f:
+            data = f.read()
+        for endian in "<>":
+            entry = struct.pack(endian + "HHI", 1, 2, 2)
+            if entry in data:
+                data = data.replace(entry, struct.pack(endian + "HHI", 1, 99, 2), 1)
+        with open("saturn.jpg", "wb") as f:
+            f.write(data)
+        self.assertRaises(addgps.NativeWriterError, addgps.read_jpeg_gps, "saturn.jpg")
+        with addgps.ExiftoolEngine(fake_exiftool) as engine:
+            self.assertEqual(addgps.read_gps_bulk(["saturn.jpg"], engine), {"saturn.jpg": None})
+
+    def test_rewrite_in_place(self):
+        addgps.add_gps_to_file("saturn.jpg", self.lat, self.lon, self.alt, False, native=True)
+        before = os.stat("saturn.jpg")
+        addgps.add_gps_to_file("saturn.jpg", addgps.GPSLatitude("10S"), self.lon, self.alt,
+                               False, native=True)
+        after = os.stat("saturn.jpg")
+        self.assertEqual((before.st_ino, before.st_size), (after.st_ino, after.st_size))
+        self.assertEqual(addgps.read_jpeg_gps("saturn.jpg")[1], "S")
+
+    def test_existing_exif(self):
+        # IFD0 with a Make tag, as little endian TIFF
+        make = b"Saturn cam\x00"
+        tiff = b"II\x2a\x00" + struct.pack("<IHHHII", 8, 1, 0x10f, 2, len(make), 26) + \
+            struct.pack("<I", 0) + make
+        segment = b"\xff\xe1" + struct.pack(">H", len(tiff) + 8) + b"Exif\x00\x00" + tiff
+        with open("saturn.jpg", "rb") as f:
+            data = f.read()
+        with open("saturn.jpg", "wb") as f:
+            f.write(data[:20] + segment + data[20:])
+
+        addgps.add_gps_to_file("saturn.jpg", self.lat, self.lon, self.alt, False, native=True)
+        with open("saturn.jpg", "rb") as f:
+            start, end, tiff = addgps.find_exif_segment(f.read())
+        entries, _ = addgps.read_ifd(tiff, struct.unpack("<I", tiff[4:8])[0], "<")
+        self.assertEqual([e.tag for e in entries], [0x10f, addgps.GPS_IFD_POINTER])
+        self.assertEqual(addgps.entry_value(tiff, entries[0], "<"), "Saturn cam")
+        self.assertEqual(addgps.read_jpeg_gps("saturn.jpg")[3], "W")
+
+    def test_write_strategy(self):
+        arguments = addgps.gps_arguments(self.lat, self.lon, self.alt)
+        before = os.stat("saturn.jpg")
+        self.assertTrue(addgps.write_gps_native(
+            "saturn.jpg", addgps.WRITE_STRATEGIES["in-place"] + arguments))
+        after = os.stat("saturn.jpg")
+        self.assertEqual(before.st_ino, after.st_ino)
+        self.assertGreater(after.st_size, before.st_size)
+        self.assertEqual(addgps.read_jpeg_gps("saturn.jpg")[3], "W")
+        self.assertFalse(os.path.exists("saturn.jpg_original"))
+
+        shutil.copy(os.path.join(self.datadir, "saturn.jpg"), "saturn.jpg")
+        addgps.write_gps_native("saturn.jpg", addgps.WRITE_STRATEGIES["overwrite"] + arguments)
+        self.assertFalse(os.path.exists("saturn.jpg_original"))
+        addgps.write_gps_native("saturn.jpg", arguments)
+        with open("saturn.jpg_original", "rb") as f, open("saturn.jpg", "rb") as g:
+            self.assertEqual(f.read(), g.read())
+
+    def test_same_size_strategy(self):
+        arguments = addgps.gps_arguments(self.lat, self.lon, self.alt)
+        for strategy, same_inode in (("overwrite", False), ("in-place", True)):
+            options = addgps.WRITE_STRATEGIES[strategy]
+            shutil.copy(os.path.join(self.datadir, "saturn.jpg"), "saturn.jpg")
+            self.assertTrue(addgps.write_gps_native("saturn.jpg", options + arguments))
+            before = os.stat("saturn.jpg")
+            self.assertTrue(addgps.write_gps_native("saturn.jpg", options + arguments))
+            after = os.stat("saturn.jpg")
+            self.assertEqual(after.st_size, before.st_size)
+            self.assertEqual(after.st_ino == before.st_ino, same_inode)
+            self.assertEqual(addgps.read_jpeg_gps("saturn.jpg")[3], "W")
+
+    def test_strategy_arguments(self):
+        arguments = addgps.gps_arguments(self.lat, self.lon, self.alt)
+        jobs = list(addgps.with_strategy([("a.jpg", arguments), ("b.jpg", None)], "overwrite"))
+        self.assertEqual(jobs[0][1], ["-overwrite_original"] + arguments)
+        self.assertIsNone(jobs[1][1])
+        self.assertEqual(addgps.strategy_of(jobs[0][1]), "overwrite")
+        self.assertEqual(addgps.strategy_of(arguments), "backup")
+        self.assertEqual(addgps.argument_tags(jobs[0][1]), addgps.argument_tags(arguments))
+
+    def test_synced(self):
+        results = [addgps.FileResult("saturn.jpg", 0, ""), addgps.FileResult("missing.jpg", 1, ""),
+                   addgps.FileResult("saturn.jpg", 0, "")]
+        synced = addgps.synced(iter(results), 2)
+        self.assertEqual(list(synced), results)
+
+    def test_unhandled(self):
+        shutil.copy("saturn.jpg", "saturn.png")
+        arguments = addgps.gps_arguments(self.lat, self.lon, self.alt)
+        self.assertFalse(addgps.write_gps_native("saturn.png", arguments))
+        self.assertFalse(addgps.write_gps_native("saturn.jpg", ["-City=Paris"] + arguments))
+        with open("broken.jpg", "wb") as f:
+            f.write(b"not a jpeg")
+        self.assertIsNone(addgps.native_job("broken.jpg", arguments, False))
+
+    @unittest.skipUnless(have_exiftool, "exiftool is not installed")
+    def test_same_as_exiftool(self):
+        shutil.copy("saturn.jpg", "exiftool.jpg")
+        addgps.add_gps_to_file("saturn.jpg", self.lat, self.lon, self.alt, False, native=True)
+        addgps.add_gps_to_file("exiftool.jpg", self.lat, self.lon, self.alt, False)
+        output = json.loads(subprocess.check_output(
+            ['exiftool', '-j', '-n', '-GPS:all', 'saturn.jpg', 'exiftool.jpg']))
+        native, reference = output
+        for tag in ('GPSLatitude', 'GPSLongitude', 'GPSAltitude'):
+            self.assertAlmostEqual(native[tag], reference[tag], places=5)
+        for tag in ('GPSLatitudeRef', 'GPSLongitudeRef', 'GPSAltitudeRef'):
+            self.assertEqual(native[tag], reference[tag])
+
+    def tearDown(self):
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+XMP = u"""<?xpacket begin="" id="W5M0MpCehiHzreSzNTczkc9d"?>
+<x:xmpmeta xmlns:x="adobe:ns:meta/">
+ <rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">
+  <rdf:Description rdf:about="" xmlns:xmp="http://ns.adobe.com/xap/1.0/"
+    xmlns:exif="http://ns.adobe.com/exif/1.0/" xmp:Rating="4" exif:GPSLatitude="1,0.0N">
+   <exif:GPSLongitude>2,0.0E</exif:GPSLongitude>
+  </rdf:Description>
+ </rdf:RDF>
+</x:xmpmeta>
+<?xpacket end="w"?>
+"""
+
+class TestSidecar(unittest.TestCase):
+    tempdir = None
+    exif = "{http://ns.adobe.com/exif/1.0/}"
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        for name in ("a.CR2", "b.cr2", "c.jpg"):
+            with open(name, "wb") as f:
+                f.write(b"raw")
+        self.arguments = addgps.gps_arguments(addgps.GPSLatitude("33.356593"),
+                                              addgps.GPSLongitude("116.864816"),
+                                              addgps.GPSAltitude("-12"))
+
+    def description(self, name):
+        """Return the rdf:Description of a sidecar"""
+        tree = addgps.ElementTree.parse(name)
+        return tree.find(".//{http://www.w3.org/1999/02/22-rdf-syntax-ns#}Description")
+
+    def test_write(self):
+        with open("b.xmp", "w") as f:
+            f.write(XMP)
+        args = addgps.handle_arguments(["--sidecar", "a.CR2", "b.cr2", "c.jpg"])
+        with addgps.ExiftoolEngine(fake_exiftool) as engine:
+            results = list(addgps.run_jobs([(name, self.arguments) for name in args.filelist],
+                                           False, engine, sidecars=addgps.sidecar_extensions(args)))
+        self.assertEqual([r.returncode for r in results], [0, 0, 0])
+        self.assertFalse(os.path.exists("c.xmp"))
+        self.assertTrue(os.path.exists("c.jpg.fake.json"))
+        with open("a.CR2", "rb") as f:
+            self.assertEqual(f.read(), b"raw")
+
+        description = self.description("a.xmp")
+        self.assertEqual(description.get(self.exif + "GPSLatitude"), "33,21.395580N")
+        self.assertEqual(description.get(self.exif + "GPSLongitude"), "116,51.888960W")
+        self.assertEqual(description.get(self.exif + "GPSAltitude"), "12000/1000")
+        self.assertEqual(description.get(self.exif + "GPSAltitudeRef"), "1")
+
+        # Other properties of an existing sidecar are kept
+        description = self.description("b.xmp")
+        self.assertEqual(description.get("{http://ns.adobe.com/xap/1.0/}Rating"), "4")
+        self.assertEqual(description.get(self.exif + "GPSLatitude"), "33,21.395580N")
+        self.assertEqual(len(description), 0)
+        with open("b.xmp", "rb") as f:
+            self.assertIn(b"xmp:Rating", f.read())
+
+        results = list(addgps.run_jobs([("b.cr2", ["-GPS*="]), ("d.cr2", ["-GPS*="])], False,
+                                       sidecars=frozenset([".cr2"])))
+        self.assertEqual([r.returncode for r in results], [0, 1])
+        description = self.description("b.xmp")
+        self.assertEqual(sorted(description.attrib), ["{http://ns.adobe.com/xap/1.0/}Rating",
+                                                      "{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about"])
+
+    def test_policy(self):
+        args = addgps.handle_arguments(["--sidecar", "--sidecar-ext", "jpg,cr2", "a.CR2"])
+        self.assertEqual(addgps.sidecar_extensions(args), frozenset([".jpg", ".cr2"]))
+        args = addgps.handle_arguments(["--sidecar", "--sidecar-ext", "*", "a.CR2"])
+        self.assertTrue(addgps.wants_sidecar("x.tif", addgps.sidecar_extensions(args)))
+        args = addgps.handle_arguments(["a.CR2"])
+        self.assertFalse(addgps.wants_sidecar("a.CR2", addgps.sidecar_extensions(args)))
+        with self.assertRaises(SystemExit):
+            addgps.handle_arguments(["--sidecar-ext", "cr2", "a.CR2"])
+
+        with open("c.xmp", "w") as f:
+            f.write(u"<not-xmp/>")
+        result = addgps.sidecar_job("c.jpg", self.arguments, False)
+        self.assertEqual(result.returncode, 1)
+        self.assertEqual(addgps.sidecar_job("c.jpg", ["-Make=x"], True).returncode, 1)
+
+    def tearDown(self):
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+GPX = u"""<?xml version="1.0" encoding="UTF-8"?>
+<gpx version="1.1" creator="test" xmlns="http://www.topografix.com/GPX/1/1">
+ <trk><trkseg>
+  <trkpt lat="10.0" lon="179.9"><ele>100</ele><time>2015-01-08T12:00:00Z</time></trkpt>
+  <trkpt lat="11.0" lon="-179.9"><ele>200</ele><time>2015-01-08T12:10:00Z</time></trkpt>
+ </trkseg><trkseg>
+  <trkpt lat="20.0" lon="20.0"><time>2015-01-08T14:00:00Z</time></trkpt>
+  <trkpt lat="12.0" lon="-170.0"><time>2015-01-08T12:20:00.5+00:00</time></trkpt>
+ </trkseg></trk>
+</gpx>
+"""
+
+class TestTrack(unittest.TestCase):
+    tempdir = None
+    datadir = os.path.join(here, 'data')
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        with open("track.gpx", "w") as f:
+            f.write(GPX)
+        self.track = addgps.GPSTrack.from_gpx("track.gpx")
+        self.noon = addgps.parse_iso_time("2015-01-08T12:00:00Z")
+
+    def test_times(self):
+        self.assertEqual(addgps.parse_iso_time("2015-01-08T13:00:00+01:00"), self.noon)
+        self.assertEqual(addgps.parse_exif_time("2015:01:08 04:00:00", -8 * 3600), self.noon)
+        self.assertEqual(addgps.parse_exif_time("2015:01:08 13:00:00+01:00", 0), self.noon)
+        self.assertIsNone(addgps.parse_exif_time(None))
+        self.assertEqual(addgps.parse_time_offset("-08:00"), -8 * 3600)
+        self.assertEqual(addgps.parse_time_offset("+0530"), 5.5 * 3600)
+
+    def test_parse(self):
+        self.assertEqual(len(self.track), 4)
+        self.assertEqual(list(self.track.lats), [10.0, 11.0, 12.0, 20.0])
+
+    def test_locate(self):
+        lat, lon, ele = self.track.locate(self.noon + 300)
+        self.assertAlmostEqual(lat, 10.5)
+        self.assertAlmostEqual(abs(lon), 180.0)
+        self.assertAlmostEqual(ele, 150.0)
+        self.assertEqual(self.track.locate(self.noon)[:2], (10.0, 179.9))
+        self.assertIsNone(self.track.locate(self.noon - 1))
+        self.assertIsNone(self.track.locate(self.noon + 3600, max_gap=1800))
+        self.assertIsNotNone(self.track.locate(self.noon + 3600, max_gap=7200))
+
+    def test_locate_all(self):
+        times = [self.noon + t for t in (-5, 0, 300, 700, 3000, 9000)]
+        expected = [self.track.locate(t) for t in times]
+        self.assertEqual(repr(self.track.locate_all(times)), repr(expected))
+        times.reverse()
+        expected.reverse()
+        self.assertEqual(repr(self.track.locate_all(times + [None])), repr(expected + [None]))
+
+    def test_geotag(self):
+        for name in ("a.jpg", "b.png", "c.jpg"):
+            shutil.copy(os.path.join(self.datadir, "saturn.jpg"), name)
+        with addgps.ExiftoolEngine(fake_exiftool) as engine:
+            engine.execute(["-DateTimeOriginal=2015:01:08 04:02:30", "a.jpg", "b.png"])
+            args = addgps.handle_arguments(["--gpx", "track.gpx", "--time-offset", "-8",
+                                            "a.jpg", "b.png", "c.jpg"])
+            results = list(addgps.geotag_from_track(args.filelist, self.track, args, engine))
+            self.assertEqual([r.returncode for r in results], [0, 0, 1])
+            self.assertEqual(addgps.read_jpeg_gps("a.jpg")[1], "N")
+            tags = addgps.read_tags(["b.png"], ["-n", "-GPS*"], engine)[0][1]
+            self.assertEqual((tags["GPSLatitude"], tags["GPSLongitudeRef"]), (10.25, "E"))
+
+    def tearDown(self):
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+NMEA = u"""$GPGGA,115959,1000.000,N,17954.000,E,1,08,0.9,50.0,M,,,,*47
+$GPRMC,120000,A,1000.000,N,17954.000,E,0.0,0.0,080115,,,A*6A
+$GPGGA,120000,1000.000,N,17954.000,E,1,08,0.9,100.0,M,,,,*47
+$GPRMC,121000,V,1100.000,N,17954.000,W,0.0,0.0,080115,,,N*6A
+$GPGGA,121000.50,1100.000,N,17954.000,W,1,08,0.9,200.0,M,,,,*47
+$GPRMC,121000.50,A,1100.000,N,17954.000,W,0.0,0.0,080115,,,A*6A
+$GPRMC,garbage
+"""
+
+class TestTrackStore(unittest.TestCase):
+    tempdir = None
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        os.makedirs(os.path.join("logs", "2015"))
+        with open(os.path.join("logs", "2015", "track.gpx"), "w") as f:
+            f.write(GPX)
+        self.noon = addgps.parse_iso_time("2015-01-08T12:00:00Z")
+        self.block = addgps.TRACK_BLOCK
+        addgps.TRACK_BLOCK = 2
+
+    def write_log(self, name, start, count):
+        """Write a GPX log of count points, a minute apart, going north"""
+        with open(os.path.join("logs", name), "w") as f:
+            f.write(u'<gpx xmlns="http://www.topografix.com/GPX/1/1"><trk><trkseg>')
+            for i in range(count):
+                f.write(u'<trkpt lat="{}" lon="0"><time>{}</time></trkpt>'.format(
+                    i, addgps.utc_text(start + 60 * i)))
+            f.write(u'</trkseg></trk></gpx>')
+
+    def test_nmea(self):
+        with open("track.nmea", "w") as f:
+            f.write(NMEA)
+        track = addgps.GPSTrack.from_file("track.nmea")
+        self.assertEqual(list(track.times), [self.noon, self.noon + 600.5])
+        self.assertEqual(list(track.lats), [10.0, 11.0])
+        self.assertEqual(list(track.lons), [179.9, -179.9])
+        self.assertEqual(list(track.eles), [100.0, 200.0])
+
+    def test_build(self):
+        store = addgps.TrackStore("store")
+        self.write_log("a.gpx", self.noon + 86400, 3)
+        self.assertEqual(store.build(["logs"]), (2, 0, 0))
+        self.assertEqual(len(store), 7)
+        self.assertEqual(len(addgps.TrackStore("store").state["sources"]), 2)
+
+        track = addgps.GPSTrack.from_gpx(os.path.join("logs", "2015", "track.gpx"))
+        times = [self.noon + t for t in (-5, 0, 300, 700, 3000, 9000, 86400 + 90, 86400 + 200)]
+        expected = [track.locate(t) for t in times[:6]] + [(1.5, 0.0), None]
+        located = [p and p[:2] for p in store.locate_all(times[6:] + [None])]
+        self.assertEqual(repr(store.locate_all(times[:6])), repr(expected[:6]))
+        self.assertEqual(located, expected[6:] + [None])
+
+        # Only new or changed logs are read again
+        self.assertEqual(store.build(["logs"]), (0, 0, 0))
+        self.write_log("b.nmea", 0, 0)
+        self.write_log("a.gpx", self.noon + 660, 3)
+        with open(os.path.join("logs", "broken.gpx"), "w") as f:
+            f.write(u"<gpx>")
+        self.assertEqual(store.build(["logs"]), (2, 0, 1))
+        self.assertEqual(len(store), 7)
+        # Overlapping logs are merged in time order
+        self.assertEqual(store.locate(self.noon + 660)[:2], (0.0, 0.0))
+        self.assertEqual(store.locate(self.noon + 750)[:2], (1.5, 0.0))
+        self.assertEqual(store.locate(self.noon + 630)[0], 5.5)
+
+        os.remove(os.path.join("logs", "a.gpx"))
+        self.assertEqual(store.build(["elsewhere"]), (0, 0, 1))
+        self.assertEqual(store.build(["logs"]), (0, 1, 1))
+        self.assertEqual(len(store), 4)
+        self.assertEqual(len(os.listdir("store")), 4)
+        self.assertEqual(len(os.listdir(os.path.join("store", "segments"))), 2)
+        store.close()
+
+    def test_command(self):
+        self.assertEqual(addgps.main(["track-index", "--track-store", "store", "-q",
+                                      "build", "logs"]), 0)
+        with self.assertRaises(SystemExit):
+            addgps.handle_arguments(["--track-index", "--gpx", "track.gpx", "a.jpg"])
+        args = addgps.handle_arguments(["--track-index", "--track-store", "store", "a.jpg"])
+        self.assertEqual(args.track_store, "store")
+        with open(os.path.join("store", "store.json"), "w") as f:
+            f.write("{}")
+        with self.assertRaises(SystemExit):
+            addgps.handle_arguments(["--track-index", "--track-store", "store", "a.jpg"])
+
+    def tearDown(self):
+        addgps.TRACK_BLOCK = self.block
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+class TestMapping(unittest.TestCase):
+    tempdir = None
+    datadir = os.path.join(here, 'data')
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        for name in ("a.png", "b.png"):
+            shutil.copy(os.path.join(self.datadir, "saturn.jpg"), name)
+        self.aliases = addgps.handle_aliases(("home=33.3N, 44.4E, 100",))
+
+    def test_csv(self):
+        lines = ["path,lat,lon,alt\n", "a.png, 33.3, 44.4\n", "# comment\n", "\n",
+                 "\"b.png\",home\n", "c.png,95,10\n", "d.png,nowhere\n"]
+        jobs = list(addgps.mapping_jobs(lines, self.aliases))
+        self.assertEqual([f for f, _ in jobs], ["a.png", "b.png", "c.png", "d.png"])
+        self.assertEqual(jobs[0][1], ['-GPSLatitude=33.3', '-GPSLatitudeRef=N',
+                                      '-GPSLongitude=44.4', '-GPSLongitudeRef=W'])
+        self.assertIn('-GPSAltitude=100.0', jobs[1][1])
+        self.assertEqual([a for _, a in jobs[2:]], [None, None])
+
+    def test_jsonl(self):
+        lines = ['{"path": "a.png", "lat": -33.25, "lon": 1e-05, "alt": 12}\n',
+                 '{"path": "b.png", "alias": "home"}\n', '{"path": broken\n']
+        jobs = list(addgps.mapping_jobs(lines, self.aliases))
+        self.assertEqual(len(jobs), 2)
+        self.assertEqual(jobs[0][1][:2], ['-GPSLatitude=33.25', '-GPSLatitudeRef=S'])
+        self.assertEqual(jobs[0][1][2], '-GPSLongitude=1e-05')
+
+    def test_streaming(self):
+        # The mapping must be consumed line by line, as it is written
+        consumed = []
+        def lines():
+            for line in ["a.png,1,2\n", "b.png,3,4\n"]:
+                consumed.append(line)
+                yield line
+        jobs = addgps.mapping_jobs(lines(), {})
+        next(jobs)
+        self.assertEqual(len(consumed), 1)
+
+    def test_batches(self):
+        self.assertEqual(list(addgps.batches(range(5), 2)), [[0, 1], [2, 3], [4]])
+        self.assertEqual(list(addgps.batches(range(5), 10, lambda taken: taken != 2)),
+                         [[0, 1], [2, 3, 4]])
+        self.assertEqual(list(addgps.batches("abacb", 10, key=lambda c: c)),
+                         [["a", "b"], ["a", "c", "b"]])
+
+    def test_pipe(self):
+        # Every record read from a pipe is written before the next one
+        # arrives, also by a pool whose batches are many records long
+        args = addgps.handle_arguments(["--mapping", "-", "--backend", "native"])
+        for incremental in (False, True):
+            names = ["c{}.jpg".format(i) for i in range(3)]
+            for name in names:
+                shutil.copy(os.path.join(self.datadir, "saturn.jpg"), name)
+            r, w = os.pipe()
+            closed = threading.Event()
+            def close(w=w, closed=closed):
+                if not closed.is_set():
+                    closed.set()
+                    os.close(w)
+            timer = threading.Timer(10, close)
+            timer.start()
+            with addgps.ExiftoolPool(3, fake_exiftool) as pool, \
+                 addgps.Manifest("manifest.db") as manifest, os.fdopen(r) as stream:
+                try:
+                    lines = addgps.StreamedLines(stream)
+                    jobs = lines.count(addgps.mapping_jobs(lines, {}))
+                    results = addgps.write_jobs(jobs, args, pool,
+                                                manifest if incremental else None,
+                                                ready=lines.ready)
+                    for name in names:
+                        os.write(w, "{}, 1, 2\n".format(name).encode("ascii"))
+                        result = next(results)
+                        self.assertFalse(closed.is_set())
+                        self.assertEqual((result.filename, result.returncode), (name, 0))
+                        self.assertTrue(addgps.read_jpeg_gps(name))
+                finally:
+                    timer.cancel()
+                    close()
+                self.assertEqual(list(results), [])
+
+    def test_repeated_file(self):
+        # A later record for the same file is a correction, written after the first
+        shutil.copy(os.path.join(self.datadir, "saturn.jpg"), "c.jpg")
+        lines = ["c.jpg,1,2\n", "a.png,5,6\n", "c.jpg,30,40\n", "a.png,7,8\n"]
+        with addgps.ExiftoolPool(2, fake_exiftool) as pool:
+            results = list(addgps.run_jobs(addgps.mapping_jobs(lines, {}), False, pool,
+                                           native=True))
+        self.assertEqual([(r.filename, r.returncode) for r in results],
+                         [("c.jpg", 0), ("a.png", 0), ("c.jpg", 0), ("a.png", 0)])
+        self.assertEqual(addgps.gps_ifd_coordinates(addgps.read_jpeg_gps("c.jpg"))[:2],
+                         (30.0, -40.0))
+        with open("a.png.fake.json") as f:
+            self.assertEqual(float(json.load(f)["GPSLatitude"]), 7.0)
+
+    def test_run(self):
+        lines = ["a.png,1,2\n", "missing.png,3,4\n", "b.png,95,4\n"]
+        with addgps.ExiftoolEngine(fake_exiftool) as engine:
+            results = list(addgps.run_jobs(addgps.mapping_jobs(lines, {}), False, engine))
+        self.assertEqual([(r.filename, r.returncode) for r in results],
+                         [("a.png", 0), ("missing.png", 1), ("b.png", 1)])
+
+    def tearDown(self):
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+class TestManifest(unittest.TestCase):
+    tempdir = None
+    datadir = os.path.join(here, 'data')
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        for name in ("a.jpg", "b.png", "c.png"):
+            shutil.copy(os.path.join(self.datadir, "saturn.jpg"), name)
+        self.arguments = addgps.gps_arguments(addgps.GPSLatitude("33.3"),
+                                              addgps.GPSLongitude("44.4E"),
+                                              addgps.GPSAltitude("-10"))
+
+    def run_incremental(self, engine, manifest, files):
+        return [r.returncode for r in addgps.run_incremental(
+            [(f, self.arguments) for f in files], False, engine, manifest, native=True)]
+
+    def test_signed_coordinates(self):
+        self.assertEqual(addgps.signed_coordinates(addgps.argument_tags(self.arguments)),
+                         (33.3, 44.4, -10.0))
+        # Plans of earlier versions have the values quoted
+        self.assertEqual(addgps.argument_tags(['-GPSLatitude="1.5"', '-GPSLatitudeRef=N']),
+                         {"GPSLatitude": "1.5", "GPSLatitudeRef": "N"})
+        tags = {1: "S", 2: [33.0, 18.0, 0.0], 3: "W", 4: [44.0, 24.0, 0.0]}
+        lat, lon, alt = addgps.gps_ifd_coordinates(tags)
+        self.assertAlmostEqual(lat, -33.3)
+        self.assertAlmostEqual(lon, -44.4)
+        self.assertIsNone(alt)
+
+    def test_same_position(self):
+        self.assertTrue(addgps.same_position((1, 179.999999, None), (1, -180.0, 5)))
+        self.assertFalse(addgps.same_position((1, 2, 3), (1, 2, None)))
+        self.assertFalse(addgps.same_position((1, 2, 3), (1.001, 2, 3)))
+
+    def test_skip(self):
+        with addgps.ExiftoolEngine(fake_exiftool) as engine, \
+             addgps.Manifest("manifest.db") as manifest:
+            # c.png already has the position, but the manifest does not know it
+            engine.execute(self.arguments + ["c.png"])
+            self.assertEqual(self.run_incremental(engine, manifest, ["a.jpg", "b.png", "c.png"]),
+                             [0, 0, None])
+            sequence = engine.sequence
+            self.assertEqual(self.run_incremental(engine, manifest, ["a.jpg", "b.png", "c.png"]),
+                             [None, None, None])
+            self.assertEqual(engine.sequence, sequence)
+
+            # a changed file is looked at again
+            addgps.add_gps_to_file("a.jpg", addgps.GPSLatitude("1"), addgps.GPSLongitude("2"),
+                                   addgps.GPSAltitude(None), False, native=True)
+            self.assertEqual(self.run_incremental(engine, manifest, ["a.jpg", "c.png"]),
+                             [0, None])
+
+    def tearDown(self):
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+class TestVerify(unittest.TestCase):
+    tempdir = None
+    datadir = os.path.join(here, 'data')
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        for name in ("a.jpg", "b.png", "c.png"):
+            shutil.copy(os.path.join(self.datadir, "saturn.jpg"), name)
+        self.arguments = addgps.gps_arguments(addgps.GPSLatitude("33.3"),
+                                              addgps.GPSLongitude("44.4E"),
+                                              addgps.GPSAltitude("-10"))
+
+    def test_verify(self):
+        jobs = [("a.jpg", self.arguments), ("b.png", self.arguments), ("c.png", ["-GPS*="]),
+                ("d.png", self.arguments)]
+        verifier = addgps.Verifier(hashes=True, executable=fake_exiftool)
+        with addgps.ExiftoolEngine(fake_exiftool) as engine:
+            engine.execute(self.arguments + ["c.png"])
+            results = list(verifier.results(addgps.run_jobs(verifier.jobs(jobs, 1), False, engine,
+                                                            batch_size=1, native=True), 1))
+        self.assertEqual([r.returncode for r in results], [0, 0, 0, 1])
+        self.assertEqual(results[3].message, "Not a file")
+        self.assertEqual(len(verifier.expected), 0)
+
+    def test_failures(self):
+        verifier = addgps.Verifier(hashes=True, executable=fake_exiftool)
+        jobs = [("a.jpg", self.arguments), ("b.png", self.arguments), ("c.png", ["-GPS*="])]
+        self.assertEqual(list(verifier.jobs(jobs)), jobs)
+        self.assertEqual(addgps.native_job("a.jpg", self.arguments, False).returncode, 0)
+        with open("a.jpg", "r+b") as f:
+            f.seek(-3, os.SEEK_END)
+            f.write(b"\x00")
+        with addgps.ExiftoolEngine(fake_exiftool) as engine:
+            engine.execute(self.arguments + ["c.png"])
+        results = list(verifier.results([addgps.FileResult(name, 0, "") for name, _ in jobs]))
+        self.assertEqual([r.message for r in results],
+                         ["Verification failed: the image data changed",
+                          "Verification failed: no GPS position was read back",
+                          "Verification failed: the GPS position is still there"])
+
+    def test_image_hash(self):
+        before = addgps.image_data_hash("a.jpg")
+        addgps.native_job("a.jpg", self.arguments, False)
+        self.assertEqual(addgps.image_data_hash("a.jpg"), before)
+        with open("a.jpg", "rb") as f:
+            segments = list(addgps.jpeg_segments(f.read()))
+            f.seek(0)
+            self.assertEqual(addgps.jpeg_image_offset(f), segments[-1][2])
+        with self.assertRaises(addgps.NativeWriterError):
+            addgps.jpeg_image_offset(io.BytesIO(b"\xff\xd8\xff\xe1\x00"))
+
+    def test_sidecar(self):
+        with open("e.xmp", "w") as f:
+            f.write(XMP)
+        self.assertEqual(addgps.read_sidecar_gps("e.xmp"), (1.0, 2.0, None))
+        with open("e.cr2", "wb") as f:
+            f.write(b"raw")
+        addgps.sidecar_job("e.cr2", self.arguments, False)
+        lat, lon, alt = addgps.read_sidecar_gps("e.xmp")
+        self.assertTrue(addgps.same_position((33.3, 44.4, -10.0), (lat, lon, alt)))
+
+        args = addgps.handle_arguments(["--verify", "--sidecar", "--backend", "exiftool",
+                                        "e.cr2"])
+        results = list(addgps.write_jobs([("e.cr2", self.arguments)], args, None))
+        self.assertEqual(results[0].returncode, 0)
+        with self.assertRaises(SystemExit):
+            addgps.handle_arguments(["--verify-hash", "e.cr2"])
+        with self.assertRaises(SystemExit):
+            addgps.handle_arguments(["--verify", "--plan", "x", "e.cr2"])
+
+    def tearDown(self):
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+class TestWithin(unittest.TestCase):
+    tempdir = None
+    datadir = os.path.join(here, 'data')
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        for name in ("a.png", "b.png", "c.png"):
+            shutil.copy(os.path.join(self.datadir, "saturn.jpg"), name)
+        self.aliases = {"home": ("33.356593", "116.864816", None)}
+
+    def test_parse(self):
+        place, lat, lon, radius = addgps.parse_geofence("home:200", self.aliases)
+        self.assertEqual((place, radius), ("home", 200.0))
+        self.assertAlmostEqual(lon, -116.864816)
+        self.assertEqual(addgps.parse_geofence("1.5, 2E : 10", {})[1:], (1.5, 2.0, 10.0))
+        for text in ("home", "home:-5", ":5", "nowhere:5", "home:far"):
+            self.assertRaises(ValueError, addgps.parse_geofence, text, self.aliases)
+
+    def test_matches(self):
+        fences = [("a", 0.0, 0.0, 1000.0), ("b", 0.0, 0.005, 1000.0), ("c", 50.0, 8.0, 10.0)]
+        positions = [(0.0, 0.0045, None), None, (50.00005, 8.0, 3.0), (10.0, 10.0, None),
+                     (0.0, -0.005, None)]
+        numpy = addgps.numpy
+        found = [addgps.geofence_matches(positions, fences)]
+        addgps.numpy = None
+        try:
+            found.append(addgps.geofence_matches(positions, fences))
+        finally:
+            addgps.numpy = numpy
+        for matches in found:
+            self.assertEqual([match and match[0] for match in matches], [0, None, 2, None, 0])
+            self.assertAlmostEqual(matches[0][1], 500.4, places=0)
+            self.assertAlmostEqual(matches[2][1], 5.6, places=0)
+        self.assertEqual(addgps.geofence_matches([None], fences), [None])
+
+    def test_remove(self):
+        near = addgps.gps_arguments(addgps.GPSLatitude("33.357"), addgps.GPSLongitude("116.865"),
+                                    addgps.GPSAltitude(None))
+        far = addgps.gps_arguments(addgps.GPSLatitude("33.4"), addgps.GPSLongitude("116.865"),
+                                   addgps.GPSAltitude(None))
+        args = addgps.handle_arguments(["-r", "-s", "--alias-file", "aliases", "-a",
+                                        "home=33.356593, 116.864816", "--within", "home:100",
+                                        "--within", "1, 1:5", "a.png", "b.png", "c.png", "d.png"])
+        stdout = sys.stdout
+        sys.stdout = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        try:
+            with addgps.ExiftoolEngine(fake_exiftool) as engine:
+                engine.execute(near + ["a.png"])
+                engine.execute(far + ["b.png"])
+                results = list(addgps.remove_within(args.filelist, args, engine))
+                report = sys.stdout.getvalue()
+                args.dryrun = False
+                self.assertEqual([r.returncode for r in results], [0, None, None, 1])
+                results = list(addgps.remove_within(args.filelist, args, engine))
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(report, "a.png: within 100 m of home (48 m)\n")
+        self.assertEqual([r.returncode for r in results], [0, None, None, 1])
+        with open("a.png.fake.json") as f:
+            self.assertNotIn("GPSLatitude", json.load(f))
+        with open("b.png.fake.json") as f:
+            self.assertIn("GPSLatitude", json.load(f))
+
+        with self.assertRaises(SystemExit):
+            addgps.handle_arguments(["--alias-file", "aliases", "--within", "1, 1:5", "a.png"])
+        with self.assertRaises(SystemExit):
+            addgps.handle_arguments(["-r", "--alias-file", "aliases", "--within", "x:5", "a.png"])
+
+    def test_remove_sidecar(self):
+        near = addgps.gps_arguments(addgps.GPSLatitude("10"), addgps.GPSLongitude("10"),
+                                    addgps.GPSAltitude(None))
+        for name in ("a.nef", "b.nef", "c.nef"):
+            with open(name, "wb") as f:
+                f.write(b"raw")
+        addgps.sidecar_job("a.nef", near, False)
+        with open("c.xmp", "wb") as f:
+            f.write(b"<x:xmpmeta")
+        args = addgps.handle_arguments(["-r", "--sidecar", "--alias-file", "aliases",
+                                        "--within", "10, 10:1000", "a.nef", "b.nef", "c.nef"])
+        with addgps.ExiftoolEngine(fake_exiftool) as engine:
+            results = list(addgps.remove_within(args.filelist, args, engine))
+        self.assertEqual([r.returncode for r in results], [0, None, 1])
+        self.assertIsNone(addgps.read_sidecar_gps("a.xmp"))
+        with open("a.nef", "rb") as f:
+            self.assertEqual(f.read(), b"raw")
+
+    def tearDown(self):
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+class TestWalk(unittest.TestCase):
+    tempdir = None
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        for name in ("top/a.jpg", "top/b.CR2", "top/sub/c.jpg", "top/sub/d.txt",
+                     "top/skip/e.jpg", "top/x.jpg"):
+            if not os.path.isdir(os.path.dirname(name)):
+                os.makedirs(os.path.dirname(name))
+            self.create_file(name)
+        os.link("top/a.jpg", "top/sub/hardlink.jpg")
+        os.symlink("..", "top/sub/loop")
+        os.symlink("a.jpg", "top/symlink.jpg")
+
+    def create_file(self, name):
+        open(os.path.join(self.tempdir, name), 'w').close()
+
+    def walk(self, paths, **kwargs):
+        return list(addgps.walk_files(paths, True, **kwargs))
+
+    def test_walk(self):
+        self.assertEqual(self.walk(["top"]),
+                         ["top/a.jpg", "top/b.CR2", "top/x.jpg", "top/skip/e.jpg",
+                          "top/sub/c.jpg", "top/sub/d.txt"])
+
+    def test_no_recursion(self):
+        self.assertEqual(list(addgps.walk_files(["top", "top/a.jpg", "nothing"])),
+                         ["top", "top/a.jpg", "nothing"])
+
+    def test_filters(self):
+        self.assertEqual(self.walk(["top"], extensions=set([".cr2", ".txt"])),
+                         ["top/b.CR2", "top/sub/d.txt"])
+        self.assertEqual(self.walk(["top"], include=["*.jpg"], exclude=["skip", "x.*"]),
+                         ["top/a.jpg", "top/sub/c.jpg"])
+
+    def test_follow_symlinks(self):
+        files = self.walk(["top"], follow_symlinks=True)
+        self.assertEqual(len(files), 6)
+        self.assertNotIn("top/symlink.jpg", files)
+
+    def test_without_scandir(self):
+        scandir = addgps.scandir
+        addgps.scandir = None
+        try:
+            self.assertEqual(len(self.walk(["top", "top/x.jpg"], follow_symlinks=True)), 6)
+        finally:
+            addgps.scandir = scandir
+
+    def test_arguments(self):
+        args = addgps.handle_arguments(["-R", "--ext", "jpg,.CR2", "--exclude", "sub", "top"])
+        self.assertEqual(list(addgps.expand_files(args)),
+                         ["top/a.jpg", "top/b.CR2", "top/x.jpg", "top/skip/e.jpg"])
+
+    def test_files_from(self):
+        self.create_file("top/new\nline.jpg")
+        with open("list", "wb") as f:
+            f.write(b"top/a.jpg\0top/new\nline.jpg\0top/a.jpg\0\0top/sub")
+        args = addgps.handle_arguments(["--files-from", "list", "-0", "top/x.jpg"])
+        self.assertEqual(list(addgps.expand_files(args)),
+                         ["top/x.jpg", "top/a.jpg", "top/new\nline.jpg", "top/a.jpg", "top/sub"])
+        args = addgps.handle_arguments(["-R", "--files-from", "list", "-0"])
+        # Listed files are not remembered, so their hard links are not skipped
+        self.assertEqual(list(addgps.expand_files(args))[-3:],
+                         ["top/sub/c.jpg", "top/sub/d.txt", "top/sub/hardlink.jpg"])
+        for arguments in (["-0", "a.jpg"], ["--files-from", "-", "a.jpg"],
+                          ["--files-from", "list", "--mapping", "map.csv"]):
+            with self.assertRaises(SystemExit):
+                addgps.handle_arguments(arguments)
+
+        # Names are produced as soon as they are written
+        reader, writer = os.pipe()
+        with io.open(reader, "rb") as stream:
+            names = addgps.read_names(stream)
+            os.write(writer, b"one.jpg\r\ntwo")
+            self.assertEqual(next(names), "one.jpg")
+            os.write(writer, b".jpg\nthree.jpg")
+            os.close(writer)
+            self.assertEqual(list(names), ["two.jpg", "three.jpg"])
+
+    def tearDown(self):
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+class TestAliasStore(unittest.TestCase):
+    tempdir = None
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        self.store = os.path.join(self.tempdir, "config", "aliases")
+
+    def alias(self, *arguments):
+        return addgps.main(["alias", "-q", "--alias-file", self.store] + list(arguments))
+
+    def test_add_remove(self):
+        self.assertEqual(self.alias("add", "home=33.3N, 44.4E, 100", "work=1,2"), 0)
+        self.assertEqual(self.alias("add", "bad=95,2", "worse"), 1)
+        self.assertEqual(self.alias("remove", "work", "nowhere"), 1)
+        self.assertEqual(addgps.AliasStore(self.store).load(),
+                         {"home": ("33.3N", "44.4E", "100")})
+
+    def test_no_command(self):
+        stderr = sys.stderr
+        sys.stderr = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        try:
+            for command in ("alias", "track-index", "gazetteer"):
+                with self.assertRaises(SystemExit):
+                    addgps.main([command, "-q"])
+        finally:
+            sys.stderr = stderr
+
+    def test_import(self):
+        with open("sites.csv", "w") as f:
+            f.write("# name, lat, lon, alt\na, 1, 2\nb=3, 4, 5f\n\nc, 95, 1\n")
+        self.assertEqual(self.alias("import", "sites.csv"), 1)
+        self.assertEqual(sorted(addgps.AliasStore(self.store).load()), ["a", "b"])
+
+    def test_cache(self):
+        self.alias("add", "a=1,2")
+        store = addgps.AliasStore(self.store)
+        self.assertEqual(store.load(), {"a": ("1", "2", "")})
+        self.assertTrue(os.path.exists(store.cachename))
+        # The cache is used while the store is unchanged ...
+        with open(store.cachename, "rb") as f:
+            cached = f.read()
+        self.assertEqual(store.load(), {"a": ("1", "2", "")})
+        # ... and rebuilt when it changes
+        with open(self.store, "a") as f:
+            f.write("b=3,4,5\n")
+        self.assertEqual(store.load(), {"a": ("1", "2", ""), "b": ("3", "4", "5")})
+        with open(store.cachename, "rb") as f:
+            self.assertNotEqual(f.read(), cached)
+
+    def test_load_aliases(self):
+        self.alias("add", "a=1,2", "b=3,4")
+        args = addgps.handle_arguments(["--alias-file", self.store, "-a", "b=5,6", "x.jpg"])
+        self.assertEqual(addgps.load_aliases(args), {"a": ("1", "2", ""), "b": ("5", "6", "")})
+
+    def test_index(self):
+        rng = random.Random(4)
+        aliases = dict(("a{}".format(n), ("{:.5f}".format(rng.uniform(-90, 90)),
+                                           "{:.5f}".format(rng.uniform(-180, 180)), ""))
+                       for n in range(300))
+        aliases["date_line"] = ("0", "179.999E", "")
+        index = addgps.AliasIndex.from_aliases(aliases)
+        self.assertEqual(len(index), 301)
+
+        def brute_force(lat, lon):
+            distances = []
+            for name, (alat, alon, _) in aliases.items():
+                # Longitudes are west-positive without a reference
+                alon = float(alon[:-1]) if alon.endswith("E") else -float(alon)
+                a = addgps.unit_vector(lat, lon)
+                b = addgps.unit_vector(float(alat), alon)
+                chord = sum((x - y) ** 2 for x, y in zip(a, b)) ** 0.5
+                distances.append((addgps.arc_distance(chord), name))
+            return sorted(distances)
+
+        for _ in range(20):
+            lat, lon = rng.uniform(-90, 90), rng.uniform(-180, 180)
+            expected = brute_force(lat, lon)
+            self.assertEqual([n for _, n in index.nearest(lat, lon, 5)],
+                             [n for _, n in expected[:5]])
+            within = index.within(lat, lon, 2000000)
+            self.assertEqual([n for _, n in within],
+                             [n for d, n in expected if d <= 2000000])
+        self.assertEqual(index.nearest(0, -179.999)[0][1], "date_line")
+        self.assertAlmostEqual(index.nearest(0, -179.999)[0][0], 222.4, places=0)
+        self.assertEqual(index.nearest(0, 0, 0), [])
+
+    def test_index_cache(self):
+        self.alias("add", "a=1,2", "b=3,4")
+        store = addgps.AliasStore(self.store)
+        index = store.index(store.load())
+        self.assertTrue(os.path.exists(self.store + ".index"))
+        self.assertEqual(index.nearest(1, -2.1)[0][1], "a")
+        cached = store.index(store.load())
+        self.assertEqual((cached.names, cached.columns), (index.names, index.columns))
+        # Aliases given on the command line are part of the index
+        aliases = store.load()
+        aliases["c"] = ("1", "2.1", "")
+        self.assertEqual(store.index(aliases, {"c": aliases["c"]}).nearest(1, -2.1)[0][1], "c")
+
+    def test_snap(self):
+        aliases = {"home": ("33.3N", "44.4E", "100")}
+        snapper = addgps.AliasSnapper(aliases, addgps.AliasIndex.from_aliases(aliases), 50)
+        jobs = list(snapper.jobs(addgps.mapping_jobs(
+            ["a.jpg,33.3002N,44.4E\n", "b.jpg,33.31N,44.4E\n", "c.jpg,95,1\n"], aliases)))
+        self.assertEqual(jobs[0][1], addgps.gps_arguments(
+            addgps.GPSLatitude("33.3N"), addgps.GPSLongitude("44.4E"), addgps.GPSAltitude("100")))
+        self.assertIn('-GPSLatitude=33.31', jobs[1][1])
+        self.assertEqual(jobs[2][1], None)
+
+    def test_completer(self):
+        completer = addgps.SimpleCompleter(["home", "hut", "work", "ho", "a"])
+        matches = []
+        while completer.complete("h", len(matches)):
+            matches.append(completer.complete("h", len(matches)))
+        self.assertEqual(matches, ["ho", "home", "hut"])
+        self.assertEqual(completer.complete("", 0), "a")
+        self.assertEqual(completer.complete("", 4), "work")
+        self.assertEqual(completer.complete("x", 0), None)
+
+    def tearDown(self):
+        del logging.getLogger(addgps.LOGGER_NAME).handlers[:]
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+GEONAMES = u"""5391959\tSan Francisco\tSan Francisco\t\t37.77493\t-122.41942\tP\tPPLA2\tUS\t\tCA\t075\t\t\t864816
+2950159\tBerlin\tBerlin\t\t52.52437\t13.41053\tP\tPPLC\tDE\t\t16\t00\t\t\t3426354
+2867714\tMünchen\tMuenchen\t\t48.13743\t11.57549\tP\tPPLA\tDE\t\t02\t091\t\t\t1260391
+6295630\tEarth\tEarth\t\t0\t0\tL\tAREA\t\t\t\t\t\t\t0
+"""
+
+class TestGazetteer(unittest.TestCase):
+    tempdir = None
+    datadir = os.path.join(here, 'data')
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        with io.open("cities.txt", "w", encoding="utf-8") as f:
+            f.write(GEONAMES + u"broken line\n")
+        with io.open("admin1.txt", "w", encoding="utf-8") as f:
+            f.write(u"US.CA\tCalifornia\tCalifornia\t5332921\nDE.02\tBavaria\tBavaria\t2951839\n")
+        with io.open("countries.txt", "w", encoding="utf-8") as f:
+            f.write(u"#ISO\tISO3\tISO-Numeric\tfips\tCountry\nDE\tDEU\t276\tGM\tGermany\n")
+        self.assertEqual(addgps.main(["gazetteer", "--gazetteer", "places", "-q", "build",
+                                      "--admin1", "admin1.txt", "--countries", "countries.txt",
+                                      "cities.txt"]), 0)
+
+    def test_nearest(self):
+        gazetteer = addgps.Gazetteer("places")
+        self.assertEqual(len(gazetteer), 3)
+        distance, place = gazetteer.nearest(48.14, 11.58)
+        self.assertLess(distance, 1000)
+        self.assertEqual(place, (u"München", u"Bavaria", u"Germany"))
+        self.assertEqual(gazetteer.nearest(37.8, -122.4)[1], (u"San Francisco", u"California", u"US"))
+        self.assertEqual(gazetteer.nearest(52.5, 13.4)[1], (u"Berlin", u"16", u"Germany"))
+        self.assertIsNone(gazetteer.nearest(0, 0))
+        gazetteer.close()
+        with open("cities.txt", "rb") as f:
+            with self.assertRaises(ValueError):
+                addgps.Gazetteer("cities.txt")
+
+    def test_geocode(self):
+        shutil.copy(os.path.join(self.datadir, "saturn.jpg"), "a.jpg")
+        with open("b.cr2", "wb") as f:
+            f.write(b"raw")
+        with open("map.csv", "w") as f:
+            f.write(u"a.jpg, 48.14, -11.58\nb.cr2, 48.14, -11.58\nc.jpg, 0, 0\n")
+        args = addgps.handle_arguments(["--geocode", "--gazetteer", "places", "--sidecar",
+                                        "--mapping", "map.csv"])
+        jobs = list(addgps.geocoded(addgps.mapping_jobs(open("map.csv"), {}), args))
+        self.assertIn(u'-XMP-photoshop:City=München', jobs[0][1])
+        self.assertIn(u'-IPTC:Province-State=Bavaria', jobs[0][1])
+        self.assertEqual(jobs[1][1], jobs[0][1])
+        self.assertEqual(len(jobs[2][1]), 4)
+
+        with addgps.ExiftoolEngine(fake_exiftool) as engine:
+            results = list(addgps.write_jobs(addgps.mapping_jobs(open("map.csv"), {}), args,
+                                             engine))
+        self.assertEqual([r.returncode for r in results], [0, 0, 1])
+        with io.open("a.jpg.fake.json", encoding="utf-8") as f:
+            tags = json.load(f)
+        self.assertEqual((tags["GPSLatitudeRef"], tags["XMP-photoshop:City"]), ("N", u"München"))
+        with io.open("b.xmp", "rb") as f:
+            sidecar = f.read()
+        self.assertIn(u'photoshop:City="München"'.encode("utf-8"), sidecar)
+        self.assertIn(b'exif:GPSLatitude="48,8.400000N"', sidecar)
+
+        with self.assertRaises(SystemExit):
+            addgps.handle_arguments(["--geocode", "--gazetteer", "nothing", "a.jpg"])
+        with self.assertRaises(SystemExit):
+            addgps.handle_arguments(["--gazetteer", "places", "a.jpg"])
+
+    def test_location_arguments(self):
+        arguments = addgps.location_arguments((u"Ä" * 20, u'The "State"', u""))
+        self.assertEqual(arguments[0], "-IPTC:CodedCharacterSet=UTF8")
+        self.assertIn(u'-IPTC:City={}'.format(u"Ä" * 16), arguments)
+        self.assertIn(u'-XMP-photoshop:State=The "State"', arguments)
+        self.assertEqual(len(arguments), 5)
+        others, place = addgps.split_location(["-GPSLatitude=1"] + arguments)
+        self.assertEqual(others, ["-GPSLatitude=1"])
+        self.assertEqual(place, {"City": u"Ä" * 20, "State": u'The "State"'})
+
+    def tearDown(self):
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+class TestPlan(unittest.TestCase):
+    tempdir = None
+    datadir = os.path.join(here, 'data')
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        for name in ("a.jpg", "b.jpg", "c.jpg"):
+            shutil.copy(os.path.join(self.datadir, "saturn.jpg"), name)
+        with open("mapping.csv", "w") as f:
+            f.write("a.jpg,1,2\nb.jpg,95,2\nb.jpg,3,4\nc.jpg,1,2\nmissing.jpg,1,2\n")
+
+    def addgps(self, *arguments):
+        return addgps.main(["-q", "--alias-file", "aliases"] + list(arguments))
+
+    def test_plan(self):
+        self.assertEqual(self.addgps("--mapping", "mapping.csv", "--plan", "out.plan"), 1)
+        plan = addgps.Plan("out.plan")
+        entries = list(plan.entries())
+        plan.close()
+        self.assertEqual([(n, os.path.basename(f)) for n, f, _ in entries],
+                         [(0, "a.jpg"), (1, "b.jpg"), (2, "c.jpg"), (3, "missing.jpg")])
+        self.assertIs(entries[0][2], entries[2][2])
+        self.assertEqual(entries[1][2][0], '-GPSLatitude=3.0')
+        # Nothing is written while planning
+        self.assertFalse(addgps.read_jpeg_gps("a.jpg"))
+        self.assertEqual([name for name in os.listdir(".") if name.endswith(".plan")],
+                         ["out.plan"])
+
+    def test_apply(self):
+        self.addgps("--mapping", "mapping.csv", "--plan", "out.plan")
+        self.assertEqual(self.addgps("--apply", "out.plan", "--range", "1:3"), 0)
+        self.assertFalse(addgps.read_jpeg_gps("a.jpg"))
+        self.assertEqual(addgps.gps_ifd_coordinates(addgps.read_jpeg_gps("b.jpg"))[:2],
+                         (3.0, -4.0))
+        plan_id = addgps.Plan("out.plan").id
+        journal = addgps.Journal("out.plan", plan_id)
+        self.assertEqual(journal.completed(), set([1, 2]))
+
+        os.remove("c.jpg")
+        self.assertEqual(self.addgps("--apply", "out.plan"), 1)
+        self.assertEqual(journal.completed(), set([0, 1, 2]))
+        self.assertTrue(addgps.read_jpeg_gps("a.jpg"))
+
+    def test_apply_manifest(self):
+        self.addgps("--mapping", "mapping.csv", "--plan", "out.plan")
+        self.assertEqual(self.addgps("--apply", "out.plan", "--range", "0:1",
+                                     "--manifest", "manifest.db"), 0)
+        path = os.path.abspath("a.jpg")
+        with addgps.Manifest("manifest.db") as manifest:
+            self.assertEqual(list(manifest.lookup([path])), [path])
+
+    def test_journal(self):
+        journal = addgps.Journal("out.plan", "1234", (0, 10))
+        for number in range(3):
+            journal.record(number)
+        journal.close()
+        with open("out.plan.0-10.journal", "a") as f:
+            f.write("12")       # cut short by a crash
+        with open("out.plan.journal", "w") as f:
+            f.write("5678\n7\n")  # another plan
+        self.assertEqual(journal.completed(), set([0, 1, 2]))
+        journal.record(3)
+        journal.close()
+        self.assertEqual(addgps.Journal("out.plan", "1234").completed(), set([0, 1, 2, 3]))
+
+    def test_range(self):
+        self.assertEqual(addgps.parse_range("10:20"), (10, 20))
+        self.assertEqual(addgps.parse_range(" 10: "), (10, None))
+        self.assertEqual(addgps.parse_range(":"), (0, None))
+        self.assertRaises(ValueError, addgps.parse_range, "20:10")
+        self.assertRaises(ValueError, addgps.parse_range, "10")
+
+    def tearDown(self):
+        del logging.getLogger(addgps.LOGGER_NAME).handlers[:]
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+class TestDaemon(unittest.TestCase):
+    tempdir = None
+    datadir = os.path.join(here, 'data')
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        for name in ("a.png", "b.jpg", "corrupt.png"):
+            shutil.copy(os.path.join(self.datadir, "saturn.jpg"), name)
+        self.socket = os.path.join(self.tempdir, "addgps.sock")
+        args = addgps.handle_arguments(["--daemon", "-q", "--alias-file", "aliases",
+                                        "-a", "home=1,2", "-j", "2"])
+        addgps.initialize_logging(args)
+        self.pool = addgps.ExiftoolPool(2, fake_exiftool)
+        self.server = addgps.DaemonServer(self.socket, addgps.DaemonRequestHandler)
+        self.server.daemon = addgps.Daemon(args, self.pool)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        os.environ[addgps_client.SOCKET_ENVIRONMENT] = self.socket
+
+    def request(self, **message):
+        return addgps_client.request(self.socket, message)
+
+    def test_requests(self):
+        self.assertEqual(self.request(command="aliases"), {"aliases": ["home"]})
+        answer = self.request(command="add", cwd=self.tempdir, coordinates="home",
+                              files=["a.png", "b.jpg", "corrupt.png"])
+        self.assertEqual([(name, code) for name, code, _ in answer["results"]],
+                         [("a.png", 0), ("b.jpg", 0), ("corrupt.png", 1)])
+        with open("a.png.fake.json") as f:
+            self.assertEqual(json.load(f)["GPSLatitude"], "1.0")
+        self.assertEqual(addgps.gps_ifd_coordinates(addgps.read_jpeg_gps("b.jpg"))[:2],
+                         (1.0, -2.0))
+        self.assertIn("out of range", self.request(command="add", cwd=self.tempdir,
+                                                   coordinates="95, 2", files=["a.png"])["error"])
+        self.assertIn("error", self.request(command="format"))
+
+    def test_concurrent(self):
+        names = ["{}.png".format(i) for i in range(20)]
+        for name in names:
+            shutil.copy("a.png", name)
+        answers = []
+        def add(name, latitude):
+            answers.append(self.request(command="add", cwd=self.tempdir,
+                                        coordinates="{}, 2".format(latitude), files=[name]))
+        threads = [threading.Thread(target=add, args=(name, i)) for i, name in enumerate(names)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(a["results"][0][1] for a in answers), [0] * len(names))
+        for i, name in enumerate(names):
+            with open(name + ".fake.json") as f:
+                self.assertEqual(json.load(f)["GPSLatitude"], "{}.0".format(i))
+
+    def test_client(self):
+        self.assertEqual(addgps_client.main(["-q", "-r", "a.png"]), 0)
+        self.assertTrue(os.path.exists("a.png.fake.json"))
+        # Without a daemon the client runs addgps itself
+        os.environ[addgps_client.SOCKET_ENVIRONMENT] = os.path.join(self.tempdir, "none.sock")
+        self.assertEqual(addgps_client.main(["-q", "-r", "missing.jpg"]), 1)
+
+    def tearDown(self):
+        del os.environ[addgps_client.SOCKET_ENVIRONMENT]
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        self.pool.close()
+        del logging.getLogger(addgps.LOGGER_NAME).handlers[:]
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+def box(kind, payload):
+    return struct.pack(">I", 8 + len(payload)) + kind + payload
+
+class TestScan(unittest.TestCase):
+    tempdir = None
+    datadir = os.path.join(here, 'data')
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        shutil.copy(os.path.join(self.datadir, "saturn.jpg"), "plain.jpg")
+        shutil.copy(os.path.join(self.datadir, "saturn.jpg"), "tagged.jpg")
+        arguments = addgps.gps_arguments(addgps.GPSLatitude("33.5"), addgps.GPSLongitude("116.25"),
+                                         addgps.GPSAltitude(None))
+        addgps.write_gps_native("tagged.jpg", addgps.WRITE_STRATEGIES["overwrite"] + arguments)
+        self.tiff = addgps.tiff_with_gps(addgps.empty_tiff(), addgps.native_gps_tags(arguments))
+        with open("tagged.tif", "wb") as f:
+            f.write(self.tiff)
+        with open("tagged.heic", "wb") as f:
+            f.write(self.heif(self.tiff))
+        with open("tagged.mp4", "wb") as f:
+            f.write(box(b"ftyp", b"isom\x00\x00\x02\x00") + box(b"mdat", b"\x00" * 1000) +
+                    box(b"moov", box(b"udta", box(b"\xa9xyz", b"\x00\x12\x15\xc7" +
+                                                   b"+37.7749-122.4194/"))))
+        with open("notes.txt", "w") as f:
+            f.write("no pictures here\n")
+
+    @staticmethod
+    def heif(tiff):
+        exif = b"\x00\x00\x00\x00" + tiff
+        infe = box(b"infe", b"\x02\x00\x00\x00" + struct.pack(">HH", 1, 0) + b"Exif")
+        iinf = box(b"iinf", b"\x00\x00\x00\x00" + struct.pack(">H", 1) + infe)
+        head = box(b"ftyp", b"heic\x00\x00\x00\x00mif1heic")
+
+        def iloc(offset):
+            return box(b"iloc", b"\x00\x00\x00\x00\x44\x00" + struct.pack(">HHHHII", 1, 1, 0, 1,
+                                                                           offset, len(exif)))
+        meta_size = len(box(b"meta", b"\x00\x00\x00\x00" + iinf + iloc(0)))
+        offset = len(head) + meta_size + 8
+        return head + box(b"meta", b"\x00\x00\x00\x00" + iinf + iloc(offset)) + box(b"mdat", exif)
+
+    def test_native(self):
+        self.assertIsNone(addgps.read_gps_native("plain.jpg"))
+        for name in ("tagged.jpg", "tagged.tif", "tagged.heic"):
+            lat, lon, alt = addgps.read_gps_native(name)
+            self.assertAlmostEqual(lat, 33.5)
+            self.assertAlmostEqual(lon, -116.25)
+            self.assertIsNone(alt)
+        self.assertEqual(addgps.read_gps_native("tagged.mp4"), (37.7749, -122.4194, None))
+        self.assertRaises(addgps.NativeWriterError, addgps.read_gps_native, "notes.txt")
+
+    def test_scan(self):
+        files = ["plain.jpg", "tagged.jpg", "tagged.heic", "tagged.mp4", "notes.txt", "missing.jpg"]
+        stream = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        args = addgps.handle_arguments(["--scan", "-j", "2"] + files)
+        with addgps.ExiftoolEngine(fake_exiftool) as engine:
+            self.assertEqual(addgps.scan(files, args, engine, stream), 1)
+        records = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual([(r["path"], r["has_gps"]) for r in records],
+                         [("plain.jpg", False), ("tagged.jpg", True), ("tagged.heic", True),
+                          ("tagged.mp4", True), ("notes.txt", False), ("missing.jpg", None)])
+        self.assertAlmostEqual(records[1]["lon"], -116.25)
+        self.assertIn("error", records[5])
+
+    def test_csv(self):
+        stream = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        args = addgps.handle_arguments(["--scan", "--scan-format", "csv", "-j", "1", "x"])
+        addgps.scan(["plain.jpg", "tagged.mp4"], args, None, stream)
+        self.assertEqual(stream.getvalue().splitlines(),
+                         ["path,has_gps,lat,lon,error", "plain.jpg,false,,,",
+                          "tagged.mp4,true,37.7749,-122.4194,"])
+
+    def tearDown(self):
+        del logging.getLogger(addgps.LOGGER_NAME).handlers[:]
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+class TestStats(unittest.TestCase):
+    tempdir = None
+    datadir = os.path.join(here, 'data')
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        for name in ("a.jpg", "b.jpg"):
+            shutil.copy(os.path.join(self.datadir, "saturn.jpg"), name)
+        with open("mapping.csv", "w") as f:
+            f.write("a.jpg,1,2\nb.jpg,3,4\nmissing.jpg,5,6\n")
+
+    def test_stats(self):
+        stats = addgps.Stats(total=3)
+        with stats.timer("parse", 2):
+            pass
+        stats.add("parse", 1.5)
+        stats.count("bytes_written", 100)
+        stats.count("bytes_written", 20)
+        stats.file_done(addgps.FileResult("a.jpg", 0, ""))
+        stats.file_done(addgps.FileResult("b.jpg", 1, "Not a file"))
+        summary = stats.summary()
+        self.assertEqual(summary["stages"]["parse"]["count"], 3)
+        self.assertGreaterEqual(summary["stages"]["parse"]["seconds"], 1.5)
+        self.assertEqual(summary["counters"], {"bytes_written": 120})
+        self.assertEqual((summary["files"], summary["failed"]), (2, 1))
+        self.assertIn("parse", stats.table())
+
+    def test_null_stats(self):
+        stats = addgps.NullStats()
+        with stats.timer("parse"):
+            stats.count("bytes_written", 100)
+        self.assertFalse(stats.enabled)
+        self.assertIs(stats.timer("parse"), stats.timer("write"))
+
+    def test_command_line(self):
+        self.assertEqual(addgps.main(["-q", "--alias-file", "aliases", "--mapping", "mapping.csv",
+                                      "--stats-json", "stats.json", "--profile", "run.prof"]), 1)
+        with open("stats.json") as f:
+            summary = json.load(f)
+        self.assertEqual((summary["files"], summary["failed"]), (3, 1))
+        self.assertEqual(summary["stages"]["native"]["count"], 2)
+        self.assertEqual(summary["stages"]["validate"]["count"], 3)
+        self.assertGreater(summary["counters"]["bytes_written"], 0)
+        self.assertTrue(os.path.getsize("run.prof"))
+        self.assertFalse(addgps.m_stats.enabled)
+
+    def test_events(self):
+        self.assertEqual(addgps.main(["--log-format", "jsonl", "--logfile", "log.jsonl",
+                                      "--alias-file", "aliases", "--mapping", "mapping.csv"]), 1)
+        with open("log.jsonl") as f:
+            records = [json.loads(line) for line in f]
+        events = [record for record in records if "path" in record]
+        self.assertEqual([(e["path"], e["action"], e["lat"], e["lon"], e["result"])
+                          for e in events],
+                         [("a.jpg", "add", 1.0, -2.0, "done"), ("b.jpg", "add", 3.0, -4.0, "done"),
+                          ("missing.jpg", "add", 5.0, -6.0, "failed")])
+        self.assertEqual(events[2]["detail"], "Not a file")
+        self.assertGreaterEqual(events[0]["seconds"], 0)
+        self.assertEqual(records[-1]["message"], "2 files processed, 1 failed")
+        self.assertFalse(addgps.m_events.enabled)
+        self.assertIsNone(addgps.m_log_listener)
+
+        # Without --log-format jsonl, files are not logged one by one
+        self.assertEqual(addgps.main(["--logfile", "log.txt", "--alias-file", "aliases",
+                                      "--mapping", "mapping.csv"]), 1)
+        with open("log.txt") as f:
+            self.assertNotIn("a.jpg", f.read())
+
+    @unittest.skipIf(addgps.QueueHandler is None, "logging has no QueueHandler")
+    def test_queue(self):
+        args = addgps.handle_arguments(["-q", "a.jpg"])
+        addgps.initialize_logging(args)
+        queued = [handler for handler in logging.getLogger(addgps.LOGGER_NAME).handlers
+                  if isinstance(handler, addgps.LogQueueHandler)]
+        self.assertEqual(len(queued), 1)
+        record = logging.LogRecord("addgps", logging.INFO, "", 0, "%s", (["a"],), None)
+        self.assertIs(queued[0].prepare(record), record)
+        addgps.stop_logging()
+        handlers = logging.getLogger(addgps.LOGGER_NAME).handlers
+        self.assertNotIn(queued[0], handlers)
+        self.assertIn(logging.StreamHandler, [type(handler) for handler in handlers])
+
+    def tearDown(self):
+        del logging.getLogger(addgps.LOGGER_NAME).handlers[:]
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
+@unittest.skipIf(sys.version_info[0] < 3, "the pipeline needs Python 3")
+class TestPipeline(unittest.TestCase):
+    tempdir = None
+    datadir = os.path.join(here, 'data')
+
+    def setUp(self):
+        import addgps_async
+        self.pipeline = addgps_async
+        self.tempdir = tempfile.mkdtemp()
+        os.chdir(self.tempdir)
+        for name in ("a.png", "b.png", "c.jpg", "corrupt.png"):
+            shutil.copy(os.path.join(self.datadir, "saturn.jpg"), name)
+        self.arguments = addgps.gps_arguments(addgps.GPSLatitude("1"), addgps.GPSLongitude("2"),
+                                              addgps.GPSAltitude(None))
+
+    def run_pipeline(self, jobs, dryrun=False, native=True):
+        return asyncio.run(self.pipeline.pipeline(jobs, 2, dryrun, native, fake_exiftool))
+
+    def test_write(self):
+        jobs = [(name, self.arguments) for name in ("a.png", "b.png", "c.jpg", "corrupt.png",
+                                                     "missing.png")] + [("a.png", None)]
+        counter = self.run_pipeline(jobs)
+        self.assertEqual((counter.done, counter.failed), (3, 3))
+        with open("b.png.fake.json") as f:
+            self.assertEqual(json.load(f)["GPSLatitude"], "1.0")
+        self.assertFalse(os.path.exists("c.jpg.fake.json"))     # written natively
+        self.assertEqual(addgps.gps_ifd_coordinates(addgps.read_jpeg_gps("c.jpg"))[:2],
+                         (1.0, -2.0))
+
+    def test_verify(self):
+        class Meddling(addgps.Verifier):
+            def check(self, results, expected):
+                if os.path.exists("b.png.fake.json"):
+                    os.remove("b.png.fake.json")
+                return super(Meddling, self).check(results, expected)
+
+        verifier = Meddling(hashes=True, executable=fake_exiftool)
+        jobs = [(name, self.arguments) for name in ("a.png", "b.png", "c.jpg")]
+        try:
+            counter = asyncio.run(self.pipeline.pipeline(jobs, 2, False, True, fake_exiftool,
+                                                         verifier=verifier))
+        finally:
+            verifier.close()
+        self.assertEqual((counter.done, counter.failed), (2, 1))
+        self.assertIsNone(addgps.handle_arguments(["--pipeline", "--verify", "a.png"]).plan)
+
+    def test_backpressure(self):
+        consumed = [0]
+        ahead = []
+        def jobs():
+            for _ in range(5000):
+                consumed[0] += 1
+                yield "a.png", self.arguments
+
+        class Counter(addgps.ResultCounter):
+            def add(self, result):
+                super(Counter, self).add(result)
+                ahead.append(consumed[0] - self.done)
+
+        counter_class = addgps.ResultCounter
+        addgps.ResultCounter = Counter
+        try:
+            counter = self.run_pipeline(jobs(), dryrun=True)
+        finally:
+            addgps.ResultCounter = counter_class
+        self.assertEqual(counter.done, 5000)
+        # Files are only read as far ahead as the queues allow
+        self.assertLess(max(ahead), 2000)
+
+    def test_exiftool(self):
+        engine = self.pipeline.AsyncExiftool(fake_exiftool)
+        loop = asyncio.new_event_loop()
+        try:
+            first = loop.run_until_complete(engine.execute(["-GPSLatitude=33.3", "a.png"]))
+            second = loop.run_until_complete(engine.execute(["-GPSLatitude=33.3", "corrupt.png"]))
+            loop.run_until_complete(engine.close())
+        finally:
+            loop.close()
+        self.assertEqual(first.returncode, 0)
+        self.assertEqual(second.returncode, 1)
+        self.assertIn("Not a valid JPG", second.stderr)
+
+    def tearDown(self):
+        os.chdir(here)
+        shutil.rmtree(self.tempdir)
+
 if __name__ == '__main__':
     unittest.main()